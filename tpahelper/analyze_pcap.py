@@ -1,27 +1,45 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from pandas import json_normalize
 from termcolor import colored
 
 import ast
-import ipaddress
-import json
+import glob
 import luigi
+import math
 import os
 import pandas as pd
-import requests
+import shlex
+import shutil
 import subprocess
+import sys
 import time
 
 from tpahelper.base import BaseTask, get_output_path
 from tpahelper.config import config
+from tpahelper.utils.addresses import public_addresses
+from tpahelper.utils.blocklists import load_blocklists, match_blocklists
+from tpahelper.utils.cache import evict_results, register_capture
+from tpahelper.utils.demux import FilterError, FlowIndex, compile_filter, demultiplex, demultiplex_flows
 from tpahelper.utils.external_commands import (
-    otx_ipv4,
-    otx_ipv6,
+    capinfos_duration,
+    editcap_time_split,
     tcpdump_protocol
 )
+from tpahelper.utils.flows import (
+    address_bytes_columns,
+    merge_shard_flows,
+    stream_flows_to_parquet
+)
+from tpahelper.utils.geoip import geoip_flows
 from tpahelper.utils.html_templates import datatable_template
+from tpahelper.utils.indicator_cache import IndicatorCache
+from tpahelper.utils.otx import query_indicators
+from tpahelper.utils.packet_index import PacketIndexBuilder
+from tpahelper.utils.pcap import PcapError
 from tpahelper.utils.protocols import ndpi_protocol_map as proto_map
 from tpahelper.utils.protocols import processor_map
+from tpahelper.utils.reputation import ReputationWriter, compact_reputation
+from tpahelper.utils.strings import extract_strings_task
 
 
 
@@ -32,14 +50,24 @@ def safe_eval(x):
         return x  # return as is if it's not a list string
 
 
+def run_ndpi_reader(pcap_path, flows_file):
+    # Execute ndpiReader with output handled by Python
+    return subprocess.run(["ndpiReader", "-i", pcap_path, "-K", "json", "-k", flows_file],
+                          capture_output=True,
+                          text=True)
+
+
 class RunNdpiReader(BaseTask):
+    shard_threshold = luigi.IntParameter(default=config.NDPI_SHARD_THRESHOLD)
+    shard_workers = luigi.IntParameter(default=config.NDPI_SHARD_WORKERS)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.pcap_name = str(self.pcap_file).split('/')[-1]
         self.pcap_path = os.path.abspath(self.pcap_file)
         self.output_path = get_output_path(self)
         self.summary_file = os.path.join(self.output_path, f"ndpi_summary.txt")
         self.flows_file = os.path.join(self.output_path, f"ndpi_flows.json")
+        self.shards_dir = os.path.join(self.output_path, "ndpi_shards")
 
     def output(self):
         return {
@@ -53,19 +81,71 @@ class RunNdpiReader(BaseTask):
         os.makedirs(self.output_dir, exist_ok=True)
         os.makedirs(self.output_path, exist_ok=True)
 
-        # Execute ndpiReader with output handled by Python
-        result = subprocess.run(["ndpiReader", "-i", self.pcap_path, "-K", "json", "-k", self.flows_file],
+        try:
+            if self.shard_workers > 1 and os.path.getsize(self.pcap_path) > self.shard_threshold:
+                shard_pcaps = self.split_capture()
+                if len(shard_pcaps) > 1:
+                    self.run_sharded(shard_pcaps)
+                    return
+
+            result = run_ndpi_reader(self.pcap_path, self.flows_file)
+
+            with open(self.summary_file, 'w') as summary_out:
+                summary_out.write(result.stdout)
+        finally:
+            # The shards are a full copy of the capture, whichever path ran
+            shutil.rmtree(self.shards_dir, ignore_errors=True)
+
+    def split_capture(self) -> list:
+        # Split the capture into one time window per worker
+        # Paths are quoted, upload and output paths may contain spaces
+        result = subprocess.run(shlex.split(capinfos_duration.format(shlex.quote(self.pcap_path))),
                                 capture_output=True,
                                 text=True)
+        try:
+            duration = float(result.stdout.strip().split(',')[-1])
+        except ValueError:
+            print(colored(f"Could not read capture duration: {result.stderr}", "yellow"))
+            return []
+
+        window = max(1, math.ceil(duration / self.shard_workers))
+        os.makedirs(self.shards_dir, exist_ok=True)
+        shard_prefix = os.path.join(self.shards_dir, "shard.pcap")
+        print(colored(f"Splitting capture into {window}s windows", "green"))
+        command = editcap_time_split.format(window, shlex.quote(self.pcap_path), shlex.quote(shard_prefix))
+        result = subprocess.run(shlex.split(command),
+                                capture_output=True,
+                                text=True)
+        if result.returncode != 0:
+            print(colored(f"Could not split capture, running unsharded: {result.stderr}", "yellow"))
+            return []
+
+        # editcap numbers the shards, so name order is time order
+        return sorted(glob.glob(os.path.join(glob.escape(self.shards_dir), "shard_*.pcap")))
+
+    def run_sharded(self, shard_pcaps: list):
+        print(colored(f"Running ndpiReader over {len(shard_pcaps)} shards", "green"))
+        shard_flow_files = [f"{shard}.json" for shard in shard_pcaps]
+
+        # ndpiReader runs as its own process, threads only wait on each shard
+        with ThreadPoolExecutor(max_workers=self.shard_workers) as pool:
+            results = list(pool.map(run_ndpi_reader, shard_pcaps, shard_flow_files))
+
+        written = merge_shard_flows([f for f in shard_flow_files if os.path.exists(f)], self.flows_file)
+        print(colored(f"Merged {written} flows from {len(shard_pcaps)} shards", "green"))
 
         with open(self.summary_file, 'w') as summary_out:
-            summary_out.write(result.stdout)
+            for shard, result in zip(shard_pcaps, results):
+                summary_out.write(f"Shard: {os.path.basename(shard)}\n")
+                summary_out.write(result.stdout)
 
 
 class NdpiFlowsToDataFrame(BaseTask):
+    streaming = luigi.BoolParameter(default=config.NDPI_STREAMING)
+    batch_size = luigi.IntParameter(default=config.NDPI_BATCH_SIZE)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.pcap_name = str(self.pcap_file).split('/')[-1]
         self.output_path = get_output_path(self)
         self.flows_parquet = os.path.join(self.output_path, "ndpi_flows.parquet")
 
@@ -80,40 +160,13 @@ class NdpiFlowsToDataFrame(BaseTask):
         # Accessing files generated by RunNdpiReader
         input_files = self.input()
         flows_file_path = input_files['flows'].path
-        df = pd.read_json(flows_file_path, lines=True)
 
-        # Explode dict values in columns to separate columns
-        explode_columns = ['xfer', 'iat', 'pktlen', 'tcp_flags']
-        for col in explode_columns:
-            if col in df.columns:
-                expanded_df = df[col].apply(pd.Series)
-                expanded_df.columns = [f"{col}_{c}" for c in expanded_df.columns]
-                df = df.join(expanded_df)
+        # Flatten and append the flows in bounded batches, or all at once
+        batch_size = self.batch_size if self.streaming else None
+        written = stream_flows_to_parquet(flows_file_path, self.flows_parquet, batch_size)
 
-        # Drop the original columns
-        df.drop(columns=explode_columns, inplace=True)
-        df = df.fillna('-')
-
-        # Rename columns (if existing) for compatibility:
-        # first_seen -> first_seen_ms
-        # last_seen -> last_seen_ms
-
-        if 'first_seen' in df.columns:
-            df.rename(columns={'first_seen': 'first_seen_ms'}, inplace=True)
-        if 'last_seen' in df.columns:
-            df.rename(columns={'last_seen': 'last_seen_ms'}, inplace=True)
-
-        # Convert milliseconds to UTC datetime
-        df["first_seen_utc"] = pd.to_datetime(df["first_seen_ms"], unit="ms", utc=True)
-        df["last_seen_utc"] = pd.to_datetime(df["last_seen_ms"], unit="ms", utc=True)
-
-        # Convert l7_protocol_data to string.
-        # required to deal with limitations of parquet file format
-        if 'l7_protocol_data' in df.columns:
-            df['l7_protocol_data'] = df['l7_protocol_data'].apply(str)
-
-        # Write the dataframe to parquet file
-        df.to_parquet(self.flows_parquet)
+        size_mb = os.path.getsize(self.flows_parquet) / 2 ** 20
+        print(colored(f"Wrote {written} flows to {self.flows_parquet} ({size_mb:.1f} MB)", "green"))
 
 class FlowsDataFrameToHTML(BaseTask):
     def __init__(self, *args, **kwargs):
@@ -121,7 +174,6 @@ class FlowsDataFrameToHTML(BaseTask):
         print(f"Initializing with pcap_file: {self.pcap_file}")
         self.output_path = get_output_path(self)
         self.flows_html = os.path.join(self.output_path, "flows.html")
-        self.pcap_name = str(self.pcap_file).split('/')[-1]
 
     def requires(self):
         return NdpiFlowsToDataFrame(**self.param_dict())
@@ -135,10 +187,10 @@ class FlowsDataFrameToHTML(BaseTask):
         input_files = self.input()
         flows_file_path = input_files.path
 
-        df = pd.read_parquet(flows_file_path)
+        df = pd.read_parquet(flows_file_path).drop(columns=address_bytes_columns, errors='ignore')
 
         # Convert DataFrame to HTML
-        html_table = df.to_html(classes='display', index=False, table_id='dataTable')
+        html_table = df.to_html(classes='display', index=False, table_id='dataTable', na_rep='-')
 
         page = datatable_template.format(html_table)
 
@@ -146,85 +198,64 @@ class FlowsDataFrameToHTML(BaseTask):
             out_file.write(page)
 
 
-class PublicIPsfromFlowsDataFrame(BaseTask):
+class GeoIPFlows(BaseTask):
+    country_db = luigi.Parameter(default=config.GEOIP_COUNTRY_DB)
+    asn_db = luigi.Parameter(default=config.GEOIP_ASN_DB)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.pcap_name = str(self.pcap_file).split('/')[-1]
-        self.output_path = os.path.join(self.output_dir, self.pcap_name.replace('.pcap', ''))
-        self.public_ips_file = os.path.join(self.output_path, f"public_ips.txt")
+        self.output_path = get_output_path(self)
+        self.geoip_parquet = os.path.join(self.output_path, "flows_geoip.parquet")
 
     def requires(self):
         return NdpiFlowsToDataFrame(**self.param_dict())
 
     def output(self):
-        return luigi.LocalTarget(self.public_ips_file)
+        return luigi.LocalTarget(self.geoip_parquet)
 
     def run(self):
-        print(colored("Task started: PublicIPsfromFlowsDataFrame", "green"))
-        # Accessing files generated by NdpiFlowsToDataFrame
-        input_files = self.input()
-        flows_file_path = input_files.path
-
-        df = pd.read_parquet(flows_file_path)
-        public_ips = [ip for ip in df['src_name'].unique()
-                      if not ipaddress.ip_address(ip).is_private
-                      and not ipaddress.ip_address(ip).is_reserved
-                      and not ipaddress.ip_address(ip).is_link_local
-                      and not ipaddress.ip_address(ip).is_loopback
-                      and not ipaddress.ip_address(ip).is_multicast]
-
-        public_ips += [ip for ip in df['dst_name'].unique()
-                      if not ipaddress.ip_address(ip).is_private
-                      and not ipaddress.ip_address(ip).is_reserved
-                      and not ipaddress.ip_address(ip).is_link_local
-                      and not ipaddress.ip_address(ip).is_loopback
-                      and not ipaddress.ip_address(ip).is_multicast]
-
-
-        with self.output().open('w') as out_file:
-            for ip in public_ips:
-                out_file.write(f"{ip}\n")
-            else:
-                out_file.write("")
-
-        print(colored(f"Public IPs written to {self.public_ips_file}", "green"))
-        print(colored(f"Public IPs: {public_ips}", "green"))
+        print(colored("Task started: GeoIPFlows", "green"))
+        # Looked up once per distinct address, written row for row with the flows
+        geoip, stats = geoip_flows(self.input().path, [self.country_db, self.asn_db], config.GEOIP_CACHE,
+                                   self.geoip_parquet, max_entries=config.GEOIP_CACHE_MAX_ENTRIES)
 
+        if not stats['databases']:
+            print(colored(f"No GeoIP databases found ({self.country_db}, {self.asn_db})", "yellow"))
+        print(colored(f"GeoIP: {geoip.num_rows} flows, {stats['addresses']} distinct addresses, "
+                      f"{stats['hits']} memoized, {stats['lookups']} lookups", "green"))
 
-class QueryOTX(BaseTask):
-    indicator = luigi.Parameter()
-    indicator_type = luigi.Parameter()
-    output_file = luigi.Parameter()
 
+class PublicIPsfromFlowsDataFrame(BaseTask):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.output_path = get_output_path(self)
+        self.public_ips_file = os.path.join(self.output_path, "public_ips.parquet")
+
+    def requires(self):
+        return NdpiFlowsToDataFrame(**self.param_dict())
 
     def output(self):
-        return luigi.LocalTarget(self.output_file)
+        return luigi.LocalTarget(self.public_ips_file)
 
     def run(self):
-        print(colored(f"Task started: QueryOTX, Indicator: {self.indicator}", "green"))
-        otx_url = None
-        if self.indicator_type == "ipv4":
-            otx_url = otx_ipv4
-        elif self.indicator_type == "ipv6":
-            otx_url = otx_ipv6
-
-        # Query OTX for the indicator
-        if otx_url:
-            resp = requests.get(otx_url.format(self.indicator))
-            if resp.status_code == 200:
-                otx_data = resp.json()
-            else:
-                otx_data = {'error': 'Failed to fetch data', 'indicator': self.indicator}
-        else:
-            otx_data = {'error': 'Invalid indicator type', 'indicator': self.indicator}
+        print(colored("Task started: PublicIPsfromFlowsDataFrame", "green"))
+        # Accessing files generated by NdpiFlowsToDataFrame
+        flows_file_path = self.input().path
+
+        # Distinct public addresses of both sides, classified on their packed form
+        public_ips = public_addresses(flows_file_path, self.public_ips_file)
+
+        versions = public_ips['version'].to_numpy()
+        print(colored(f"Public IPs written to {self.public_ips_file}", "green"))
+        print(colored(f"Public IPs: {(versions == 4).sum()} IPv4, {(versions == 6).sum()} IPv6", "green"))
 
-        print(colored(f"OTX results stored in {self.output_file}", "green"))
-        with self.output().open('w') as out_file:
-            json.dump(otx_data, out_file)
 
 class IPReputation(BaseTask):
+    concurrency = luigi.IntParameter(default=config.OTX_CONCURRENCY)
+    rate = luigi.FloatParameter(default=config.OTX_RATE)
+    retries = luigi.IntParameter(default=config.OTX_RETRIES)
+    base_url = luigi.OptionalParameter(default=config.OTX_BASE_URL)
+
     # Define retry parameters
     retry_count = 3  # Number of retries
     retry_delay = 300  # Delay between retries in seconds (optional)
@@ -233,151 +264,122 @@ class IPReputation(BaseTask):
         super().__init__(*args, **kwargs)
         self.out_dir = self.task_output_path("indicators")
         self.raw_dir = self.task_output_path("indicators/raw")
+        self.reputation_parquet = os.path.join(self.out_dir, "ip_reputation.parquet")
         self.retry_count = 10
         self.retry_delay = 15
         self.ipv4 = []
         self.ipv6 = []
-        self.return_values = []
 
     def requires(self):
         return PublicIPsfromFlowsDataFrame(**self.param_dict())
 
     def output(self):
-        default_output = os.path.join(self.out_dir, "IPReputation_complete.txt")
-        return [luigi.LocalTarget(default_output)] + self.return_values
+        return luigi.LocalTarget(os.path.join(self.out_dir, "IPReputation_complete.txt"))
 
     def get_public_ips(self):
-        with open(self.input().path, 'r') as infile:
-            ips = infile.readlines()
-
-        self.ipv4 = list(set(ip.strip() for ip in ips if ipaddress.ip_address(ip.strip()).version == 4))
-        self.ipv6 = list(set(ip.strip() for ip in ips if ipaddress.ip_address(ip.strip()).version == 6))
-
-        # define the output values
-        self.return_values += [luigi.LocalTarget(os.path.join(self.raw_dir, f"otx_ipv4_{ip}.json")) for ip in self.ipv4]
-        self.return_values += [luigi.LocalTarget(os.path.join(self.raw_dir, f"otx_ipv6_{ip}.json")) for ip in self.ipv6]
+        public_ips = pd.read_parquet(self.input().path, columns=['ip', 'version'])
+        self.ipv4 = public_ips.loc[public_ips['version'] == 4, 'ip'].tolist()
+        self.ipv6 = public_ips.loc[public_ips['version'] == 6, 'ip'].tolist()
 
     def run(self):
         print(colored("Task started: IPReputation", "green"))
-        print(colored(f"IPs to process: {self.ipv4}, {self.ipv6}", "green"))
         # create output directory
         os.makedirs(self.out_dir, exist_ok=True)
         os.makedirs(self.raw_dir, exist_ok=True)
 
-        # call QueryOTX with ipv4_ips and ipv6_ips separately
-        query_tasks = []  # List to store all QueryOTX tasks
-
         self.get_public_ips()
 
-        if self.ipv4:
-            print(colored(f"Querying OTX for {len(self.ipv4)} IPv4 addresses", "green"))
-            indicator_type = "ipv4"
-            for indicator in self.ipv4:
-                output_file = os.path.join(self.raw_dir, f"otx_{indicator_type}_{indicator}.json")
-                query_task = QueryOTX(pcap_file=self.pcap_file, indicator=indicator,
-                                      indicator_type=indicator_type, output_file=output_file)
-                query_tasks.append(query_task)
-                yield query_task
-
-        if self.ipv6:
-            print(colored(f"Querying OTX for {len(self.ipv6)} IPv6 addresses", "green"))
-            indicator_type = "ipv6"
-            for indicator in self.ipv6:
-                output_file = os.path.join(self.raw_dir, f"otx_{indicator_type}_{indicator}.json")
-                query_task = QueryOTX(pcap_file=self.pcap_file, indicator=indicator,
-                                      indicator_type=indicator_type, output_file=output_file)
-                query_tasks.append(query_task)
-                yield query_task
-
-        if not query_tasks:  # If there are no QueryOTX tasks, exit early
-            print(colored("No public IPs found", "yellow"))
-        else:
-            # Wait for all QueryOTX tasks to complete
-            yield query_tasks
+        indicators = [(ip, 'ipv4') for ip in self.ipv4] + [(ip, 'ipv6') for ip in self.ipv6]
+        # Results are summarized as they arrive, the summary so far is the checkpoint
+        with ReputationWriter(self.reputation_parquet) as writer:
+            pending = [key for key in indicators if key not in writer.done]
+            if not indicators:
+                print(colored("No public IPs found", "yellow"))
+            elif not config.OTX_ENABLED:
+                print(colored("OTX disabled, skipping online IP reputation", "yellow"))
+            elif not pending:
+                print(colored(f"All {len(indicators)} public IPs already summarized", "green"))
+            else:
+                if len(pending) < len(indicators):
+                    print(colored(f"Resuming, {len(indicators) - len(pending)} public IPs already summarized",
+                                  "green"))
+                # All indicators are queried in one pooled, rate limited stage
+                print(colored(f"Querying OTX for {len(pending)} of {len(self.ipv4)} IPv4 and "
+                              f"{len(self.ipv6)} IPv6 addresses", "green"))
+                with IndicatorCache(config.INDICATOR_CACHE, ttl=config.INDICATOR_CACHE_TTL,
+                                    negative_ttl=config.INDICATOR_CACHE_NEGATIVE_TTL,
+                                    max_bytes=config.INDICATOR_CACHE_MAX_BYTES) as cache:
+                    stats = query_indicators(pending, self.raw_dir, concurrency=self.concurrency, rate=self.rate,
+                                             retries=self.retries, base_url=self.base_url,
+                                             api_key=config.OTX_API_KEY, cache=cache, on_result=writer.add)
+                print(colored(f"OTX cache: {stats['hits']} hits, {stats['misses']} misses", "green"))
+                print(colored(f"OTX: {stats['fetched']} fetched, {stats['failed']} failed, "
+                              f"{stats['skipped']} already queried", "green"))
 
         # Store completion time in marker file
-        with open(self.output()[0].path, 'w') as marker_file:
+        with open(self.output().path, 'w') as marker_file:
             marker_file.write(datetime.now().isoformat())
 
 
+class BlocklistMatches(BaseTask):
+    blocklist_dir = luigi.Parameter(default=config.BLOCKLIST_DIR)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.out_dir = self.task_output_path("indicators")
+        self.matches_file = os.path.join(self.out_dir, "blocklist_matches.parquet")
+
+    def requires(self):
+        return NdpiFlowsToDataFrame(**self.param_dict())
+
+    def output(self):
+        return luigi.LocalTarget(self.matches_file)
+
+    def run(self):
+        print(colored("Task started: BlocklistMatches", "green"))
+        os.makedirs(self.out_dir, exist_ok=True)
+
+        # The compiled index is shared by all captures and rebuilt when a feed changes
+        index = load_blocklists(self.blocklist_dir, config.BLOCKLIST_INDEX)
+        if not index.feeds:
+            print(colored(f"No blocklists found in {self.blocklist_dir}", "yellow"))
+        matches = match_blocklists(self.input().path, index, self.matches_file)
+
+        listed = len(set(matches['ip'].to_pylist()))
+        print(colored(f"Blocklists: {listed} addresses listed, {matches.num_rows} hits in "
+                      f"{len(index.feeds)} feeds", "green"))
+
+
 class SummarizeIPReputation(BaseTask):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        # self.output_path = os.path.join(get_output_path(self), "indicators")
         self.out_dir = self.task_output_path("indicators")
         self.out_parquet = os.path.join(self.out_dir, "ip_reputation.parquet")
         self.out_html = os.path.join(self.out_dir, "ip_reputation.html")
 
     def requires(self):
-        return IPReputation(**self.param_dict())
+        return {
+            'otx': IPReputation(**self.param_dict()),
+            'blocklists': BlocklistMatches(**self.param_dict()),
+        }
 
     def output(self):
         return [luigi.LocalTarget(self.out_parquet), luigi.LocalTarget(self.out_html)]
 
     def run(self):
-        # create output directory
         print(colored("Task started: SummarizeIPReputation", "green"))
         os.makedirs(self.out_dir, exist_ok=True)
 
-        # Accessing files generated by IPReputation
-        input_files = list(input_file.path for input_file in self.input())
-        if len(input_files) == 1:
+        # IPReputation summarized the results as they arrived, the parts are
+        # merged into one sorted file together with the blocklist hits
+        table = compact_reputation(self.out_parquet, self.input()['blocklists'].path)
+        if not table.num_rows:
             print(colored("No IPs to process", "yellow"))
-            # create empty parquet file and blank html page
-            pd.DataFrame().to_parquet(self.out_parquet)
             with open(self.out_html, 'w') as out_file:
                 out_file.write(datatable_template.format(''))
-
             return
 
-        # Skip the marker file
-        input_files = input_files[1:] if len(input_files) > 1 else []
-        otx_files = [f for f in input_files]
-
-        # Initialize an empty DataFrame for the main data and pulses
-        main_df_list = []
-        pulses_df_list = []
-
-        # Read each file and process
-        for file in otx_files:
-            with open(file, 'r') as infile:
-                data = json.load(infile)
-
-                # Normalize main data, excluding the deeply nested 'pulses' first
-                this_df = json_normalize(data)
-                if 'pulse_info.pulses' in this_df.columns:
-                    this_df.drop(columns=['pulse_info.pulses'], inplace=True)
-
-                # Store each main DataFrame to list
-                main_df_list.append(this_df)
-
-                # Check if 'pulse_info.pulses' is present and process if available
-                if 'pulse_info.pulses' in data:
-                    # Normalize pulses data
-                    pulses = json_normalize(data, record_path=['pulse_info', 'pulses'])
-                    # Add an identifier if necessary (e.g., from the main data)
-                    if 'indicator' in this_df.columns:
-                        pulses['indicator'] = data['indicator']
-                    pulses_df_list.append(pulses)
-
-        # Concatenate all main dataframes into a single DataFrame
-        main_df = pd.concat(main_df_list, ignore_index=True, sort=False)
-
-        # Concatenate all pulses dataframes into a single DataFrame
-        if pulses_df_list:
-            pulses_df = pd.concat(pulses_df_list, ignore_index=True, sort=False)
-
-            # Join pulses to the main DataFrame based on an identifier or directly if the order is preserved
-            # Here we assume 'indicator' to be the linking column; adjust as necessary
-            df = pd.merge(main_df, pulses_df, on='indicator', how='left', suffixes=('', '_pulse'))
-        else:
-            df = main_df  # No pulses data to merge
-
-        # Replace empty lists with None using applymap and proper list comparison
-        df = df.applymap(lambda x: None if isinstance(x, list) and not x else x)
-
-        # Write the DataFrame to parquet file
-        df.to_parquet(self.out_parquet)
+        df = table.to_pandas()
         html_table = df.to_html(classes='display', index=False, table_id='dataTable')
 
         page = datatable_template.format(html_table)
@@ -410,15 +412,17 @@ class ExtractProtocol(BaseTask):
 
 
 class SegmentProtocols(BaseTask):
+    segment_mode = luigi.ChoiceParameter(choices=['flows', 'ports'], default=config.SEGMENT_MODE)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.output_path = get_output_path(self)
         self.protocols_dir = os.path.join(self.output_path, "protocols")
         self.protocol_pcaps_dir = os.path.join(self.protocols_dir, "pcaps")
-        self.pcap_name = str(self.pcap_file).split('/')[-1]
         self.to_extract = []
         self.output_pcaps = []
         self.marker_file = os.path.join(self.output_path, "SegmentProtocols_complete.txt")
+        self.packet_index = os.path.join(self.output_path, "packet_index.parquet")
 
     def requires(self):
         return NdpiFlowsToDataFrame(**self.param_dict())
@@ -431,12 +435,40 @@ class SegmentProtocols(BaseTask):
         # create protocols directory
         os.makedirs(self.protocol_pcaps_dir, exist_ok=True)
 
+        if self.segment_mode == 'flows':
+            try:
+                self.segment_by_flows()
+            except PcapError as e:
+                print(colored(f"{e}, segmenting by port filters", "yellow"))
+                yield from self.segment_by_ports()
+        else:
+            yield from self.segment_by_ports()
+
+        with open(self.marker_file, 'w') as f:
+            f.write("ProcessProtocols task completed successfully.\n")
+
+    def segment_by_flows(self):
+        # route every packet to the protocol nDPI classified its flow as
+        flow_index = FlowIndex.from_parquet(self.input().path)
+        outputs = {protocol: os.path.join(self.protocol_pcaps_dir, f"{self.pcap_name}_{protocol}.pcap")
+                   for protocol in sorted(flow_index.protocols)}
+        with PacketIndexBuilder(self.pcap_file, self.packet_index) as index:
+            counts = demultiplex_flows(self.pcap_file, flow_index, outputs, index)
+        self.output_pcaps = [luigi.LocalTarget(path) for path in outputs.values()]
+        print(colored(f"Packets per protocol: {counts}", "green"))
+
+    def segment_by_ports(self):
+        # run() restarts from the top after dynamic dependencies, start over
+        self.to_extract = []
+        self.output_pcaps = []
+
         # load flows dataframe
-        flows_df = pd.read_parquet(self.input().path)
+        flows_df = pd.read_parquet(self.input().path, columns=['l7_protocol_name', 'src_port', 'dst_port'])
 
         # get unique l7_protocol_name values and their corresponding src_port and dst_port
-        protocols = flows_df['l7_protocol_name'].unique()
-        l7_protocols_ports = flows_df.groupby('l7_protocol_name').agg({'src_port': 'unique', 'dst_port': 'unique'}).reset_index()
+        protocols = flows_df['l7_protocol_name'].dropna().unique()
+        l7_protocols_ports = flows_df.groupby('l7_protocol_name', observed=True).agg(
+            {'src_port': 'unique', 'dst_port': 'unique'}).reset_index()
 
         summary_csv = []
 
@@ -466,41 +498,77 @@ class SegmentProtocols(BaseTask):
             else:
                 summary_csv.append((protocol, "unhandled", None))
 
-        # extract protocols
+        # extract protocols in a single pass over the capture.
+        # tcpdump remains the fallback for filters the demultiplexer can't compile.
+        demux_outputs = {}
+        fallback = {}
+        filters = {}
         for proto_tuple in self.to_extract:
             output_pcap = os.path.join(self.protocol_pcaps_dir, f"{self.pcap_name}_{proto_tuple[0]}.pcap")
             self.output_pcaps.append(luigi.LocalTarget(output_pcap))
-            yield ExtractProtocol(pcap_file=self.pcap_file, output_pcap=output_pcap, filters=proto_tuple[1])
-
-        with open(self.marker_file, 'w') as f:
-            f.write("ProcessProtocols task completed successfully.\n")
+            filters[output_pcap] = proto_tuple[1]
+            try:
+                demux_outputs[output_pcap] = compile_filter(proto_tuple[1]['tcpdump'])
+            except FilterError as e:
+                print(colored(f"{e}, using tcpdump", "yellow"))
+                fallback[output_pcap] = proto_tuple[1]
+
+        # Luigi restarts run() until the dynamic dependencies it yields are
+        # complete, so they are yielded before the capture is demultiplexed
+        if fallback:
+            yield self.extract_tasks(fallback)
+
+        if demux_outputs:
+            try:
+                with PacketIndexBuilder(self.pcap_file, self.packet_index) as index:
+                    counts = demultiplex(self.pcap_file, demux_outputs, index)
+                print(colored(f"Packets per protocol: {counts}", "green"))
+            except PcapError as e:
+                print(colored(f"{e}, using tcpdump", "yellow"))
+                yield self.extract_tasks({output_pcap: filters[output_pcap] for output_pcap in demux_outputs})
+
+    def extract_tasks(self, filters_by_pcap: dict) -> list:
+        return [ExtractProtocol(**self.param_dict(), output_pcap=output_pcap, filters=filters)
+                for output_pcap, filters in filters_by_pcap.items()]
 
 
 class ExtractStrings(BaseTask):
-    protocol_pcap = luigi.Parameter()
+    protocol_pcaps = luigi.ListParameter()
+    min_length = luigi.IntParameter(default=config.STRINGS_MIN_LENGTH)
+    workers = luigi.IntParameter(default=config.STRINGS_WORKERS)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.proto_strings_dir = os.path.join(get_output_path(self), "protocols", "strings")
-        self.output_filename = str(self.protocol_pcap).split('_')[-1].replace('.pcap', '') + "_strings.txt"
-        self.output_filepath = os.path.join(self.proto_strings_dir, self.output_filename)
+        self.outputs = []
+        for protocol_pcap in self.protocol_pcaps:
+            protocol = str(protocol_pcap).split('_')[-1].replace('.pcap', '')
+            self.outputs.append((protocol_pcap,
+                                 os.path.join(self.proto_strings_dir, f"{protocol}_strings.txt"),
+                                 os.path.join(self.proto_strings_dir, f"{protocol}_strings.parquet"),
+                                 os.path.join(self.proto_strings_dir, f"{protocol}_templates.parquet")))
 
     def output(self):
-        return luigi.LocalTarget(self.output_filepath)
+        return [luigi.LocalTarget(path) for _, *paths in self.outputs for path in paths]
 
     def run(self):
-        print(colored(f"Dumping strings: {self.output_filename}", "green"))
+        print(colored(f"Dumping strings: {len(self.outputs)} protocol pcaps", "green"))
         # create strings directory
         os.makedirs(self.proto_strings_dir, exist_ok=True)
 
-        command = f"strictstrings -q {self.protocol_pcap} > {self.output_filepath}"
-        print(colored(f'Executing command: {command}', 'yellow'))
-
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
+        # one protocol pcap per process
+        jobs = [(*paths, self.min_length) for paths in self.outputs]
+        with ProcessPoolExecutor(max_workers=max(1, min(self.workers, len(jobs)))) as executor:
+            for pcap_name, unique, templates in executor.map(extract_strings_task, jobs):
+                print(colored(f"Strings extracted: {pcap_name} ({unique} unique, {templates} templates)", "green"))
 
 
 class ExtractProtocolValues(BaseTask):
     protocol_pcap = luigi.Parameter()
+    json_output = luigi.ChoiceParameter(choices=['none', 'gzip', 'plain'], default=config.PROCESSOR_JSON_OUTPUT)
+    chart_points = luigi.IntParameter(default=config.CHART_MAX_POINTS)
+    chart_page_size = luigi.IntParameter(default=config.CHART_PAGE_SIZE)
+    chart_method = luigi.ChoiceParameter(choices=['minmax', 'lttb'], default=config.CHART_DOWNSAMPLING)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -520,7 +588,9 @@ class ExtractProtocolValues(BaseTask):
 
         cls = processor_map.get(self.protocol.lower(), None)
         if cls:
-            processor = cls(self.protocol_pcap, self.protocol_values_dir)
+            processor = cls(self.protocol_pcap, self.protocol_values_dir, json_output=self.json_output,
+                            chart_points=self.chart_points, chart_page_size=self.chart_page_size,
+                            chart_method=self.chart_method)
             print(colored(f"Running processor {processor.name} for: {self.protocol_pcap}", "green"))
             self.output_files = processor.run()
             print(colored(f"Output files: {self.output_files}", "green"))
@@ -539,12 +609,14 @@ class ProcessProtocols(BaseTask):
 
     def run(self):
         print(colored("Task started: ProcessProtocols", "green"))
-        for target in self.input():
-            protocol = str(target.path).split('_')[-1].replace('.pcap', '')
-            self.protocol_tasks.append(ExtractStrings(pcap_file=self.pcap_file, protocol_pcap=target.path))
+        protocol_pcaps = [target.path for target in self.input() if target.path.endswith('.pcap')]
+        if protocol_pcaps:
+            self.protocol_tasks.append(ExtractStrings(**self.param_dict(), protocol_pcaps=protocol_pcaps))
 
+        for protocol_pcap in protocol_pcaps:
+            protocol = str(protocol_pcap).split('_')[-1].replace('.pcap', '')
             if protocol.lower() in processor_map:
-                self.protocol_tasks.append(ExtractProtocolValues(pcap_file=self.pcap_file, protocol_pcap=target.path))
+                self.protocol_tasks.append(ExtractProtocolValues(**self.param_dict(), protocol_pcap=protocol_pcap))
 
         yield self.protocol_tasks
 
@@ -570,6 +642,7 @@ class AllTasks(BaseTask):
         return [
             PublicIPsfromFlowsDataFrame(**self.param_dict()),
             FlowsDataFrameToHTML(**self.param_dict()),
+            GeoIPFlows(**self.param_dict()),
             ProcessProtocols(**self.param_dict()),
             SummarizeIPReputation(**self.param_dict()),
         ]
@@ -605,9 +678,29 @@ class AllTasks(BaseTask):
         with self.output()['success'].open('w') as f:
             f.write(f"Task succeeded at {datetime.now().isoformat()}\n")
 
+        # Keep the result cache within its size budget
+        evicted = evict_results(self.output_dir, config.RESULT_CACHE_MAX_BYTES, keep=(self.pcap_digest,))
+        if evicted:
+            print(colored(f"Evicted cached results: {evicted}", "yellow"))
+
     def on_failure(self, exception):
         print(colored(f"Task {self.task_id} failed with exception: {exception}", "red"))
         # write timestamp to the failure output file:
         with self.output()['failure'].open('w') as f:
             f.write(f"Task failed at {datetime.now().isoformat()}\n{str(exception)}\n")
         raise exception
+
+
+def analyze_capture(pcap_file, output_dir=config.OUTPUT_DIR, workers: int = config.WORKERS) -> bool:
+    """Runs every task on pcap_file. The capture is hashed here, once, and its digest passed to the tasks."""
+    digest = register_capture(pcap_file, output_dir)
+    return luigi.build([AllTasks(pcap_file=pcap_file, output_dir=output_dir, pcap_digest=digest)], workers=workers)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m tpahelper.analyze_pcap <pcap file> [output dir]")
+        sys.exit(1)
+
+    luigi.configuration.get_config().set('core', 'no_lock', 'True')
+    analyze_capture(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else config.OUTPUT_DIR)
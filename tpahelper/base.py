@@ -4,26 +4,33 @@ import os
 import pandas as pd
 import subprocess
 from tpahelper.config import config
+from tpahelper.utils.cache import capture_name
 
 
 def get_output_path(self):
-    return os.path.join(self.output_dir, self.pcap_name.replace('.pcap', ''))
+    return os.path.join(self.output_dir, self.pcap_digest)
 
 
 class BaseTask(luigi.Task):
     pcap_file = luigi.Parameter()
     output_dir = luigi.Parameter(default=config.OUTPUT_DIR)
+    # Content digest from cache.register_capture, resolved once when the
+    # capture is uploaded or submitted and passed down to every task
+    pcap_digest = luigi.Parameter()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Ensure all parameters are initialized before setting this.
-        self.pcap_name = str(self.pcap_file).split('/')[-1]
+        # Outputs are keyed by the capture's content, and named after the
+        # first filename the capture was seen under.
+        self.pcap_name = (capture_name(self.pcap_digest, self.output_dir)
+                          or str(self.pcap_file).split('/')[-1])
 
     def output_path(self):
-        return os.path.join(self.output_dir, self.pcap_name.replace('.pcap', ''))
+        return os.path.join(self.output_dir, self.pcap_digest)
 
     def task_output_path(self, task_path:str):
         return os.path.join(self.output_path(), task_path)
 
     def param_dict(self):
-        return {'pcap_file': self.pcap_file, 'output_dir': self.output_dir}
\ No newline at end of file
+        return {'pcap_file': self.pcap_file, 'output_dir': self.output_dir, 'pcap_digest': self.pcap_digest}
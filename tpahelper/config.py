@@ -6,6 +6,74 @@ class Config:
     ALLOWED_EXTENSIONS = {'pcap', 'pcapng'}
     OUTPUT_DIR = os.path.join(BASE_DIR, 'processed')
     WORKERS = 1
+    # Stream ndpi flows to parquet in batches of NDPI_BATCH_SIZE flows
+    NDPI_STREAMING = True
+    NDPI_BATCH_SIZE = 100000
+    # Captures larger than NDPI_SHARD_THRESHOLD bytes are split into time
+    # windows and run through ndpiReader in parallel
+    NDPI_SHARD_THRESHOLD = 2 * 1024 ** 3
+    NDPI_SHARD_WORKERS = os.cpu_count() or 1
+    # Result sets are keyed by pcap digest, least recently used ones are
+    # evicted once the output directory grows past this size
+    RESULT_CACHE_MAX_BYTES = 50 * 1024 ** 3
+    # 'flows' segments protocols by looking up each packet's 5-tuple in the
+    # ndpi flow table, 'ports' uses the tcpdump filters in ndpi_protocol_map
+    SEGMENT_MODE = 'flows'
+    # Flow and time slices cut from captures for download are kept in an
+    # LRU disk cache of this size
+    SLICE_CACHE_DIR = os.path.join(OUTPUT_DIR, 'slices')
+    SLICE_CACHE_MAX_BYTES = 1024 ** 3
+    # Strings of at least STRINGS_MIN_LENGTH characters are extracted from the
+    # protocol pcaps, STRINGS_WORKERS pcaps at a time
+    STRINGS_MIN_LENGTH = 4
+    STRINGS_WORKERS = os.cpu_count() or 1
+    # Protocol processors parse tshark json as it is produced. 'none' keeps no
+    # copy of it, 'gzip' and 'plain' also write it next to the values
+    PROCESSOR_JSON_OUTPUT = 'none'
+    # Value charts draw at most CHART_MAX_POINTS samples per point, downsampled
+    # with 'minmax' envelopes or 'lttb', and CHART_PAGE_SIZE points per chart
+    # file (0 puts every point in one file, 1 gives a file per point)
+    CHART_MAX_POINTS = 2000
+    CHART_PAGE_SIZE = 20
+    CHART_DOWNSAMPLING = 'minmax'
+    # Interactive dissection from the dashboard goes to a pool of long-lived
+    # sharkd daemons. Sessions are kept per capture, idle ones are closed
+    # after SHARKD_IDLE_TIMEOUT seconds
+    SHARKD_WORKERS = 1
+    SHARKD_MAX_SESSIONS = 8
+    SHARKD_IDLE_TIMEOUT = 600
+    SHARKD_MAX_CONCURRENT = 4
+    # OTX enrichment runs OTX_CONCURRENCY requests at a time over pooled
+    # connections, at most OTX_RATE per second (0 for no limit), retrying
+    # throttled and failed ones OTX_RETRIES times. OTX_BASE_URL replaces the
+    # OTX host, e.g. with a local stub server. OTX_ENABLED = False skips OTX
+    OTX_ENABLED = True
+    OTX_CONCURRENCY = 16
+    OTX_RATE = 10.0
+    OTX_RETRIES = 5
+    OTX_BASE_URL = None
+    OTX_API_KEY = os.environ.get('OTX_API_KEY')
+    # Indicator responses are shared between captures in a SQLite cache.
+    # Entries expire after INDICATOR_CACHE_TTL seconds, failed lookups after
+    # INDICATOR_CACHE_NEGATIVE_TTL, and the least recently used ones are
+    # evicted past INDICATOR_CACHE_MAX_BYTES
+    INDICATOR_CACHE = os.path.join(OUTPUT_DIR, 'indicator_cache.sqlite')
+    INDICATOR_CACHE_TTL = 7 * 24 * 3600
+    INDICATOR_CACHE_NEGATIVE_TTL = 3600
+    INDICATOR_CACHE_MAX_BYTES = 1024 ** 3
+    # Offline enrichment: IP, CIDR and range feeds in BLOCKLIST_DIR are
+    # compiled into BLOCKLIST_INDEX, rebuilt when a feed changes, and matched
+    # against the flow addresses
+    BLOCKLIST_DIR = os.path.join(BASE_DIR, 'blocklists')
+    BLOCKLIST_INDEX = os.path.join(OUTPUT_DIR, 'blocklist_index.npz')
+    # Flows are enriched with country and ASN from local MaxMind DB files
+    # (e.g. GeoLite2), skipped when missing. Results are memoized per address
+    # in GEOIP_CACHE for all captures, up to GEOIP_CACHE_MAX_ENTRIES addresses,
+    # until a database is updated
+    GEOIP_COUNTRY_DB = os.path.join(BASE_DIR, 'geoip', 'GeoLite2-Country.mmdb')
+    GEOIP_ASN_DB = os.path.join(BASE_DIR, 'geoip', 'GeoLite2-ASN.mmdb')
+    GEOIP_CACHE = os.path.join(OUTPUT_DIR, 'geoip_cache.parquet')
+    GEOIP_CACHE_MAX_ENTRIES = 5_000_000
     LOG_DIR = os.path.join(BASE_DIR, 'logs')
     STATE_DIR = os.path.join(BASE_DIR, 'luigi_state')
     DASH_PORT = 5001
@@ -1,7 +1,12 @@
+import atexit
 import os
 import glob
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import luigi
+import shlex
+import subprocess
 from multiprocessing import Process
 from dtale.app import build_app
 from dtale.global_state import cleanup
@@ -22,6 +27,22 @@ from werkzeug.utils import secure_filename
 
 from tpahelper.config import config
 from tpahelper.analyze_pcap import AllTasks
+from tpahelper.utils.cache import (
+    COMPLETE_MARKER,
+    cached_file,
+    capture_name,
+    lookup_capture,
+    register_capture,
+    resolve_alias,
+    touch_results
+)
+from tpahelper.utils.flows import address_bytes_columns
+from tpahelper.utils.demux import protocol_numbers
+from tpahelper.utils.external_commands import tcpdump_filter
+from tpahelper.utils.packet_index import flow_id, slice_capture
+from tpahelper.utils.pcap import PcapError
+from tpahelper.utils.point_values import pivot_point_series
+from tpahelper.utils.sharkd import SharkdError, SharkdPool
 
 # Ensure the upload folder exists
 os.makedirs(config.UPLOAD_FOLDER, exist_ok=True)
@@ -31,22 +52,54 @@ def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in config.ALLOWED_EXTENSIONS
 
 
-def run_luigi_task_in_subprocess(filename):
+def run_luigi_task_in_subprocess(filename, digest):
     print(f"Running luigi task for {filename}")
     pcap_path = os.path.join(config.UPLOAD_FOLDER, filename)
 
-    # Run luigi process_pcap module / AllTasks
+    # Run luigi process_pcap module / AllTasks, the digest was resolved at submission
     luigi.configuration.get_config().set('core', 'no_lock', 'True')
-    task = AllTasks(pcap_file=pcap_path)
+    task = AllTasks(pcap_file=pcap_path, pcap_digest=digest)
     luigi.build([task], workers=config.WORKERS)
 
 
+def get_capture(filename):
+    # Results are keyed by the capture digest, the filename is only an alias.
+    # Returns the output path and the name used in the result filenames.
+    # Captures are hashed at upload or submission, never while serving a request.
+    # The alias only stands in for uploads that are gone: a file changed since
+    # it was registered has no results yet, not those of its old content.
+    pcap_path = os.path.join(config.UPLOAD_FOLDER, filename)
+    if os.path.exists(pcap_path):
+        digest = lookup_capture(pcap_path, config.OUTPUT_DIR)
+    else:
+        digest = resolve_alias(filename, config.OUTPUT_DIR)
+
+    if not digest:
+        return os.path.join(config.OUTPUT_DIR, filename.replace('.pcap', '')), filename
+
+    return os.path.join(config.OUTPUT_DIR, digest), capture_name(digest, config.OUTPUT_DIR) or filename
+
+
+def list_captures():
+    # Every capture in the upload folder. Listing never hashes one: captures
+    # missing from the result index (copied in by hand, uploaded before it
+    # existed or overwritten since) are marked unregistered, /analyze hashes them.
+    filenames = [f for f in sorted(os.listdir(config.UPLOAD_FOLDER))
+                 if any(f.strip().endswith(ext) for ext in config.ALLOWED_EXTENSIONS)]
+    pcaps = []
+    for id, f in enumerate(filenames, 1):
+        registered = lookup_capture(os.path.join(config.UPLOAD_FOLDER, f), config.OUTPUT_DIR) is not None
+        outdir, _ = get_capture(f)
+        pcaps.append({"id": id, "filename": f, "outdir": outdir, "registered": registered})
+    return pcaps
+
+
 def check_task_status(filename):
     # Checks for the presence of the following files:
     # queue.txt, done.txt, and failed.txt in the output directory
-    output_path = os.path.join(config.OUTPUT_DIR, filename.replace('.pcap', ''))
+    output_path, _ = get_capture(filename)
     queue_file = os.path.join(output_path, 'task_created.txt')
-    done_file = os.path.join(output_path, 'all_tasks_complete.txt')
+    done_file = os.path.join(output_path, COMPLETE_MARKER)
     failed_file = os.path.join(output_path, 'did_not_complete.txt')
 
     if os.path.exists(done_file):
@@ -60,8 +113,9 @@ def check_task_status(filename):
 
 
 def get_output_files(filename):
-    output_path = os.path.join(config.OUTPUT_DIR, filename.replace('.pcap', ''))
+    output_path, _ = get_capture(filename)
     flows = os.path.join(output_path, 'ndpi_flows.parquet')
+    flows_geoip = os.path.join(output_path, 'flows_geoip.parquet')
     ndpi_summary = os.path.join(output_path, 'ndpi_summary.txt')
     ip_rep = os.path.join(output_path, 'indicators/ip_reputation.parquet')
     proto_string_dir = os.path.join(output_path, 'protocols/strings')
@@ -70,6 +124,7 @@ def get_output_files(filename):
 
     results = {
         'flows': flows,
+        'flows_geoip': flows_geoip,
         'ndpi_summary': ndpi_summary,
         'ip_rep': ip_rep,
         'proto_string_dir': proto_string_dir,
@@ -80,6 +135,44 @@ def get_output_files(filename):
     return results
 
 
+def requested_flows(flows_parquet, args):
+    # A flow is requested by its ndpi flow_id (unique per capture), or by 5-tuple: src, dst, sport, dport
+    # and optionally proto. Returns the (proto, src, sport, dst, dport) tuples to extract.
+    if 'flow_id' in args:
+        flows_df = pd.read_parquet(flows_parquet, columns=['proto', 'src_name', 'src_port', 'dst_name', 'dst_port'],
+                                   filters=[('flow_id', '==', args.get('flow_id', type=int))])
+        # Flows without ports (e.g. ICMP) have NA in the nullable port columns
+        return [(proto, src, 0 if pd.isna(sport) else int(sport), dst, 0 if pd.isna(dport) else int(dport))
+                for proto, src, sport, dst, dport in flows_df.itertuples(index=False)]
+
+    protos = [args['proto']] if 'proto' in args else ['TCP', 'UDP']
+    return [(proto, args['src'], args.get('sport', 0, type=int), args['dst'], args.get('dport', 0, type=int))
+            for proto in protos]
+
+
+def flows_filter(flows):
+    # A tcpdump expression matching the packets of any of the flows, in either direction
+    terms = []
+    for proto, src, sport, dst, dport in flows:
+        number = int(proto) if str(proto).isdigit() else protocol_numbers[str(proto).lower()]
+        term = f"{'ip6' if ':' in str(src) else 'ip'} proto {number} and host {src} and host {dst}"
+        # Portless flows (e.g. ICMP) and tuples requested without a port match any port
+        for port in (sport, dport):
+            if port:
+                term += f" and port {port}"
+        terms.append(f"({term})")
+    return ' or '.join(terms)
+
+
+def extract_flows(pcap_path, output_pcap, flows, index_file):
+    # Seek-and-copy through the packet index, tcpdump for captures the reader can't handle
+    try:
+        slice_capture(pcap_path, output_pcap, flow_ids=[flow_id(*flow) for flow in flows], index_file=index_file)
+    except PcapError:
+        command = tcpdump_filter.format(pcap_path, output_pcap, shlex.quote(flows_filter(flows)))
+        subprocess.run(shlex.split(command), capture_output=True, text=True, check=True)
+
+
 def process_ndpi_summary(pcap_stats):
     sections = {}
 
@@ -128,6 +221,10 @@ def launch_dashboard():
     app = build_app(reaper_on=False, additional_templates=additional_templates)
     app.jinja_env.filters['isinstance_jinja'] = isinstance_jinja
 
+    # Warm sharkd sessions for packet drill-down, daemons start on first use
+    sharkd_pool = SharkdPool(workers=config.SHARKD_WORKERS, max_sessions=config.SHARKD_MAX_SESSIONS,
+                             idle_timeout=config.SHARKD_IDLE_TIMEOUT, max_concurrent=config.SHARKD_MAX_CONCURRENT)
+    atexit.register(sharkd_pool.close)
 
     @app.route('/static/<path:filename>')
     def custom_static(filename):
@@ -139,14 +236,7 @@ def launch_dashboard():
 
     @app.route("/pcaps", methods=["GET"])
     def pcaps():
-        pcaps = [
-            {"id": id, "filename": f}
-            for id, f in enumerate(os.listdir(config.UPLOAD_FOLDER), 1)
-            if any(f.strip().endswith(ext) for ext in config.ALLOWED_EXTENSIONS)
-        ]
-
-        for pcap in pcaps:
-            pcap['outdir'] = os.path.join(config.OUTPUT_DIR, pcap['filename'].replace('.pcap', ''))
+        pcaps = list_captures()
         print(f"PCAPS: {pcaps}")
 
         context = {
@@ -167,6 +257,8 @@ def launch_dashboard():
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
             file.save(os.path.join(config.UPLOAD_FOLDER, filename))
+            # Hash once at upload so the results are keyed by content
+            register_capture(os.path.join(config.UPLOAD_FOLDER, filename), config.OUTPUT_DIR)
             flash("File successfully uploaded")
             return redirect(url_for("pcaps"))
         else:
@@ -179,8 +271,89 @@ def launch_dashboard():
 
     @app.route("/download_proto_pcap/<filename>/<protocol>", methods=["GET"])
     def download_proto_pcap(filename, protocol):
-        return send_file(os.path.join(config.OUTPUT_DIR, filename.replace('.pcap', ''),
-                                      'protocols', 'pcaps', f"{filename}_{protocol}.pcap"), as_attachment=True)
+        output_path, pcap_name = get_capture(filename)
+        proto_pcap = os.path.join(output_path, 'protocols', 'pcaps', f"{pcap_name}_{protocol}.pcap")
+
+        # optional ?start=&end= (epoch seconds) cuts a time slice through the packet index
+        start = request.args.get('start', type=float)
+        end = request.args.get('end', type=float)
+        if start is None and end is None:
+            return send_file(proto_pcap, as_attachment=True, download_name=f"{filename}_{protocol}.pcap")
+
+        time_range = f"{'' if start is None else start}-{'' if end is None else end}"
+        slice_pcap = cached_file(
+            config.SLICE_CACHE_DIR, f"{os.path.basename(output_path)}_{protocol}_{time_range}.pcap",
+            lambda path: slice_capture(proto_pcap, path,
+                                       start_ns=None if start is None else int(start * 1e9),
+                                       end_ns=None if end is None else int(end * 1e9)),
+            config.SLICE_CACHE_MAX_BYTES)
+        return send_file(slice_pcap, as_attachment=True, download_name=f"{filename}_{protocol}_{time_range}.pcap")
+
+    @app.route("/download_flow_pcap/<filename>", methods=["GET"])
+    def download_flow_pcap(filename):
+        # /download_flow_pcap/<filename>?flow_id=<ndpi flow id>
+        # /download_flow_pcap/<filename>?src=<ip>&dst=<ip>&sport=<port>&dport=<port>[&proto=TCP]
+        output_path, _ = get_capture(filename)
+        pcap_path = os.path.join(config.UPLOAD_FOLDER, filename)
+        if not os.path.exists(pcap_path):
+            return jsonify({'error': f"Unknown capture {escape(filename)}"}), 404
+
+        try:
+            flows = requested_flows(get_output_files(filename)['flows'], request.args)
+        except KeyError as e:
+            return jsonify({'error': f"Missing flow parameter {escape(str(e))}"}), 400
+        except (OSError, ValueError, pa.ArrowException) as e:
+            return jsonify({'error': escape(str(e))}), 400
+        if not flows:
+            return jsonify({'error': "No matching flow"}), 404
+
+        try:
+            flow_ids = sorted({flow_id(*flow) for flow in flows})
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': f"Invalid flow: {escape(str(e))}"}), 400
+
+        flow_name = '-'.join(f"{i & 0xffffffffffffffff:016x}" for i in flow_ids)
+        try:
+            flow_pcap = cached_file(
+                config.SLICE_CACHE_DIR, f"{os.path.basename(output_path)}_flow_{flow_name}.pcap",
+                lambda path: extract_flows(pcap_path, path, flows, os.path.join(output_path, 'packet_index.parquet')),
+                config.SLICE_CACHE_MAX_BYTES)
+        except (OSError, subprocess.CalledProcessError) as e:
+            # Neither the packet index nor tcpdump could slice the capture
+            return jsonify({'error': escape(str(e))}), 503
+        _, src, sport, dst, dport = flows[0]
+        return send_file(flow_pcap, as_attachment=True,
+                         download_name=f"{filename}_{src}_{sport}_{dst}_{dport}.pcap")
+
+    @app.route("/dissect/<filename>/frames", methods=["GET"])
+    def dissect_frames(filename):
+        # /dissect/<filename>/frames?filter=<display filter>&skip=<n>&limit=<n>
+        pcap_path = os.path.join(config.UPLOAD_FOLDER, filename)
+        if not os.path.exists(pcap_path):
+            return jsonify({'error': f"Unknown capture {escape(filename)}"}), 404
+
+        display_filter = request.args.get('filter')
+        try:
+            if display_filter and not sharkd_pool.check_filter(pcap_path, display_filter):
+                return jsonify({'error': f"Invalid filter {escape(display_filter)}"}), 400
+            frames = sharkd_pool.frames(pcap_path, display_filter, skip=request.args.get('skip', 0, type=int),
+                                        limit=min(request.args.get('limit', 100, type=int), 10000))
+        except (OSError, SharkdError) as e:
+            return jsonify({'error': escape(str(e))}), 503
+        return jsonify(frames)
+
+    @app.route("/dissect/<filename>/frame/<int:number>", methods=["GET"])
+    def dissect_frame(filename, number):
+        # /dissect/<filename>/frame/<number>[?bytes=1]
+        pcap_path = os.path.join(config.UPLOAD_FOLDER, filename)
+        if not os.path.exists(pcap_path):
+            return jsonify({'error': f"Unknown capture {escape(filename)}"}), 404
+
+        try:
+            frame = sharkd_pool.frame(pcap_path, number, data=request.args.get('bytes', 0, type=int) == 1)
+        except (OSError, SharkdError) as e:
+            return jsonify({'error': escape(str(e))}), 503
+        return jsonify(frame)
 
     @app.route("/luigi", methods=["GET"])
     def luigi():
@@ -189,14 +362,25 @@ def launch_dashboard():
 
     @app.route("/analyze/<filename>", methods=["GET"])
     def analyze_file(filename):
+        # Submission hashes captures that weren't registered at upload
+        pcap_path = os.path.join(config.UPLOAD_FOLDER, filename)
+        if not os.path.exists(pcap_path):
+            return jsonify({'error': f"Unknown capture {escape(filename)}"}), 404
+        digest = lookup_capture(pcap_path, config.OUTPUT_DIR) or register_capture(pcap_path, config.OUTPUT_DIR)
         # create output directory
-        output_path = os.path.join(config.OUTPUT_DIR, filename.replace('.pcap', ''))
+        output_path, _ = get_capture(filename)
         os.makedirs(output_path, exist_ok=True)
+
+        # Identical captures reuse the completed results
+        if os.path.exists(os.path.join(output_path, COMPLETE_MARKER)):
+            touch_results(os.path.basename(output_path), config.OUTPUT_DIR)
+            return jsonify({"message": f"Cached results reused for {escape(filename)}"})
+
         # create "task_created.txt" file to indicate that the task has been created
         with open(os.path.join(output_path, 'task_created.txt'), 'w') as f:
             f.write("Task created")
 
-        process = Process(target=run_luigi_task_in_subprocess, args=(filename,))
+        process = Process(target=run_luigi_task_in_subprocess, args=(filename, digest))
         process.start()
 
         message = {"message": f"Analysis queued for {escape(filename)}"}
@@ -226,8 +410,11 @@ def launch_dashboard():
 
     @app.route('/flows/<filename>')
     def flows(filename):
-        flows_parquet = get_output_files(filename).get('flows', None)
-        df = pd.read_parquet(flows_parquet)
+        output_files = get_output_files(filename)
+        df = pd.read_parquet(output_files['flows']).drop(columns=address_bytes_columns, errors='ignore')
+        if os.path.exists(output_files['flows_geoip']):
+            # Country and ASN columns, one row per flow
+            df = pd.concat([df, pd.read_parquet(output_files['flows_geoip'])], axis=1)
 
         cleanup("1")
         instance = startup(data_id="1", data=df)
@@ -259,8 +446,9 @@ def launch_dashboard():
                         if 'complete' not in f)
 
         protocol_data = []
+        _, pcap_name = get_capture(filename)
         for protocol in protocols:
-            pcap_file = os.path.join(pcap_file_path, f"{filename}_{protocol}.pcap")
+            pcap_file = os.path.join(pcap_file_path, f"{pcap_name}_{protocol}.pcap")
             if not os.path.exists(pcap_file):
                 pcap_file = None
 
@@ -285,7 +473,17 @@ def launch_dashboard():
 
     @app.route('/strings/<filename>/<protocol>')
     def strings(filename, protocol):
-        strings = os.path.join(get_output_files(filename).get('proto_string_dir', None), f"{protocol}_strings.txt")
+        strings_dir = get_output_files(filename).get('proto_string_dir', None)
+
+        # near-duplicates are collapsed into ranked templates when available
+        templates = os.path.join(strings_dir, f"{protocol}_templates.parquet")
+        if os.path.exists(templates):
+            df = pd.read_parquet(templates, columns=['rank', 'count', 'template', 'templates', 'example',
+                                                     'first_packet'])
+            return render_template("strings.html", templates=df.to_dict('records'), filename=filename,
+                                   protocol=protocol)
+
+        strings = os.path.join(strings_dir, f"{protocol}_strings.txt")
         with open(strings, "r") as infile:
             data = infile.readlines()
 
@@ -294,7 +492,19 @@ def launch_dashboard():
     @app.route('/values/<filename>/<protocol>')
     def values(filename, protocol):
         values = os.path.join(get_output_files(filename).get('proto_values', None), f"{protocol}_values.parquet")
-        df = pd.read_parquet(values)
+
+        # Values are stored sparse, the wide view is pivoted for the requested
+        # ?points=<id,id,...>&start=&end= (epoch seconds), all points by default
+        points = request.args.get('points')
+        start = request.args.get('start', type=float)
+        end = request.args.get('end', type=float)
+        if 'point' in pq.read_schema(values).names:
+            df = pivot_point_series(values, points.split(',') if points else None,
+                                    None if start is None else pd.Timestamp(start, unit='s', tz='UTC'),
+                                    None if end is None else pd.Timestamp(end, unit='s', tz='UTC'))
+            df = df.rename_axis('frame.time').reset_index()
+        else:
+            df = pd.read_parquet(values)
 
         cleanup("1")
         instance = startup(data_id="1", data=df)
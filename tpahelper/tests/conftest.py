@@ -0,0 +1,87 @@
+import asyncio
+import sys
+import threading
+
+import pytest
+from aiohttp import web
+
+
+@pytest.fixture
+def otx_server():
+    """
+    Local stand-in for the OTX API. Yields its base URL and a state dict:
+    indicators in state['failing'] are answered with 503, every request is
+    counted in state['requests'].
+    """
+    state = {'failing': set(), 'requests': 0}
+
+    async def general(request):
+        state['requests'] += 1
+        indicator = request.match_info['indicator']
+        if indicator in state['failing']:
+            return web.Response(status=503, headers={'Retry-After': '0'})
+        return web.json_response({'indicator': indicator, 'type': request.match_info['type'], 'reputation': 0,
+                                  'pulse_info': {'count': 1, 'pulses': [{'id': 'p1', 'name': 'pulse'}]}})
+
+    app = web.Application()
+    app.router.add_get('/api/v1/indicators/{type}/{indicator}/general', general)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app, access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{port}", state
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+FAKE_SHARKD = '''
+import json, os, socket, sys, threading, time
+
+path = sys.argv[1][len('unix:'):]
+# Daemons of the workers named in SHARKD_SLOW_START take a while to come up
+if os.path.basename(path) in os.environ.get('SHARKD_SLOW_START', '').split(','):
+    time.sleep(1.0)
+
+
+def serve(conn):
+    with conn, conn.makefile('rb') as reader:
+        for line in reader:
+            request = json.loads(line)
+            params = request.get('params', {})
+            if request['method'] == 'bye':
+                return
+            if request['method'] == 'load' and not os.path.exists(params['file']):
+                response = {'error': {'code': -2001, 'message': 'Unable to open the file'}}
+            else:
+                if params.get('filter') == 'slow':
+                    time.sleep(0.5)
+                response = {'result': {'method': request['method'], 'params': params, 'pid': os.getpid()}}
+            conn.sendall(json.dumps({'jsonrpc': '2.0', 'id': request['id'], **response}).encode() + b'\\n')
+
+
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(path)
+server.listen()
+while True:
+    threading.Thread(target=serve, args=(server.accept()[0],), daemon=True).start()
+'''
+
+
+@pytest.fixture
+def fake_sharkd(tmp_path):
+    """
+    Path of a stand-in sharkd answering every JSON-RPC request with its method
+    and params. A 'frames' request with filter='slow' takes half a second.
+    """
+    path = tmp_path / 'sharkd'
+    path.write_text(f"#!{sys.executable}\n{FAKE_SHARKD}")
+    path.chmod(0o755)
+    return str(path)
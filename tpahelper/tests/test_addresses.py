@@ -0,0 +1,84 @@
+import ipaddress
+import random
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from tpahelper.utils.addresses import format_addresses, is_public, public_addresses
+from tpahelper.utils.flows import pack_address
+
+# IANA special-purpose address registries: network and whether it is globally
+# reachable; the most specific match decides. Multicast is not in the
+# registries and is not public here.
+IANA_REGISTRY = [
+    ('0.0.0.0/8', False), ('10.0.0.0/8', False), ('100.64.0.0/10', False), ('127.0.0.0/8', False),
+    ('169.254.0.0/16', False), ('172.16.0.0/12', False), ('192.0.0.0/24', False), ('192.0.0.9/32', True),
+    ('192.0.0.10/32', True), ('192.0.2.0/24', False), ('192.31.196.0/24', True), ('192.52.193.0/24', True),
+    ('192.168.0.0/16', False), ('192.175.48.0/24', True), ('198.18.0.0/15', False), ('198.51.100.0/24', False),
+    ('203.0.113.0/24', False), ('224.0.0.0/4', False), ('240.0.0.0/4', False),
+    ('::/0', False), ('2000::/3', True), ('64:ff9b::/96', True), ('64:ff9b:1::/48', False),
+    ('2001::/23', False), ('2001:1::1/128', True), ('2001:1::2/128', True), ('2001:1::3/128', True),
+    ('2001:2::/48', False), ('2001:3::/32', True), ('2001:4:112::/48', True), ('2001:20::/28', True),
+    ('2001:30::/28', True), ('2001:db8::/32', False), ('2620:4f:8000::/48', True), ('3fff::/20', False),
+]
+
+EDGE_CASES = [
+    '192.0.0.8', '192.0.0.9', '192.0.0.10', '192.0.0.11', '192.0.0.170', '192.31.196.1', '100.63.255.255',
+    '100.64.0.0', '100.127.255.255', '100.128.0.0', '172.15.255.255', '172.32.0.0', '8.8.8.8', '255.255.255.255',
+    '2002::1', '2002:c000:204::1', '2001:1::1', '2001:1::2', '2001:1::3', '2001:1::4', '2001:2::1', '2001:3::1',
+    '2001:4:112::1', '2001:4:113::1', '2001:20::1', '2001:2f:ffff::1', '2001:30::1', '2001:40::1', '2001::1',
+    '2001:200::1', '2001:db8::1', '2001:4860::8888', '64:ff9b::808:808', '64:ff9b:1::1', '::1', '::',
+    '::ffff:0:1', '3fff::1', '4000::1', 'fc00::1', 'fe80::1', 'ff02::1',
+]
+
+
+def iana_public(address: str) -> bool:
+    ip = ipaddress.ip_address(address)
+    matches = [(network.prefixlen, reachable) for network, reachable in
+               ((ipaddress.ip_network(n), r) for n, r in IANA_REGISTRY) if ip.version == network.version
+               and ip in network]
+    return max(matches)[1] if matches else True
+
+
+def packed(addresses: list) -> pa.Array:
+    return pa.array([pack_address(address) for address in addresses], type=pa.binary(16))
+
+
+def test_is_public_matches_the_iana_registry():
+    assert is_public(packed(EDGE_CASES)).tolist() == [iana_public(address) for address in EDGE_CASES]
+
+
+@pytest.mark.skipif(ipaddress.ip_address('192.0.0.8').is_global or not ipaddress.ip_address('2001:3::1').is_global,
+                    reason="ipaddress predates the IANA globally reachable exceptions")
+def test_is_public_matches_ipaddress():
+    # Left out where ipaddress differs: multicast and unallocated IPv6 space are
+    # global there, 6to4 is not, and 2001:1::3 was registered after it
+    global_unicast = ipaddress.ip_network('2000::/3')
+    cases = [address for address in EDGE_CASES
+             if not ipaddress.ip_address(address).is_multicast and address not in ('2001:1::3', '::ffff:0:1')
+             and not address.startswith('2002:')
+             and (ipaddress.ip_address(address).version == 4 or ipaddress.ip_address(address) in global_unicast)]
+    assert is_public(packed(cases)).tolist() == [ipaddress.ip_address(address).is_global for address in cases]
+
+
+def test_format_addresses_matches_ipaddress():
+    rng = random.Random(0)
+    # IPv4-mapped addresses are how IPv4 is packed, they print as IPv4
+    addresses = [a for a in EDGE_CASES if not a.startswith('::ffff:')]
+    addresses += ['1:0:0:1:0:0:0:1', '1:0:0:0:1:0:0:1', '0:0:1::', '1::', 'a:b:c:d:e:f:0:0']
+    addresses += [str(ipaddress.IPv4Address(rng.getrandbits(32))) for _ in range(200)]
+    # Random hextets, many of them zero so that runs of zeros of every length occur
+    addresses += [str(ipaddress.IPv6Address(':'.join(format(rng.choice([0, 0, 1, rng.getrandbits(16)]), 'x')
+                                                     for _ in range(8)))) for _ in range(500)]
+    assert format_addresses(packed(addresses)).to_pylist() == [str(ipaddress.ip_address(a)) for a in addresses]
+
+
+def test_public_addresses(tmp_path):
+    flows_parquet = str(tmp_path / 'flows.parquet')
+    pq.write_table(pa.table({'src_name': ['10.0.0.1', '2002::1', '8.8.8.8', None],
+                             'dst_name': ['8.8.8.8', '192.168.1.5', '192.0.0.9', '2001:db8::1']}), flows_parquet)
+    result = public_addresses(flows_parquet, str(tmp_path / 'public.parquet'))
+    assert result['ip'].to_pylist() == ['8.8.8.8', '192.0.0.9', '2002::1']
+    assert result['version'].to_pylist() == [4, 4, 6]
+    assert pq.read_table(tmp_path / 'public.parquet').equals(result)
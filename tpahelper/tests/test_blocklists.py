@@ -0,0 +1,97 @@
+import ipaddress
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from tpahelper.utils.blocklists import BlocklistIndex, load_blocklists, match_blocklists, parse_entry, read_feed
+from tpahelper.utils.flows import pack_address
+
+
+def packed(addresses: list) -> pa.Array:
+    return pa.array([pack_address(address) for address in addresses], type=pa.binary(16))
+
+
+def listed_by(index: BlocklistIndex, addresses: list) -> list:
+    positions, feed_numbers = index.matches(packed(addresses))
+    listed = [set() for _ in addresses]
+    for position, feed_number in zip(positions, feed_numbers):
+        listed[position].add(index.feeds[feed_number])
+    return listed
+
+
+def test_parse_entry():
+    mapped = 0xffff << 32
+    assert parse_entry('10.0.0.1') == [(mapped | 0x0a000001, mapped | 0x0a000001)]
+    assert parse_entry('10.0.0.7/30') == [(mapped | 0x0a000004, mapped | 0x0a000007)]
+    assert parse_entry('10.0.0.9 - 10.0.0.5') == []
+    assert parse_entry('10.0.0.1-2001:db8::1') == []
+    assert parse_entry('not an address') == []
+    network = ipaddress.ip_network('2001:db8::/32')
+    assert parse_entry('2001:db8::/32') == [(int(network.network_address), int(network.broadcast_address))]
+    # IPv6 ranges never cover the IPv4-mapped block
+    assert parse_entry('::/0') == [(0, mapped - 1), ((mapped | 0xffff_ffff) + 1, (1 << 128) - 1)]
+
+
+def test_read_feed(tmp_path):
+    feed_file = tmp_path / 'feed.txt'
+    feed_file.write_text('# Spamhaus DROP\n; header\n\n1.2.3.0/24 ; SBL123\n"5.6.7.8",malware,2024\n'
+                         '9.9.9.1-9.9.9.3\tcomment\n// note\nbogus line\n2001:db8::1\n')
+    assert len(read_feed(feed_file)) == 4
+
+
+def test_index_lookup():
+    index = BlocklistIndex.build({
+        'a': parse_entry('10.0.0.0/8') + parse_entry('2001:db8::/32'),
+        'b': parse_entry('10.1.0.0/16'),
+        'c': parse_entry('::/0'),
+        'empty': [],
+    })
+    assert index.feeds == ['a', 'b', 'c']
+    assert listed_by(index, ['10.1.2.3', '10.2.0.1', '11.0.0.1', '2001:db8::5', '2001:db9::1']) == [
+        {'a', 'b'}, {'a'}, set(), {'a', 'c'}, {'c'}]
+
+
+def test_index_of_many_feeds():
+    # More feeds than bits in one mask word
+    index = BlocklistIndex.build({f'feed{i:03d}': parse_entry(f'10.0.{i}.0/24') + parse_entry('10.0.0.0/8')
+                                  for i in range(100)})
+    assert index.masks.shape[1] == 2
+    assert listed_by(index, ['10.0.70.1', '10.0.200.1', '192.168.0.1']) == [
+        {'feed070'} | set(index.feeds), set(index.feeds), set()]
+    assert len(BlocklistIndex.build({}).lookup(packed(['10.0.0.1']))) == 1
+
+
+def test_load_blocklists_rebuilds_when_a_feed_changes(tmp_path, monkeypatch):
+    blocklist_dir = tmp_path / 'blocklists'
+    (blocklist_dir / 'firehol').mkdir(parents=True)
+    (blocklist_dir / 'firehol' / 'level1.netset').write_text('10.0.0.0/8\n')
+    (blocklist_dir / '.hidden').write_text('8.8.8.8\n')
+    index_file = str(tmp_path / 'index' / 'blocklists.npz')
+    builds = []
+    build = BlocklistIndex.build.__func__
+    monkeypatch.setattr(BlocklistIndex, 'build', classmethod(lambda cls, *args: builds.append(args) or
+                                                             build(cls, *args)))
+
+    index = load_blocklists(str(blocklist_dir), index_file)
+    assert index.feeds == [os.path.join('firehol', 'level1.netset')]
+    assert load_blocklists(str(blocklist_dir), index_file).feeds == index.feeds
+    assert len(builds) == 1
+
+    (blocklist_dir / 'drop.txt').write_text('8.8.8.0/24 ; SBL1\n')
+    index = load_blocklists(str(blocklist_dir), index_file)
+    assert len(builds) == 2
+    assert listed_by(index, ['8.8.8.8']) == [{'drop.txt'}]
+
+
+def test_match_blocklists(tmp_path):
+    flows_parquet = str(tmp_path / 'flows.parquet')
+    pq.write_table(pa.table({'src_name': ['10.0.0.1', '2001:db8::1', '8.8.8.8'],
+                             'dst_name': ['8.8.8.8', '10.0.0.1', '192.168.1.1']}), flows_parquet)
+    index = BlocklistIndex.build({'dns': parse_entry('8.8.8.8'), 'private': parse_entry('10.0.0.0/8'),
+                                  'docs': parse_entry('2001:db8::/32') + parse_entry('8.8.8.0/24')})
+    result = match_blocklists(flows_parquet, index, str(tmp_path / 'blocklists.parquet'))
+    assert list(zip(result['ip'].to_pylist(), result['version'].to_pylist(),
+                    result['feed'].cast(pa.string()).to_pylist())) == [
+        ('8.8.8.8', 4, 'dns'), ('8.8.8.8', 4, 'docs'), ('10.0.0.1', 4, 'private'), ('2001:db8::1', 6, 'docs')]
+    assert pq.read_table(tmp_path / 'blocklists.parquet').equals(result)
@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+from tpahelper.utils import cache
+from tpahelper.utils.cache import (
+    INDEX_FILE,
+    cached_file,
+    capture_name,
+    evict_results,
+    lookup_capture,
+    register_capture,
+    resolve_alias,
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_memo():
+    cache._digest_memo.clear()
+    yield
+    cache._digest_memo.clear()
+
+
+def write_capture(path, content: bytes):
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_same_content_shares_a_digest(tmp_path):
+    first = write_capture(tmp_path / 'first.pcap', b'capture')
+    second = write_capture(tmp_path / 'second.pcap', b'capture')
+    other = write_capture(tmp_path / 'other.pcap', b'other capture')
+    output_dir = tmp_path / 'processed'
+
+    digest = register_capture(first, output_dir)
+    assert register_capture(second, output_dir) == digest
+    assert register_capture(other, output_dir) != digest
+    assert resolve_alias('second.pcap', output_dir) == digest
+    assert capture_name(digest, output_dir) == 'first.pcap'
+
+
+def test_lookups_never_hash_or_write(tmp_path, monkeypatch):
+    pcap = write_capture(tmp_path / 'capture.pcap', b'capture')
+    output_dir = tmp_path / 'processed'
+    assert lookup_capture(pcap, output_dir) is None
+
+    digest = register_capture(pcap, output_dir)
+    cache._digest_memo.clear()
+    index_stat = os.stat(output_dir / INDEX_FILE)
+    monkeypatch.setattr(cache, 'hash_pcap', lambda path: pytest.fail("hashed on lookup"))
+    assert lookup_capture(pcap, output_dir) == digest
+    assert resolve_alias('capture.pcap', output_dir) == digest
+    assert capture_name(digest, output_dir) == 'capture.pcap'
+    assert os.stat(output_dir / INDEX_FILE).st_mtime_ns == index_stat.st_mtime_ns
+
+
+def test_tasks_are_built_without_hashing(tmp_path, monkeypatch):
+    pytest.importorskip('maxminddb')
+    import luigi
+    from tpahelper import analyze_pcap
+
+    hashed = []
+    monkeypatch.setattr(cache, 'hash_pcap', lambda path: hashed.append(path) or 'digest')
+    built = []
+    monkeypatch.setattr(analyze_pcap.luigi, 'build', lambda tasks, workers: built.extend(tasks))
+    pcap = write_capture(tmp_path / 'capture.pcap', b'capture')
+    analyze_pcap.analyze_capture(pcap, str(tmp_path / 'processed'))
+    assert hashed == [pcap]
+
+    # The whole dependency graph shares the digest given at submission, even for a missing capture
+    tasks = [analyze_pcap.AllTasks(pcap_file=str(tmp_path / 'missing.pcap'), output_dir=str(tmp_path / 'processed'),
+                                   pcap_digest='digest')] + built
+    while tasks:
+        task = tasks.pop()
+        assert task.pcap_digest == 'digest' and task.output_dir == str(tmp_path / 'processed')
+        tasks += luigi.task.flatten(task.requires())
+    assert hashed == [pcap]
+
+
+def test_changed_capture_is_not_found(tmp_path):
+    pcap = write_capture(tmp_path / 'capture.pcap', b'capture')
+    output_dir = tmp_path / 'processed'
+    digest = register_capture(pcap, output_dir)
+    write_capture(tmp_path / 'capture.pcap', b'a longer capture')
+    assert lookup_capture(pcap, output_dir) is None
+    assert register_capture(pcap, output_dir) != digest
+
+
+def test_evict_results_keeps_recent_and_running(tmp_path):
+    output_dir = tmp_path / 'processed'
+    digests = []
+    for name in ('old', 'running', 'recent'):
+        digest = register_capture(write_capture(tmp_path / f'{name}.pcap', name.encode()), output_dir)
+        (output_dir / digest).mkdir()
+        (output_dir / digest / 'flows.parquet').write_bytes(b'x' * 1000)
+        digests.append(digest)
+    (output_dir / digests[1] / cache.QUEUED_MARKER).write_text('')
+
+    assert evict_results(output_dir, 2500) == [digests[0]]
+    assert not (output_dir / digests[0]).exists()
+    assert resolve_alias('old.pcap', output_dir) is None
+    assert evict_results(output_dir, 0, keep=(digests[2],)) == []
+
+
+def test_cached_file_builds_once_and_evicts_lru(tmp_path):
+    builds = []
+
+    def build(path):
+        builds.append(path)
+        with open(path, 'wb') as outfile:
+            outfile.write(b'x' * 100)
+
+    first = cached_file(tmp_path, 'first.pcap', build, max_bytes=250)
+    assert cached_file(tmp_path, 'first.pcap', build, max_bytes=250) == first
+    cached_file(tmp_path, 'second.pcap', build, max_bytes=250)
+    os.utime(first, (1, 1))
+    cached_file(tmp_path, 'third.pcap', build, max_bytes=250)
+    assert len(builds) == 3
+    assert not os.path.exists(first)
+    assert sorted(os.listdir(tmp_path)) == ['.index.lock', 'second.pcap', 'third.pcap']
@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tpahelper.utils.charts import downsample, lttb_indices, minmax_indices, write_point_charts
+from tpahelper.utils.point_values import PointValueWriter, write_point_series
+
+
+def test_minmax_keeps_the_envelope_of_long_series():
+    rng = np.random.default_rng(0)
+    values = np.r_[rng.normal(size=1000), rng.normal(size=10)]
+    values[500] = 100
+    values[700] = -100
+    codes = np.r_[np.zeros(1000, dtype=np.int64), np.ones(10, dtype=np.int64)]
+    indices = minmax_indices(codes, values, max_points=100)
+    long_series = indices[indices < 1000]
+    assert len(long_series) <= 102
+    assert {0, 500, 700, 999} <= set(long_series)
+    # Series within max_points are kept whole
+    assert list(indices[indices >= 1000]) == list(range(1000, 1010))
+    assert len(minmax_indices(np.arange(0), np.arange(0))) == 0
+
+
+def test_lttb_keeps_the_ends_and_spikes():
+    x = np.arange(1000)
+    y = np.sin(x / 50)
+    y[321] = 10
+    indices = lttb_indices(x, y, max_points=50)
+    assert len(indices) == 50 and indices[0] == 0 and indices[-1] == 999
+    assert np.all(np.diff(indices) > 0)
+    assert 321 in indices
+    assert list(lttb_indices(x[:10], y[:10], max_points=50)) == list(range(10))
+
+
+@pytest.mark.parametrize('method', ['minmax', 'lttb'])
+def test_downsample_per_point(method):
+    df = pd.DataFrame({'point': ['1'] * 500 + ['2'] * 5,
+                       'time': pd.to_datetime(np.r_[np.arange(500), np.arange(5)], unit='s', utc=True),
+                       'value': np.r_[np.arange(500.0), np.arange(5.0)]})
+    result = downsample(df, max_points=20, method=method)
+    assert (result['point'] == '1').sum() <= 22
+    assert (result['point'] == '2').sum() == 5
+    assert result.groupby('point')['value'].agg(['min', 'max']).values.tolist() == [[0, 499], [0, 4]]
+
+
+@pytest.fixture
+def series_parquet(tmp_path):
+    values_parquet = str(tmp_path / 'points.parquet')
+    with PointValueWriter(values_parquet, ['dnp3.al.ana.int']) as writer:
+        for second in range(3000):
+            for index in range(5):
+                writer.add(second * 1_000_000_000, 0, index, float(second % 97))
+    series_parquet = str(tmp_path / 'values.parquet')
+    write_point_series(values_parquet, series_parquet)
+    return series_parquet
+
+
+def test_write_point_charts(series_parquet, tmp_path):
+    output_html = str(tmp_path / 'charts.html')
+    assert write_point_charts(series_parquet, output_html, 'DNP3', max_points=100) == [output_html]
+    # The 15000 readings are not all written out
+    assert os.path.getsize(output_html) < 5_000_000
+    assert 'scattergl' in open(output_html).read()
+
+
+def test_write_point_chart_pages(series_parquet, tmp_path):
+    output_html = str(tmp_path / 'charts.html')
+    stale_page = tmp_path / 'charts_0009.html'
+    stale_page.write_text('')
+    files = write_point_charts(series_parquet, output_html, 'DNP3', max_points=100, page_size=2)
+    pages = [str(tmp_path / f'charts_{page:04d}.html') for page in (1, 2, 3)]
+    assert files == [output_html] + pages + [str(tmp_path / 'plotly.min.js')]
+    assert all(os.path.exists(path) for path in files)
+    assert not stale_page.exists()
+    index = open(output_html).read()
+    assert '<a href="charts_0001.html">0, 1</a>' in index and '<a href="charts_0003.html">4</a>' in index
+    # The pages share plotly.js instead of embedding it
+    assert os.path.getsize(pages[0]) < os.path.getsize(files[-1])
@@ -0,0 +1,83 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from tpahelper.utils.packet_index import flow_id
+
+app = pytest.importorskip('tpahelper.dashboard.app')
+
+
+@pytest.fixture
+def flows_parquet(tmp_path):
+    path = tmp_path / 'ndpi_flows.parquet'
+    pq.write_table(pa.table({
+        'flow_id': pa.array([0, 1], type=pa.int64()),
+        'proto': ['TCP', 'ICMP'],
+        'src_name': ['10.0.0.1', '10.0.0.3'],
+        'src_port': pa.array([51000, None], type=pa.uint16()),
+        'dst_name': ['10.0.0.2', '10.0.0.4'],
+        'dst_port': pa.array([502, None], type=pa.uint16()),
+    }), path)
+    return path
+
+
+def test_requested_flow_by_id(flows_parquet):
+    flows = app.requested_flows(flows_parquet, MultiDict({'flow_id': '0'}))
+    assert flows == [('TCP', '10.0.0.1', 51000, '10.0.0.2', 502)]
+    assert flow_id(*flows[0]) == flow_id('TCP', '10.0.0.2', 502, '10.0.0.1', 51000)
+
+
+def test_requested_flow_without_ports(flows_parquet):
+    flows = app.requested_flows(flows_parquet, MultiDict({'flow_id': '1'}))
+    assert flows == [('ICMP', '10.0.0.3', 0, '10.0.0.4', 0)]
+    assert isinstance(flow_id(*flows[0]), int)
+
+
+def test_requested_flow_by_tuple(flows_parquet):
+    flows = app.requested_flows(flows_parquet, MultiDict({'src': '10.0.0.1', 'dst': '10.0.0.2', 'dport': '502'}))
+    assert flows == [(proto, '10.0.0.1', 0, '10.0.0.2', 502) for proto in ('TCP', 'UDP')]
+    with pytest.raises(KeyError):
+        app.requested_flows(flows_parquet, MultiDict({'src': '10.0.0.1'}))
+
+
+def test_list_captures_keeps_unregistered_files(tmp_path, monkeypatch):
+    upload_folder, output_dir = tmp_path / 'uploads', tmp_path / 'processed'
+    upload_folder.mkdir()
+    monkeypatch.setattr(app.config, 'UPLOAD_FOLDER', str(upload_folder))
+    monkeypatch.setattr(app.config, 'OUTPUT_DIR', str(output_dir))
+    for name in ('a.pcap', 'b.pcap', 'c.pcap', 'notes.txt'):
+        (upload_folder / name).write_bytes(name.encode())
+    digest = app.register_capture(str(upload_folder / 'a.pcap'), str(output_dir))
+    app.register_capture(str(upload_folder / 'c.pcap'), str(output_dir))
+    # Overwritten under the same name after it was registered
+    (upload_folder / 'c.pcap').write_bytes(b'new content')
+
+    pcaps = app.list_captures()
+    assert [(p['filename'], p['registered']) for p in pcaps] == [('a.pcap', True), ('b.pcap', False),
+                                                                  ('c.pcap', False)]
+    assert pcaps[0]['outdir'] == str(output_dir / digest)
+    assert pcaps[1]['outdir'] == str(output_dir / 'b')
+    assert app.check_task_status('c.pcap') == 'new'
+
+
+def test_tcpdump_fallback_extracts_every_flow(tmp_path, monkeypatch):
+    flows = [('TCP', '10.0.0.1', 51000, '10.0.0.2', 502), ('UDP', '10.0.0.1', 51000, '10.0.0.2', 502),
+             ('ICMP', '10.0.0.3', 0, '10.0.0.4', 0), ('UDP', 'fe80::1', 0, 'fe80::2', 53)]
+    assert app.flows_filter(flows) == (
+        "(ip proto 6 and host 10.0.0.1 and host 10.0.0.2 and port 51000 and port 502) or "
+        "(ip proto 17 and host 10.0.0.1 and host 10.0.0.2 and port 51000 and port 502) or "
+        "(ip proto 1 and host 10.0.0.3 and host 10.0.0.4) or "
+        "(ip6 proto 17 and host fe80::1 and host fe80::2 and port 53)")
+
+    def unreadable(*args, **kwargs):
+        raise app.PcapError("unsupported capture")
+
+    commands = []
+    monkeypatch.setattr(app, 'slice_capture', unreadable)
+    monkeypatch.setattr(app.subprocess, 'run', lambda command, **kwargs: commands.append(command))
+    app.extract_flows(str(tmp_path / 'my capture.pcap'), str(tmp_path / 'flow.pcap'), flows[:2], 'index.parquet')
+    # The paths and the filter are single arguments
+    assert commands == [['tcpdump', '-r', str(tmp_path / 'my capture.pcap'), '-nn', '-w', str(tmp_path / 'flow.pcap'),
+                         app.flows_filter(flows[:2])]]
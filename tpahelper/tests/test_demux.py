@@ -0,0 +1,168 @@
+import os
+import struct
+
+import pandas as pd
+import pytest
+
+from tpahelper.utils.demux import FilterError, FlowIndex, compile_filter, demultiplex, demultiplex_flows
+from tpahelper.utils.flows import pack_address
+from tpahelper.utils.pcap import PcapReader, PcapWriter, decode_packet
+
+TCP, UDP = 6, 17
+
+
+def packet(proto=TCP, sport=40000, dport=502, flags=0x18, src=(10, 0, 0, 1), dst=(10, 0, 0, 2)):
+    """Ethernet frame of an IPv4 TCP or UDP packet."""
+    if proto == TCP:
+        l4 = struct.pack('!HHIIBBHHH', sport, dport, 0, 0, 0x50, flags, 8192, 0, 0)
+    else:
+        l4 = struct.pack('!HHHH', sport, dport, 8, 0)
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(l4), 0, 0, 64, proto, 0, bytes(src), bytes(dst))
+    return bytes(12) + b'\x08\x00' + ip + l4
+
+
+def matches(expression, data):
+    return bool(compile_filter(expression).match(decode_packet(1, data)))
+
+
+def test_port_filters():
+    assert matches('tcp port 502', packet(dport=502))
+    assert matches('tcp port 502', packet(sport=502, dport=40000))
+    assert not matches('tcp port 502', packet(UDP, dport=502))
+    assert matches('port 502', packet(UDP, dport=502))
+    assert matches('udp port domain', packet(UDP, dport=53))
+    assert compile_filter('tcp port 502 or tcp port 503').port_route == (TCP, frozenset({502, 503}))
+    # Mixed protocols are evaluated, not routed by port
+    assert compile_filter('tcp port 502 or udp port 502').port_route is None
+
+
+def test_boolean_precedence():
+    # 'and' and 'or' associate left at the same level, as in pcap-filter
+    assert matches('udp or tcp and port 80', packet(UDP, dport=53)) is False
+    assert matches('udp or (tcp and port 80)', packet(UDP, dport=53))
+    assert matches('not udp', packet())
+    assert matches('ip and not icmp', packet())
+
+
+def test_header_loads():
+    syn = packet(flags=0x02)
+    assert matches('tcp[13] & 2 != 0', syn)
+    assert not matches('tcp[13] & 2 != 0', packet(flags=0x10))
+    assert matches('(tcp[13] & 0x12) == 2', syn)
+    assert matches('tcp[2:2] == 502', syn)
+    assert matches('ip[9] == 6', syn)
+    # Loads from another protocol's header or past the packet reject
+    assert not matches('udp[0:2] == 40000', syn)
+    assert not matches('tcp[200] == 0', syn)
+
+
+def test_host_filter():
+    assert matches('host 10.0.0.2', packet())
+    assert not matches('host 10.0.0.3', packet())
+
+
+@pytest.mark.parametrize('expression', ['vlan 100', 'tcp port', 'tcp[13:3] == 0', 'port 502 and', 'ether[0] = 1'])
+def test_unsupported_filters(expression):
+    with pytest.raises(FilterError):
+        compile_filter(expression)
+
+
+def test_demultiplex(tmp_path):
+    pcap_file = str(tmp_path / "capture.pcap")
+    with PcapWriter(pcap_file, 1) as writer:
+        for i, data in enumerate([packet(dport=502), packet(UDP, dport=20000), packet(flags=0x02, dport=80),
+                                  packet(dport=502)]):
+            writer.write(i * 1000, data)
+    outputs = {str(tmp_path / "modbus.pcap"): compile_filter('tcp port 502'),
+               str(tmp_path / "syn.pcap"): compile_filter('tcp[13] & 2 != 0'),
+               str(tmp_path / "none.pcap"): compile_filter('sctp')}
+    counts = demultiplex(pcap_file, outputs)
+    assert list(counts.values()) == [2, 1, 0]
+    with PcapReader(str(tmp_path / "modbus.pcap")) as reader:
+        assert [record.ts_ns for record in reader] == [0, 3000]
+    # Outputs without packets are still written
+    with PcapReader(str(tmp_path / "none.pcap")) as reader:
+        assert list(reader) == []
+
+
+def test_port_segmentation_demultiplexes_once(tmp_path, monkeypatch):
+    pytest.importorskip('maxminddb')
+    from tpahelper import analyze_pcap
+    from tpahelper.utils.benchmarks import write_synthetic_pcap
+
+    pcap_file = str(tmp_path / "capture.pcap")
+    write_synthetic_pcap(pcap_file, 100)
+    task = analyze_pcap.SegmentProtocols(pcap_file=pcap_file, output_dir=str(tmp_path / 'processed'),
+                                         pcap_digest='capture', segment_mode='ports')
+    os.makedirs(task.output_path)
+    pd.DataFrame({'l7_protocol_name': ['Modbus', 'DNP3'], 'src_port': [40000, 40001],
+                  'dst_port': [502, 20000]}).to_parquet(task.input().path)
+
+    def compile_or_fail(expression):
+        if expression == 'port 20000':
+            raise FilterError("unsupported")
+        return compile_filter(expression)
+
+    calls = []
+    monkeypatch.setattr(analyze_pcap, 'compile_filter', compile_or_fail)
+    monkeypatch.setattr(analyze_pcap, 'demultiplex', lambda *args: calls.append(args) or demultiplex(*args))
+
+    # Luigi drops run() at an incomplete dynamic dependency and runs it again once it is complete
+    fallback = next(task.run())
+    assert [t.output_pcap for t in fallback] == [task.output_pcaps[1].path]
+    assert not calls
+    open(fallback[0].output_pcap, 'wb').close()
+    run = task.run()
+    next(run)
+    with pytest.raises(StopIteration):
+        run.send(None)
+
+    assert len(calls) == 1
+    assert len({target.path for target in task.output_pcaps}) == len(task.output_pcaps) == 2
+    assert all(target.exists() for target in task.output())
+
+
+def flow_row(protocol, sport, dport, first_seen_ms, last_seen_ms, proto='TCP'):
+    return {'src_ip_bytes': pack_address('10.0.0.1'), 'dst_ip_bytes': pack_address('10.0.0.2'),
+            'src_port': sport, 'dst_port': dport, 'proto': proto, 'l7_protocol_name': protocol,
+            'first_seen_ms': first_seen_ms, 'last_seen_ms': last_seen_ms}
+
+
+def test_flow_index_routes_both_directions():
+    flow_index = FlowIndex()
+    flow_index.add(flow_row('Modbus', 40000, 502, 0, 10))
+    flow_index.add(flow_row('DNS', 40001, 53, 0, 10, proto='UDP'))
+    flow_index.add(flow_row(None, 40002, 80, 0, 10))
+    assert flow_index.protocols == {'Modbus', 'DNS'}
+    reply = packet(sport=502, dport=40000, src=(10, 0, 0, 2), dst=(10, 0, 0, 1))
+    assert flow_index.lookup(decode_packet(1, reply), 0) == 'Modbus'
+    assert flow_index.lookup(decode_packet(1, packet(UDP, 40001, 53)), 0) == 'DNS'
+    # Same ports over the other transport, unclassified flows and non-IP frames are not routed
+    assert flow_index.lookup(decode_packet(1, packet(TCP, 40001, 53)), 0) is None
+    assert flow_index.lookup(decode_packet(1, packet(dport=80, sport=40002)), 0) is None
+    assert flow_index.lookup(decode_packet(1, bytes(12) + b'\x08\x06' + bytes(28)), 0) is None
+
+
+def test_flow_index_resolves_reused_tuples_by_time():
+    flow_index = FlowIndex()
+    flow_index.add(flow_row('HTTP', 40000, 80, 1_000, 2_000))
+    flow_index.add(flow_row('TLS', 40000, 80, 5_000, 6_000))
+    info = decode_packet(1, packet(dport=80))
+    assert flow_index.lookup(info, 1_500 * 1_000_000) == 'HTTP'
+    assert flow_index.lookup(info, 5_500 * 1_000_000) == 'TLS'
+    # Between flows, the closest one
+    assert flow_index.lookup(info, 4_000 * 1_000_000) == 'TLS'
+
+
+def test_demultiplex_flows(tmp_path):
+    flows_parquet = str(tmp_path / "flows.parquet")
+    pd.DataFrame([flow_row('Modbus', 40000, 502, 0, 10), flow_row('DNS', 40001, 53, 0, 10, proto='UDP')]) \
+        .to_parquet(flows_parquet)
+    pcap_file = str(tmp_path / "capture.pcap")
+    reply = packet(sport=502, dport=40000, src=(10, 0, 0, 2), dst=(10, 0, 0, 1))
+    with PcapWriter(pcap_file, 1) as writer:
+        for i, data in enumerate([packet(), packet(UDP, 40001, 53), packet(dport=503), reply]):
+            writer.write(i, data)
+    outputs = {'DNS': str(tmp_path / "dns.pcap"), 'Modbus': str(tmp_path / "modbus.pcap")}
+    counts = demultiplex_flows(pcap_file, FlowIndex.from_parquet(flows_parquet), outputs)
+    assert counts == {outputs['DNS']: 1, outputs['Modbus']: 2}
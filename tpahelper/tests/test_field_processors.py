@@ -0,0 +1,99 @@
+import sys
+
+import pyarrow.parquet as pq
+import pytest
+
+from tpahelper.utils import field_processors
+from tpahelper.utils.field_processors import AGGREGATOR, FieldProcessor, ModbusProcessor
+from tpahelper.utils.protocols import processor_map
+
+
+@pytest.fixture(autouse=True)
+def no_tshark(monkeypatch):
+    # Every declared field is taken as known, whatever tshark is installed
+    monkeypatch.setattr(field_processors, 'tshark_field_names', lambda: frozenset())
+
+
+def tshark_line(processor, values: dict) -> list:
+    return [values.get(name, '') for name in processor.fields]
+
+
+def test_processors_are_registered():
+    assert all(issubclass(processor_map[name], FieldProcessor)
+               for name in ('modbus', 'iec60870', 's7comm', 'cip', 'bacnet'))
+
+
+def test_fields_are_requested_once(tmp_path):
+    processor = ModbusProcessor('modbus.pcap', str(tmp_path))
+    assert processor.fields[:5] == ['frame.number', 'frame.time_epoch', 'ip.src', 'ipv6.src', 'ip.dst']
+    assert len(processor.fields) == len(set(processor.fields))
+    command = processor.tshark_command()
+    assert command[command.index('-Y') + 1] == 'mbtcp'
+    assert command.count('-e') == len(processor.fields)
+
+
+def test_unknown_fields_are_skipped(tmp_path, monkeypatch):
+    processor = ModbusProcessor('modbus.pcap', str(tmp_path))
+    known = frozenset(processor.fields) - {'ipv6.src', 'modbus.regval_uint16'}
+    monkeypatch.setattr(field_processors, 'tshark_field_names', lambda: known)
+    processor = ModbusProcessor('modbus.pcap', str(tmp_path))
+    assert 'ipv6.src' not in processor.fields and 'modbus.regval_uint16' not in processor.fields
+    # The column stays in the schema, always empty
+    assert processor.schema.names[-1] == 'value'
+
+
+def test_packet_rows(tmp_path):
+    processor = ModbusProcessor('modbus.pcap', str(tmp_path))
+    values = tshark_line(processor, {
+        'frame.number': '4', 'frame.time_epoch': '1700000000.000000001', 'ipv6.src': 'fe80::1', 'ip.dst': '10.0.0.2',
+        'mbtcp.trans_id': '7', 'modbus.func_code': '3', 'modbus.reference_num': 'bad',
+        'modbus.regnum16': AGGREGATOR.join(['100', '101', '102']),
+        'modbus.regval_uint16': AGGREGATOR.join(['0x10', '5', '']),
+    })
+    rows = [dict(zip(processor.schema.names, row)) for row in processor.packet_rows(values)]
+    # One row per register, packet columns repeated, empty and invalid values None
+    assert [(row['register'], row['value']) for row in rows] == [(100, 16), (101, 5), (102, None)]
+    assert rows[0]['frame'] == 4 and rows[0]['time'] == 1_700_000_000_000_000_001
+    assert (rows[0]['src'], rows[0]['dst']) == ('fe80::1', '10.0.0.2')
+    assert (rows[0]['trans_id'], rows[0]['func_code'], rows[0]['reference_num']) == (7, 3, None)
+
+    # Row fields not occurring as often as the others are left empty, a packet without any gives one row
+    values = tshark_line(processor, {'frame.number': '5', 'modbus.regnum16': AGGREGATOR.join(['1', '2']),
+                                     'modbus.regval_uint16': '9'})
+    assert [row[-2:] for row in processor.packet_rows(values)] == [[1, None], [2, None]]
+    assert [row[-2:] for row in processor.packet_rows(tshark_line(processor, {'frame.number': '6'}))] == [[None, None]]
+
+
+def test_run(tmp_path, monkeypatch):
+    processor = ModbusProcessor('modbus.pcap', str(tmp_path), batch_size=2)
+    lines = ['\t'.join(tshark_line(processor, {'frame.number': str(i), 'frame.time_epoch': f'{i}.5',
+                                               'modbus.regnum16': str(i), 'modbus.regval_uint16': str(i * 2)}))
+             for i in range(1, 6)]
+    # A short line (tshark warnings) is skipped
+    lines.insert(2, 'warning')
+    script = f"import sys; sys.stdout.write({chr(10).join(lines) + chr(10)!r})"
+    monkeypatch.setattr(processor, 'tshark_command', lambda: [sys.executable, '-c', script])
+
+    assert processor.run() == [processor.output_parquet]
+    table = pq.read_table(processor.output_parquet)
+    assert table.schema == processor.schema
+    assert table['frame'].to_pylist() == [1, 2, 3, 4, 5]
+    assert table['value'].to_pylist() == [2, 4, 6, 8, 10]
+    assert table['time'].cast('int64').to_pylist()[0] == 1_500_000_000
+
+
+def test_out_of_range_values_are_left_empty(tmp_path, monkeypatch):
+    processor = ModbusProcessor('modbus.pcap', str(tmp_path))
+    values = tshark_line(processor, {'frame.number': '1', 'modbus.func_code': '300',
+                                     'modbus.regnum16': AGGREGATOR.join(['70000', '08', '-1', '0xffff']),
+                                     'modbus.regval_uint16': AGGREGATOR.join(['1', '2', '3', '4'])})
+    rows = processor.packet_rows(values)
+    # Decimals with leading zeros parse, values outside uint16/uint8 don't
+    assert [row[-2] for row in rows] == [None, 8, None, 0xffff]
+    assert rows[0][processor.schema.names.index('func_code')] is None
+
+    # A whole run writes them without failing
+    script = f"import sys; sys.stdout.write({chr(9).join(values) + chr(10)!r})"
+    monkeypatch.setattr(processor, 'tshark_command', lambda: [sys.executable, '-c', script])
+    processor.run()
+    assert pq.read_table(processor.output_parquet)['register'].to_pylist() == [None, 8, None, 0xffff]
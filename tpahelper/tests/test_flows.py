@@ -0,0 +1,187 @@
+import json
+import os
+import subprocess
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from tpahelper.utils.benchmarks import synthetic_flow_records, write_synthetic_flows
+from tpahelper.utils.flows import (expand_dict_column, flatten_flows, flow_key, merge_flow_records,
+                                   merge_shard_flows, pack_address, read_flow_records, stream_flows_to_parquet)
+
+
+def flow(flow_id, src, sport, dst, dport, first_seen, last_seen, packets=1, proto='TCP'):
+    return {'flow_id': flow_id, 'proto': proto, 'src_name': src, 'src_port': sport, 'dst_name': dst,
+            'dst_port': dport, 'first_seen': first_seen, 'last_seen': last_seen,
+            'xfer': {'src2dst_packets': packets, 'dst2src_packets': 0}}
+
+
+def write_shard(path, records):
+    with open(path, 'w') as outfile:
+        for record in records:
+            outfile.write(json.dumps(record) + "\n")
+    return str(path)
+
+
+def test_flow_key_is_direction_independent():
+    key, reversed_ = flow_key(flow(0, '10.0.0.1', 5000, '10.0.0.2', 502, 0, 1))
+    other_key, other_reversed = flow_key(flow(0, '10.0.0.2', 502, '10.0.0.1', 5000, 0, 1))
+    assert key == other_key
+    assert reversed_ != other_reversed
+
+
+def test_merge_flow_records_keeps_first_orientation():
+    first = flow(0, '10.0.0.1', 5000, '10.0.0.2', 502, 10, 20)
+    second = flow(0, '10.0.0.2', 502, '10.0.0.1', 5000, 20, 30)
+    merged = merge_flow_records(first, second, reversed_=True)
+    assert (merged['src_name'], merged['first_seen'], merged['last_seen']) == ('10.0.0.1', 10, 30)
+
+
+def test_shard_flow_ids_are_unique_per_capture(tmp_path):
+    shards = [
+        write_shard(tmp_path / 'shard_0.json', [
+            flow(0, '10.0.0.1', 5000, '10.0.0.2', 502, 0, 10),
+            flow(1, '10.0.0.3', 5001, '10.0.0.4', 502, 0, 5),
+        ]),
+        write_shard(tmp_path / 'shard_1.json', [
+            # Continues flow 0 of the first shard, seen from the other side
+            flow(0, '10.0.0.2', 502, '10.0.0.1', 5000, 10, 20),
+            flow(1, '10.0.0.5', 5002, '10.0.0.6', 502, 12, 15),
+        ]),
+        write_shard(tmp_path / 'shard_2.json', [
+            flow(0, '10.0.0.7', 5003, '10.0.0.8', 502, 21, 25),
+        ]),
+    ]
+    written = merge_shard_flows(shards, tmp_path / 'flows.json')
+    records = list(read_flow_records(tmp_path / 'flows.json'))
+
+    assert written == len(records) == 4
+    ids = [record['flow_id'] for record in records]
+    assert len(set(ids)) == len(ids)
+    by_src = {record['src_name']: record for record in records}
+    # The reconciled flow keeps its first shard id and spans both shards
+    assert by_src['10.0.0.1']['flow_id'] == 0
+    assert (by_src['10.0.0.1']['first_seen'], by_src['10.0.0.1']['last_seen']) == (0, 20)
+    assert by_src['10.0.0.5']['flow_id'] == 3
+    assert by_src['10.0.0.7']['flow_id'] == 4
+
+
+def test_run_removes_shards_on_every_path(tmp_path, monkeypatch):
+    pytest.importorskip('maxminddb')
+    from tpahelper import analyze_pcap
+
+    pcap = tmp_path / 'capture.pcap'
+    pcap.write_bytes(b'\0' * 64)
+    task = analyze_pcap.RunNdpiReader(pcap_file=str(pcap), output_dir=str(tmp_path / 'processed'),
+                                      pcap_digest='capture', shard_threshold=0, shard_workers=2)
+
+    def split_capture():
+        # editcap produced a single shard, so the capture runs unsharded
+        os.makedirs(task.shards_dir, exist_ok=True)
+        shard = os.path.join(task.shards_dir, 'shard_00000.pcap')
+        open(shard, 'wb').close()
+        return [shard]
+
+    class Result:
+        stdout = 'summary'
+
+    monkeypatch.setattr(task, 'split_capture', split_capture)
+    monkeypatch.setattr(analyze_pcap, 'run_ndpi_reader', lambda pcap_path, flows_file: Result())
+    task.run()
+    assert not (tmp_path / 'processed' / task.pcap_digest / 'ndpi_shards').exists()
+
+
+
+def test_split_capture_with_spaces_in_paths(tmp_path, monkeypatch):
+    pytest.importorskip('maxminddb')
+    from tpahelper import analyze_pcap
+
+    pcap = tmp_path / 'my uploads' / 'capture 1.pcap'
+    pcap.parent.mkdir()
+    pcap.write_bytes(b'\0' * 64)
+    task = analyze_pcap.RunNdpiReader(pcap_file=str(pcap), output_dir=str(tmp_path / 'processed [1]'),
+                                      pcap_digest='capture', shard_workers=2)
+    commands = []
+
+    def run(command, **kwargs):
+        commands.append(command)
+        if command[0] == 'editcap':
+            for n in range(2):
+                open(command[-1].replace('shard.pcap', f'shard_{n:05d}_20240101.pcap'), 'wb').close()
+        return subprocess.CompletedProcess(command, 0, stdout=f"{command[-1]},10.0\n", stderr='')
+
+    monkeypatch.setattr(analyze_pcap.subprocess, 'run', run)
+    shards = task.split_capture()
+    assert commands[0][-1] == str(pcap)
+    assert commands[1][1:] == ['-i', '5', str(pcap), os.path.join(task.shards_dir, 'shard.pcap')]
+    assert [os.path.basename(shard) for shard in shards] == ['shard_00000_20240101.pcap', 'shard_00001_20240101.pcap']
+
+
+def test_streamed_flows_match_a_single_batch(tmp_path):
+    flows_file = tmp_path / 'flows.json'
+    write_synthetic_flows(flows_file, 250)
+    # Blank lines between records are skipped
+    flows_file.write_text(flows_file.read_text().replace('\n', '\n\n', 3))
+
+    assert stream_flows_to_parquet(flows_file, tmp_path / 'batched.parquet', batch_size=100) == 250
+    assert stream_flows_to_parquet(flows_file, tmp_path / 'whole.parquet') == 250
+    assert pq.ParquetFile(tmp_path / 'batched.parquet').metadata.num_row_groups == 3
+    batched = pd.read_parquet(tmp_path / 'batched.parquet')
+    pd.testing.assert_frame_equal(batched, pd.read_parquet(tmp_path / 'whole.parquet'), check_categorical=False)
+    assert batched['dst_port'].tolist()[:5] == [record['dst_port'] for record in synthetic_flow_records(5)]
+
+
+def test_empty_flows_file(tmp_path):
+    (tmp_path / 'flows.json').write_text('\n')
+    assert stream_flows_to_parquet(tmp_path / 'flows.json', tmp_path / 'flows.parquet', batch_size=10) == 0
+    assert pd.read_parquet(tmp_path / 'flows.parquet').empty
+
+
+def test_expand_dict_column_matches_apply():
+    series = pd.Series([{'a': 1, 'b': 2.5}, None, {'b': 3.0, 'c': 'x'}, {}], index=[10, 11, 12, 13])
+    expanded = expand_dict_column(series, 'xfer')
+    expected = series.apply(lambda value: pd.Series(value if isinstance(value, dict) else {}, dtype=object))
+    expected.columns = [f"xfer_{c}" for c in expected.columns]
+    pd.testing.assert_frame_equal(expanded.astype(object), expected[expanded.columns].astype(object))
+    assert list(expanded.index) == [10, 11, 12, 13]
+
+
+def test_flatten_flows():
+    df = flatten_flows(pd.DataFrame({
+        'src_name': ['10.0.0.1', '2001:db8::1'], 'dst_name': ['8.8.8.8', 'not an address'],
+        'first_seen': [1700000000000, 1700000000500], 'last_seen': [1700000001000, 1700000002000],
+        'xfer': [{'src2dst_packets': 3}, {'src2dst_packets': 4, 'dst2src_packets': 1}],
+        'iat': [{'flow_min': 0}, None], 'l7_protocol_data': [{'dns': 1}, None],
+    }))
+    assert not {'xfer', 'iat', 'first_seen'} & set(df.columns)
+    assert df['xfer_src2dst_packets'].tolist() == [3, 4]
+    assert df['xfer_dst2src_packets'].isna().tolist() == [True, False]
+    assert df['first_seen_utc'][1] == pd.Timestamp('2023-11-14 22:13:20.500', tz='UTC')
+    assert df['l7_protocol_data'][0] == "{'dns': 1}" and pd.isna(df['l7_protocol_data'][1])
+    assert df['src_ip_bytes'].tolist() == [pack_address('10.0.0.1'), pack_address('2001:db8::1')]
+    assert df['dst_ip_bytes'][1] is None
+
+
+def test_typed_flow_schema(tmp_path):
+    records = [flow(0, '10.0.0.1', 5000, '10.0.0.2', 502, 0, 10),
+               {**flow(1, '10.0.0.3', None, '10.0.0.4', 53, 5, 6, proto='UDP'), 'l7_protocol_name': 'DNS',
+                'l7_protocol_data': {'query': 'example.com'}, 'xfer': {'src2dst_packets': 2, 'dst2src_bytes': 1.5}}]
+    flows_file = write_shard(tmp_path / 'flows.json', records)
+    stream_flows_to_parquet(flows_file, tmp_path / 'flows.parquet')
+
+    schema = pq.read_schema(tmp_path / 'flows.parquet')
+    assert schema.field('src_name').type == pa.dictionary(pa.int32(), pa.string())
+    assert schema.field('src_port').type == pa.uint16()
+    assert schema.field('first_seen_ms').type == pa.int64()
+    assert schema.field('xfer_src2dst_packets').type == pa.int64()
+    assert schema.field('xfer_dst2src_bytes').type == pa.float64()
+    assert schema.field('l7_protocol_data').type == pa.string()
+
+    df = pd.read_parquet(tmp_path / 'flows.parquet')
+    # Gaps are nulls of the column's own type, not '-' strings
+    assert str(df['src_port'].dtype) == 'UInt16' and df['src_port'].isna().tolist() == [False, True]
+    assert df['l7_protocol_name'].dtype == 'category' and pd.isna(df['l7_protocol_name'][0])
+    assert df['xfer_dst2src_bytes'].isna().tolist() == [True, False]
+    assert df['l7_protocol_data'][1] == "{'query': 'example.com'}"
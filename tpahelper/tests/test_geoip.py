@@ -0,0 +1,110 @@
+import ipaddress
+from types import SimpleNamespace
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+pytest.importorskip('maxminddb')
+
+from tpahelper.utils import geoip  # noqa: E402
+from tpahelper.utils.addresses import format_addresses  # noqa: E402
+from tpahelper.utils.flows import pack_address  # noqa: E402
+from tpahelper.utils.geoip import geoip_flows, lookup_addresses, record_fields  # noqa: E402
+
+COUNTRY = {'8.8.8.0/24': {'country': {'iso_code': 'US'}},
+           '1.1.1.0/24': {'registered_country': {'iso_code': 'AU'}},
+           '2001:4860::/32': {'country': {'iso_code': 'US'}}}
+ASN = {'8.8.0.0/16': {'autonomous_system_number': 15169, 'autonomous_system_organization': 'GOOGLE'}}
+
+
+class Reader:
+    """Database reader over {network: record}, counting its lookups."""
+
+    def __init__(self, networks: dict, ip_version: int = 6, build_epoch: int = 1):
+        self.networks = [(ipaddress.ip_network(network), record) for network, record in networks.items()]
+        self.ip_version = ip_version
+        self.build_epoch = build_epoch
+        self.lookups = []
+
+    def metadata(self):
+        return SimpleNamespace(database_type='test', build_epoch=self.build_epoch, ip_version=self.ip_version)
+
+    def get_with_prefix_len(self, text):
+        self.lookups.append(text)
+        ip = ipaddress.ip_address(text)
+        for network, record in self.networks:
+            if network.version == ip.version and ip in network:
+                return record, network.prefixlen
+        # The largest block around ip holding no record
+        width = ip.max_prefixlen
+        for prefix_len in range(width + 1):
+            block = ipaddress.ip_network(f"{ip}/{prefix_len}", strict=False)
+            if not any(network.version == ip.version and network.overlaps(block) for network, _ in self.networks):
+                return None, prefix_len
+
+    def close(self):
+        pass
+
+
+def packed_sorted(addresses: list) -> pa.Array:
+    return pa.array(sorted(pack_address(address) for address in addresses), type=pa.binary(16))
+
+
+def test_record_fields():
+    assert record_fields({'country': {'iso_code': 'DE'}, 'registered_country': {'iso_code': 'FR'}}) == {
+        'country': 'DE', 'asn': None, 'org': None}
+    assert record_fields({'country': {'names': {}}, 'registered_country': {'iso_code': 'FR'}})['country'] == 'FR'
+    assert record_fields(ASN['8.8.0.0/16']) == {'country': None, 'asn': 'AS15169', 'org': 'GOOGLE'}
+    assert record_fields(None) == {'country': None, 'asn': None, 'org': None}
+
+
+def test_lookup_addresses_once_per_network():
+    country, asn = Reader(COUNTRY), Reader(ASN, ip_version=4)
+    addresses = ['8.8.8.8', '8.8.8.4', '8.8.4.4', '1.1.1.1', '10.0.0.1', '10.0.0.2', '2001:4860::8888',
+                 '2001:4860::8844', '2001:db8::1']
+    table, lookups = lookup_addresses([country, asn], packed_sorted(addresses))
+    rows = dict(zip(format_addresses(table['ip_bytes'].combine_chunks()).to_pylist(), table.to_pylist()))
+    assert {ip: (row['country'], row['asn']) for ip, row in rows.items()} == {
+        '1.1.1.1': ('AU', None), '8.8.4.4': (None, 'AS15169'), '8.8.8.4': ('US', 'AS15169'),
+        '8.8.8.8': ('US', 'AS15169'), '10.0.0.1': (None, None), '10.0.0.2': (None, None),
+        '2001:4860::8844': ('US', None), '2001:4860::8888': ('US', None), '2001:db8::1': (None, None)}
+    # One lookup per network and database; an IPv4 database isn't asked about IPv6
+    assert len(country.lookups) == 6 and len(asn.lookups) == 3
+    assert lookups == 9
+
+
+def test_geoip_flows_memoizes_lookups(tmp_path, monkeypatch):
+    readers = [Reader(COUNTRY), Reader(ASN, ip_version=4)]
+    monkeypatch.setattr(geoip, 'open_databases', lambda files: readers)
+    flows_parquet = str(tmp_path / 'flows.parquet')
+    pq.write_table(pa.table({'src_name': ['10.0.0.1', '10.0.0.1', '2001:4860::8888'],
+                             'dst_name': ['8.8.8.8', '1.1.1.1', None]}), flows_parquet)
+    memo_file = str(tmp_path / 'cache' / 'geoip.parquet')
+    output_parquet = str(tmp_path / 'geoip.parquet')
+
+    table, stats = geoip_flows(flows_parquet, ['country.mmdb', 'asn.mmdb'], memo_file, output_parquet)
+    assert stats == {'addresses': 4, 'hits': 0, 'lookups': 7, 'databases': 2}
+    assert table['dst_country'].to_pylist() == ['US', 'AU', None]
+    assert table['dst_asn'].to_pylist() == ['AS15169', None, None]
+    assert table['src_country'].to_pylist() == [None, None, 'US']
+    assert pa.types.is_dictionary(table.schema.field('src_org').type)
+    assert pq.read_table(output_parquet).equals(table)
+
+    # A second capture reuses the memo, until a database is updated
+    _, stats = geoip_flows(flows_parquet, [], memo_file, output_parquet)
+    assert (stats['hits'], stats['lookups']) == (4, 0)
+    readers[0].build_epoch = 2
+    _, stats = geoip_flows(flows_parquet, [], memo_file, output_parquet)
+    assert (stats['hits'], stats['lookups']) == (0, 7)
+
+
+def test_geoip_memo_keeps_recent_addresses(tmp_path, monkeypatch):
+    monkeypatch.setattr(geoip, 'open_databases', lambda files: [Reader(COUNTRY)])
+    memo_file = str(tmp_path / 'geoip_memo.parquet')
+    for i, addresses in enumerate([['8.8.8.8', '1.1.1.1'], ['9.9.9.9'], ['8.8.8.8']]):
+        flows_parquet = str(tmp_path / f'flows{i}.parquet')
+        pq.write_table(pa.table({'src_name': addresses, 'dst_name': addresses}), flows_parquet)
+        geoip_flows(flows_parquet, [], memo_file, str(tmp_path / 'geoip.parquet'), max_entries=2)
+    memo = pq.read_table(memo_file)['ip_bytes'].to_pylist()
+    assert memo == [pack_address('8.8.8.8'), pack_address('9.9.9.9')]
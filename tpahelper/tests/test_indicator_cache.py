@@ -0,0 +1,55 @@
+import pytest
+
+from tpahelper.utils import indicator_cache
+from tpahelper.utils.indicator_cache import QUERY_CHUNK, IndicatorCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(indicator_cache.time, 'time', lambda: now[0])
+    return now
+
+
+def test_entries_persist_and_expire(tmp_path, clock):
+    cache_file = tmp_path / 'cache' / 'indicators.sqlite'
+    with IndicatorCache(cache_file, ttl=100, negative_ttl=10) as cache:
+        cache.put('8.8.8.8', 'ipv4', {'reputation': 0})
+        cache.put('9.9.9.9', 'ipv4', {'error': 'Failed to fetch data'})
+        cache.put('1.1.1.1', 'ipv4', {'reputation': 0}, failed=True)
+
+    with IndicatorCache(cache_file, ttl=100, negative_ttl=10) as cache:
+        assert cache.get('8.8.8.8', 'ipv4') == {'reputation': 0}
+        assert cache.get('8.8.8.8', 'ipv6') is None
+        clock[0] += 50
+        # Failures expire after the negative ttl, whether flagged or detected
+        assert cache.get_many([('8.8.8.8', 'ipv4'), ('9.9.9.9', 'ipv4'), ('1.1.1.1', 'ipv4')]) == {
+            ('8.8.8.8', 'ipv4'): {'reputation': 0}}
+        clock[0] += 51
+        assert cache.get('8.8.8.8', 'ipv4') is None
+        assert cache.evict() == 3
+
+
+def test_get_many_queries_in_chunks(tmp_path, clock):
+    keys = [(f'10.0.{i // 256}.{i % 256}', 'ipv4') for i in range(QUERY_CHUNK * 2 + 1)]
+    with IndicatorCache(tmp_path / 'indicators.sqlite') as cache:
+        for indicator, indicator_type in keys[::2]:
+            cache.put(indicator, indicator_type, {'indicator': indicator})
+        hits = cache.get_many(keys)
+    assert sorted(hits) == sorted(keys[::2])
+    assert all(hits[key] == {'indicator': key[0]} for key in hits)
+
+
+def test_evict_least_recently_used(tmp_path, clock):
+    with IndicatorCache(tmp_path / 'indicators.sqlite') as cache:
+        for i in range(4):
+            cache.put(f'host{i}', 'hostname', {'data': 'x' * 100})
+            clock[0] += 1
+        size = cache._db.execute("SELECT size FROM indicators LIMIT 1").fetchone()[0]
+        # Reading host0 makes host1 the least recently used
+        assert cache.get('host0', 'hostname')
+        cache.max_bytes = size * 2
+        assert cache.evict() == 2
+        assert sorted(cache.get_many([(f'host{i}', 'hostname') for i in range(4)])) == [
+            ('host0', 'hostname'), ('host3', 'hostname')]
+        assert cache.evict() == 0
@@ -0,0 +1,65 @@
+import json
+import os
+
+from tpahelper.utils.indicator_cache import IndicatorCache
+from tpahelper.utils.otx import indicator_file, indicator_url, query_indicators
+
+
+def query(raw_dir, indicators, base_url, **kwargs):
+    return query_indicators(indicators, raw_dir, rate=0, retries=1, backoff=0, base_url=base_url, **kwargs)
+
+
+def test_indicator_url_keeps_the_path_on_another_host():
+    url = indicator_url('2001:db8::1', 'ipv6', 'http://127.0.0.1:8000/')
+    assert url == 'http://127.0.0.1:8000/api/v1/indicators/IPv6/2001%3Adb8%3A%3A1/general'
+
+
+def test_responses_are_written_and_skipped_on_rerun(tmp_path, otx_server):
+    base_url, state = otx_server
+    indicators = [('8.8.8.8', 'ipv4'), ('1.1.1.1', 'ipv4')]
+    stats = query(tmp_path, indicators, base_url)
+    assert (stats['fetched'], stats['failed']) == (2, 0)
+    with open(indicator_file(tmp_path, '8.8.8.8', 'ipv4')) as infile:
+        assert json.load(infile)['indicator'] == '8.8.8.8'
+
+    results = []
+    stats = query(tmp_path, indicators, base_url, on_result=lambda *result: results.append(result))
+    assert stats['skipped'] == 2
+    assert state['requests'] == 2
+    assert sorted(indicator for indicator, _, _ in results) == ['1.1.1.1', '8.8.8.8']
+
+
+def test_failures_are_not_persisted(tmp_path, otx_server):
+    base_url, state = otx_server
+    state['failing'].add('9.9.9.9')
+    stats = query(tmp_path, [('9.9.9.9', 'ipv4')], base_url)
+    assert stats['failed'] == 1
+    assert not os.path.exists(indicator_file(tmp_path, '9.9.9.9', 'ipv4'))
+
+    # The transient failure is retried by the next run
+    state['failing'].clear()
+    stats = query(tmp_path, [('9.9.9.9', 'ipv4')], base_url)
+    assert stats['fetched'] == 1
+    assert os.path.exists(indicator_file(tmp_path, '9.9.9.9', 'ipv4'))
+
+
+def test_error_files_of_earlier_runs_are_pending(tmp_path, otx_server):
+    base_url, _ = otx_server
+    with open(indicator_file(tmp_path, '9.9.9.9', 'ipv4'), 'w') as outfile:
+        json.dump({'error': 'Failed to fetch data', 'indicator': '9.9.9.9'}, outfile)
+    stats = query(tmp_path, [('9.9.9.9', 'ipv4')], base_url)
+    assert (stats['fetched'], stats['skipped']) == (1, 0)
+
+
+def test_cache_serves_other_captures(tmp_path, otx_server):
+    base_url, state = otx_server
+    state['failing'].add('9.9.9.9')
+    indicators = [('8.8.8.8', 'ipv4'), ('9.9.9.9', 'ipv4')]
+    with IndicatorCache(tmp_path / 'cache.sqlite', negative_ttl=3600) as cache:
+        query(tmp_path / 'first', indicators, base_url, cache=cache)
+        requests = state['requests']
+        stats = query(tmp_path / 'second', indicators, base_url, cache=cache)
+    # The failure is cached for the negative ttl, but gets no raw file
+    assert (stats['hits'], stats['misses']) == (2, 0)
+    assert state['requests'] == requests
+    assert os.listdir(tmp_path / 'second') == [os.path.basename(indicator_file('', '8.8.8.8', 'ipv4'))]
@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pyarrow.parquet as pq
+import pytest
+
+from tpahelper.tests.test_pcap import IPV4_TCP, IPV6_UDP, ethernet, pcapng
+from tpahelper.utils import packet_index
+from tpahelper.utils.benchmarks import write_synthetic_pcap
+from tpahelper.utils.packet_index import (PacketIndexBuilder, _flow_row_groups, build_packet_index, flow_id,
+                                          flow_index_path, is_current, slice_capture)
+from tpahelper.utils.pcap import PcapReader, decode_packet
+
+START_NS = 1_700_000_000_000_000_000
+
+
+@pytest.fixture
+def capture(tmp_path, monkeypatch):
+    # Small row groups, so the flow ordered copy is merged from several spilled runs
+    monkeypatch.setattr(packet_index, 'ROW_GROUP_SIZE', 300)
+    pcap_file = str(tmp_path / "capture.pcap")
+    write_synthetic_pcap(pcap_file, 3000)
+    index_file = str(tmp_path / "capture.index.parquet")
+    build_packet_index(pcap_file, index_file)
+    return pcap_file, index_file
+
+
+def _records(pcap_file):
+    with PcapReader(pcap_file) as reader:
+        return [(record.ts_ns, record.data) for record in reader]
+
+
+def test_flow_index_is_sorted_and_complete(capture):
+    pcap_file, index_file = capture
+    assert is_current(pcap_file, index_file)
+    by_time = pq.read_table(index_file)
+    by_flow = pq.read_table(flow_index_path(index_file))
+    assert by_flow.num_rows == by_time.num_rows == 3000
+    flow_ids = by_flow['flow_id'].to_numpy()
+    assert (np.diff(flow_ids) >= 0).all()
+    # Packets of a flow stay in capture order
+    offsets = by_flow['offset'].to_numpy()
+    assert (np.diff(offsets)[np.diff(flow_ids) == 0] > 0).all()
+    assert sorted(offsets.tolist()) == by_time['offset'].to_pylist()
+
+
+def test_flow_lookup_reads_only_matching_row_groups(capture):
+    _, index_file = capture
+    parquet_file = pq.ParquetFile(flow_index_path(index_file))
+    wanted = np.array([flow_id('TCP', '10.0.0.1', 40007, '10.0.0.2', 502)])
+    assert parquet_file.metadata.num_row_groups > 1
+    assert len(_flow_row_groups(parquet_file, wanted)) == 1
+
+
+def test_slice_by_flow(capture, tmp_path):
+    pcap_file, index_file = capture
+    ports = [40007, 40500]
+    output = str(tmp_path / "flows.pcap")
+    count = slice_capture(pcap_file, output, [flow_id('TCP', '10.0.0.2', 502, '10.0.0.1', port) for port in ports],
+                          index_file=index_file)
+    expected = [record for i, record in enumerate(_records(pcap_file)) if 40000 + i % 1000 in ports]
+    assert count == len(expected) == 6
+    assert _records(output) == expected
+
+
+def test_slice_by_time(capture, tmp_path):
+    pcap_file, index_file = capture
+    output = str(tmp_path / "window.pcap")
+    count = slice_capture(pcap_file, output, start_ns=START_NS + 100_000, end_ns=START_NS + 199_000,
+                          index_file=index_file)
+    assert count == 100
+    assert _records(output) == _records(pcap_file)[100:200]
+
+
+def test_slice_by_flow_and_time(capture, tmp_path):
+    pcap_file, index_file = capture
+    output = str(tmp_path / "both.pcap")
+    count = slice_capture(pcap_file, output, [flow_id('TCP', '10.0.0.1', 40007, '10.0.0.2', 502)],
+                          start_ns=START_NS + 1_000_000, index_file=index_file)
+    assert count == 2
+    assert [ts for ts, _ in _records(output)] == [START_NS + 1_007_000, START_NS + 2_007_000]
+
+
+def test_abort_leaves_no_files(tmp_path):
+    pcap_file = str(tmp_path / "capture.pcap")
+    write_synthetic_pcap(pcap_file, 10)
+    with pytest.raises(RuntimeError):
+        with PcapReader(pcap_file) as reader, PacketIndexBuilder(pcap_file) as builder:
+            for record in reader:
+                builder.add(record, decode_packet(record.linktype, record.data))
+            builder._flush()
+            raise RuntimeError("interrupted")
+    assert os.listdir(tmp_path) == ["capture.pcap"]
+
+
+def test_slice_pcapng(tmp_path):
+    pcap_file = tmp_path / "capture.pcapng"
+    packets = [(START_NS + i, ethernet(IPV4_TCP) if i % 2 else ethernet(IPV6_UDP, ethertype=0x86dd))
+               for i in range(6)]
+    pcap_file.write_bytes(pcapng(packets, tsresol=9))
+    output = str(tmp_path / "tcp.pcap")
+    count = slice_capture(str(pcap_file), output, [flow_id('TCP', '10.0.0.1', 40000, '10.0.0.2', 502)])
+    assert count == 3
+    # pcapng packets are rewritten as nanosecond pcap
+    with PcapReader(output) as reader:
+        assert reader.format == 'pcap' and reader.nanosecond
+        assert [(record.ts_ns, record.data) for record in reader] == packets[1::2]
@@ -0,0 +1,99 @@
+import struct
+
+import pytest
+
+from tpahelper.utils.pcap import PcapError, PcapReader, PcapWriter, decode_packet
+
+IPV4_TCP = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40, 0, 0, 64, 6, 0, bytes([10, 0, 0, 1]), bytes([10, 0, 0, 2])) + \
+    struct.pack('!HHIIBBHHH', 40000, 502, 0, 0, 0x50, 0x18, 8192, 0, 0)
+IPV6_UDP = struct.pack('!IHBB16s16s', 6 << 28, 8, 17, 64, bytes(15) + b'\x01', bytes(15) + b'\x02') + \
+    struct.pack('!HHHH', 5353, 53, 8, 0)
+
+
+def ethernet(payload, ethertype=0x0800, vlans=()):
+    frame = bytes(12)
+    for vlan in vlans:
+        frame += struct.pack('!HH', 0x8100, vlan)
+    return frame + struct.pack('!H', ethertype) + payload
+
+
+def block(endian, block_type, body):
+    body += bytes(-len(body) % 4)
+    length = 12 + len(body)
+    return struct.pack(endian + 'II', block_type, length) + body + struct.pack(endian + 'I', length)
+
+
+def pcapng(packets, endian='<', tsresol=None, linktype=1):
+    """A pcapng section with one interface and an Enhanced Packet Block per (ts_units, data)."""
+    shb = block(endian, 0x0a0d0d0a, struct.pack(endian + 'IHHq', 0x1a2b3c4d, 1, 0, -1))
+    options = b''
+    if tsresol is not None:
+        options = struct.pack(endian + 'HH', 9, 1) + bytes([tsresol, 0, 0, 0]) + struct.pack(endian + 'HH', 0, 0)
+    idb = block(endian, 1, struct.pack(endian + 'HHI', linktype, 0, 65535) + options)
+    epbs = b''.join(block(endian, 6, struct.pack(endian + 'IIIII', 0, ts >> 32, ts & 0xffffffff, len(data),
+                                                 len(data) + 4) + data) for ts, data in packets)
+    return shb + idb + epbs
+
+
+def test_pcap_round_trip(tmp_path):
+    path = str(tmp_path / 'capture.pcap')
+    packets = [(1_700_000_000_123_456_000, ethernet(IPV4_TCP)), (1_700_000_001_000_001_000, ethernet(IPV6_UDP))]
+    with PcapWriter(path, 1) as writer:
+        for ts_ns, data in packets:
+            writer.write(ts_ns, data)
+    with PcapReader(path) as reader:
+        records = list(reader)
+        assert (reader.format, reader.linktype, reader.nanosecond) == ('pcap', 1, False)
+        assert [(record.ts_ns, record.data) for record in records] == packets
+        assert [record.offset for record in records] == [24, 24 + records[0].size]
+        assert reader.read_at(records[1].offset, records[1].size)[16:] == packets[1][1]
+        assert reader.packet_at(records[1].offset)[2] == packets[1][1]
+
+
+def test_truncated_last_record_is_skipped(tmp_path):
+    path = tmp_path / 'capture.pcap'
+    with PcapWriter(str(path), 1, nanosecond=True) as writer:
+        writer.write(1, ethernet(IPV4_TCP))
+        writer.write(2, ethernet(IPV4_TCP))
+    path.write_bytes(path.read_bytes()[:-10])
+    with PcapReader(str(path)) as reader:
+        assert [record.ts_ns for record in reader] == [1]
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+@pytest.mark.parametrize('tsresol, scale', [(None, 1000), (9, 1), (0x80 | 10, None)])
+def test_pcapng(tmp_path, endian, tsresol, scale):
+    path = tmp_path / 'capture.pcapng'
+    packets = [(1_700_000_000_000_000 + i, ethernet(IPV4_TCP, vlans=[i] * i)) for i in range(3)]
+    path.write_bytes(pcapng(packets, endian, tsresol))
+    with PcapReader(str(path)) as reader:
+        records = list(reader)
+        assert reader.format == 'pcapng' and reader.linktype == 1
+        assert [record.data for record in records] == [data for _, data in packets]
+        for (units, _), record in zip(packets, records):
+            # Binary resolutions (2^-10 s here) are converted without float rounding
+            assert record.ts_ns == (units * scale if scale else (units * 1_000_000_000) >> 10)
+        assert reader.packet_at(records[2].offset) == (len(packets[2][1]), len(packets[2][1]) + 4, packets[2][1])
+
+
+@pytest.mark.parametrize('content', [b'', b'\xd4\xc3', b'not a capture at all'])
+def test_invalid_captures(tmp_path, content):
+    path = tmp_path / 'capture.pcap'
+    path.write_bytes(content)
+    with pytest.raises(PcapError):
+        with PcapReader(str(path)):
+            pass
+
+
+def test_decode_packet():
+    info = decode_packet(1, ethernet(IPV4_TCP, vlans=[10, 20]))
+    assert (info.version, info.proto, info.sport, info.dport) == (4, 6, 40000, 502)
+    assert info.src == bytes([10, 0, 0, 1]) and info.l4_offset == 14 + 8 + 20
+    info = decode_packet(1, ethernet(IPV6_UDP, ethertype=0x86dd))
+    assert (info.version, info.proto, info.sport, info.dport) == (6, 17, 5353, 53)
+    # Linux cooked capture and raw IP
+    assert decode_packet(113, bytes(14) + b'\x08\x00' + IPV4_TCP).dport == 502
+    assert decode_packet(101, IPV6_UDP).dport == 53
+    # Non-IP and truncated packets keep the fields they could not decode empty
+    assert decode_packet(1, ethernet(bytes(28), ethertype=0x0806)).proto is None
+    assert decode_packet(1, ethernet(IPV4_TCP[:22])).sport is None
@@ -0,0 +1,58 @@
+import math
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from tpahelper.utils.periodicity import analyze_periodicity, autocorrelation, strongest_peaks
+from tpahelper.utils.point_values import series_schema
+
+
+def write_series(path, points: dict):
+    # points: name -> (seconds, values)
+    names, times, values = [], [], []
+    for name, (seconds, readings) in points.items():
+        names += [name] * len(seconds)
+        times += (np.asarray(seconds) * 1e9).astype(np.int64).tolist()
+        values += list(readings)
+    pq.write_table(pa.table({
+        'point': pa.array(names).dictionary_encode(),
+        'time': pa.array(times, type=pa.int64()).cast(pa.timestamp('ns', tz='UTC')),
+        'value': pa.array(values, type=pa.float64()),
+    }, schema=series_schema), path)
+
+
+@pytest.mark.parametrize('span', [0.5, 1.5])
+def test_short_captures_have_no_period(tmp_path, span):
+    # 1 and 2 one-second bins
+    seconds = np.linspace(0, span, 20)
+    write_series(tmp_path / 'series.parquet', {'a': (seconds, np.arange(20) % 3)})
+    report = analyze_periodicity(tmp_path / 'series.parquet', tmp_path / 'report.parquet').to_pylist()
+    assert len(report) == 1
+    assert report[0]['readings'] == 20
+    for column in ('acf_period_s', 'acf_peak', 'fft_period_s', 'fft_power_ratio'):
+        assert math.isnan(report[0][column])
+
+
+def test_periodic_point_is_found(tmp_path):
+    seconds = np.arange(120)
+    write_series(tmp_path / 'series.parquet', {
+        'polled': (seconds, (seconds % 5 == 0).astype(float)),
+        'constant': (seconds, np.ones(120)),
+        'sparse': (seconds[:3], [1.0, 2.0, 3.0]),
+    })
+    report = {row['point']: row for row in
+              analyze_periodicity(tmp_path / 'series.parquet', tmp_path / 'report.parquet').to_pylist()}
+    assert report['polled']['acf_period_s'] == 5.0
+    assert report['polled']['fft_period_s'] == pytest.approx(5.0)
+    assert math.isnan(report['constant']['acf_period_s'])
+    assert math.isnan(report['sparse']['acf_period_s'])
+    assert pq.read_table(tmp_path / 'report.parquet').num_rows == 3
+
+
+def test_strongest_peaks_without_lags():
+    acf = autocorrelation(np.array([[1.0, -1.0]]))
+    lags, heights = strongest_peaks(acf, 2)
+    assert lags.tolist() == [0]
+    assert np.isnan(heights).all()
@@ -0,0 +1,130 @@
+import math
+import os
+
+import pyarrow.parquet as pq
+import pytest
+
+from tpahelper.utils.point_values import PointValueWriter, epoch_ns, pivot_point_series, read_point_series, \
+    resample_point_values, series_stats_path, to_float, write_point_series
+
+TYPES = ['dnp3.al.ana.int', 'dnp3.al.ana.float']
+
+
+def test_epoch_ns():
+    assert epoch_ns('1700000000.123456789') == 1_700_000_000_123_456_789
+    assert epoch_ns('1700000000.5') == 1_700_000_000_500_000_000
+    assert epoch_ns('1700000000') == 1_700_000_000_000_000_000
+
+
+def test_to_float():
+    assert to_float('-1.5') == -1.5
+    assert math.isnan(to_float('n/a')) and math.isnan(to_float(None))
+
+
+def test_point_value_writer_flushes_batches(tmp_path):
+    values_parquet = str(tmp_path / 'points.parquet')
+    with PointValueWriter(values_parquet, TYPES, batch_size=2) as writer:
+        for i in range(5):
+            writer.add(i * 1_000_000, i % 2, i, float(i))
+        # Full batches are written as they fill up
+        assert writer.count == 4
+    assert writer.count == 5
+
+    parquet = pq.ParquetFile(values_parquet)
+    assert parquet.metadata.num_row_groups == 3
+    table = parquet.read()
+    assert table['time'].cast('int64').to_pylist() == [i * 1_000_000 for i in range(5)]
+    assert table['type'].cast('string').to_pylist() == [TYPES[i % 2] for i in range(5)]
+    assert table['index'].to_pylist() == list(range(5))
+    assert table['value'].to_pylist() == [float(i) for i in range(5)]
+    assert not os.path.exists(f"{values_parquet}.tmp")
+
+
+def test_point_value_writer_aborts_on_error(tmp_path):
+    values_parquet = str(tmp_path / 'points.parquet')
+    with pytest.raises(RuntimeError):
+        with PointValueWriter(values_parquet, TYPES) as writer:
+            writer.add(0, 0, 1, 1.0)
+            raise RuntimeError("interrupted")
+    assert os.listdir(tmp_path) == []
+
+
+def test_resample_point_values(tmp_path):
+    values_parquet = str(tmp_path / 'points.parquet')
+    second = 1_000_000_000
+    with PointValueWriter(values_parquet, TYPES) as writer:
+        writer.add(2 * second + 10, 0, 7, 3.0)
+        writer.add(0, 0, 7, 1.0)
+        writer.add(second - 1, 0, 7, 2.0)
+        writer.add(second // 2, 1, 3, 5.0)
+        writer.add(second // 2, 1, 3, math.nan)
+    table = resample_point_values(values_parquet)
+    # Mean per point and second, NaN readings are left out
+    assert list(zip(table['time'].cast('int64').to_pylist(), table['index'].to_pylist(),
+                    table['value'].to_pylist())) == [(0, 3, 5.0), (0, 7, 1.5), (2 * second, 7, 3.0)]
+
+
+
+def test_resample_point_values_in_batches(tmp_path, monkeypatch):
+    values_parquet = str(tmp_path / 'points.parquet')
+    with PointValueWriter(values_parquet, TYPES, batch_size=100) as writer:
+        for i in range(1000):
+            writer.add(i * 7_000_000, i % 2, i % 5, math.nan if i % 11 == 0 else float(i))
+    whole = resample_point_values(values_parquet, 100_000_000, batch_size=10_000)
+    # The readings are never loaded at once
+    monkeypatch.setattr(pq, 'read_table', lambda *args, **kwargs: pytest.fail("read the whole file"))
+    batched = resample_point_values(values_parquet, 100_000_000, batch_size=30)
+    assert batched['time'].equals(whole['time']) and batched['index'].equals(whole['index'])
+    assert batched['value'].to_pylist() == pytest.approx(whole['value'].to_pylist())
+    assert whole.num_rows == 70 * 5
+
+
+def test_resample_no_point_values(tmp_path):
+    values_parquet = str(tmp_path / 'points.parquet')
+    with PointValueWriter(values_parquet, TYPES):
+        pass
+    table = resample_point_values(values_parquet)
+    assert table.num_rows == 0 and table.schema.names == ['time', 'index', 'value']
+
+
+@pytest.fixture
+def series_parquet(tmp_path):
+    values_parquet = str(tmp_path / 'points.parquet')
+    second = 1_000_000_000
+    with PointValueWriter(values_parquet, TYPES) as writer:
+        for i in range(4):
+            writer.add(i * second, 0, 7, float(i))
+        writer.add(second, 1, 10, -2.0)
+        writer.add(3 * second, 1, 10, 4.0)
+        writer.add(2 * second, 0, 3, 9.0)
+    series_parquet = str(tmp_path / 'values.parquet')
+    write_point_series(values_parquet, series_parquet)
+    return series_parquet
+
+
+def test_write_point_series(series_parquet):
+    table = pq.read_table(series_parquet)
+    # Sorted by point id, then time, only the intervals with a reading
+    assert table['point'].cast('string').to_pylist() == ['10'] * 2 + ['3'] + ['7'] * 4
+    assert table['time'].cast('int64').to_pylist() == [s * 1_000_000_000 for s in (1, 3, 2, 0, 1, 2, 3)]
+    column = pq.ParquetFile(series_parquet).metadata.row_group(0).column(1)
+    assert 'DELTA_BINARY_PACKED' in column.encodings
+
+    stats = pq.read_table(series_stats_path(series_parquet)).to_pylist()
+    assert [(s['point'], s['count'], s['min'], s['max']) for s in stats] == [
+        ('10', 2, -2.0, 4.0), ('3', 1, 9.0, 9.0), ('7', 4, 0.0, 3.0)]
+    assert stats[0]['first'].timestamp() == 1 and stats[0]['last'].timestamp() == 3
+
+
+def test_read_point_series(series_parquet):
+    df = read_point_series(series_parquet, points=[7, 10], start='1970-01-01 00:00:01', end='1970-01-01 00:00:02')
+    assert list(zip(df['point'].astype(str), df['value'])) == [('10', -2.0), ('7', 1.0), ('7', 2.0)]
+    assert len(read_point_series(series_parquet)) == 7
+
+
+def test_pivot_point_series_leaves_gaps_empty(series_parquet):
+    df = pivot_point_series(series_parquet, points=['3', '10'])
+    assert list(df.columns) == ['10', '3']
+    assert len(df) == 3
+    # No fake zero readings where a point has no value
+    assert df['10'].isna().sum() == 1 and df['3'].isna().sum() == 2
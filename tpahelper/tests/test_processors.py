@@ -0,0 +1,79 @@
+import gzip
+import json
+import math
+import sys
+import time
+
+import pyarrow.parquet as pq
+import pytest
+
+from tpahelper.utils.point_values import PointValueWriter
+from tpahelper.utils.processors import DNP3Processor, collect_fields, tshark_json_generator
+
+PACKET = {'_source': {'layers': {
+    'frame': {'frame.time': 'Nov 14, 2023 22:13:20.000000000 UTC', 'frame.time_epoch': '1700000000.123456789'},
+    'dnp3': {'Application Layer': {'RESPONSE Data Objects': {
+        'Object 0': {'Point Numbers': {
+            'Point Number 3': {'dnp3.al.index': '3', 'dnp3.al.ana.int': '42'},
+            'Point Number 7': {'dnp3.al.index': '7', 'dnp3.al.ana.int': 'n/a'},
+        }},
+        'Object 1': {'Point Numbers': {
+            'Point Number 9': {'dnp3.al.index': '9', 'dnp3.al.anaout.double': '-1.5'},
+        }},
+    }}},
+}}}
+
+
+def test_collect_fields_in_document_order():
+    found = collect_fields({'a': 1, 'b': {'a': 2, 'c': [{'a': 3}]}, 'd': {'a': 4}}, ['a', 'c'])
+    assert found == {'a': [1, 2, 3, 4], 'c': [[{'a': 3}]]}
+
+
+def test_add_packet_values(tmp_path):
+    processor = DNP3Processor(None, str(tmp_path))
+    values_parquet = str(tmp_path / "points.parquet")
+    with PointValueWriter(values_parquet, processor.target_points) as writer:
+        processor.add_packet_values(writer, PACKET)
+        # Packets without a timestamp give no values
+        processor.add_packet_values(writer, {'dnp3.al.index': '1', 'dnp3.al.ana.int': '5'})
+
+    table = pq.read_table(values_parquet)
+    assert table['time'].cast('int64').to_pylist() == [1700000000123456789] * 3
+    assert table['type'].cast('string').to_pylist() == ['dnp3.al.ana.int', 'dnp3.al.ana.int',
+                                                        'dnp3.al.anaout.double']
+    # Values pair with the point indexes in order, non numeric ones are NaN
+    index, value = table['index'].to_pylist(), table['value'].to_pylist()
+    assert index[:2] == [3, 7] and value[0] == 42.0 and math.isnan(value[1])
+
+
+def fake_tshark(packets, exit_code=0):
+    """A command printing packets as tshark -T json does."""
+    script = f"import json, sys; print(json.dumps({packets!r}, indent=2)); sys.stderr.write('oops'); sys.exit({exit_code})"
+    return [sys.executable, '-c', script]
+
+
+@pytest.mark.parametrize('tee_name', [None, 'dnp3.json', 'dnp3.json.gz'])
+def test_tshark_json_generator(tmp_path, tee_name):
+    packets = [{'_source': {'layers': {'frame': {'frame.number': str(i)}}}} for i in range(3)]
+    tee_json = str(tmp_path / tee_name) if tee_name else None
+    assert list(tshark_json_generator(fake_tshark(packets), tee_json)) == packets
+    if tee_json:
+        with gzip.open(tee_json) if tee_json.endswith('.gz') else open(tee_json) as tee_file:
+            assert json.load(tee_file) == packets
+
+
+def test_tshark_json_generator_reports_failures(capsys):
+    assert list(tshark_json_generator(fake_tshark([], exit_code=2))) == []
+    assert 'oops' in capsys.readouterr().out
+
+
+def test_tshark_json_generator_stops_early(capsys):
+    # More output than one read of the parser, then tshark hangs
+    command = [sys.executable, '-c', "import time; print('[' + '{\"a\": 1},' * 100_000, flush=True); time.sleep(30)"]
+    packets = tshark_json_generator(command)
+    start = time.monotonic()
+    assert next(packets) == {'a': 1}
+    # Closing the generator kills tshark instead of waiting for it
+    packets.close()
+    assert time.monotonic() - start < 10
+    assert 'Error' not in capsys.readouterr().out
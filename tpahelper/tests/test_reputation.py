@@ -0,0 +1,106 @@
+import json
+import os
+
+import pyarrow.parquet as pq
+
+from tpahelper.utils.cache import register_capture
+from tpahelper.utils.manual_summarize_otx import capture_digest, summarize_otx
+from tpahelper.utils.reputation import ReputationWriter, compact_reputation, flatten_response, read_reputation
+
+RESPONSE = {
+    'indicator': '8.8.8.8', 'type': 'IPv4', 'reputation': 0, 'asn': 'AS15169 google llc',
+    'pulse_info': {'count': 2, 'pulses': [
+        {'id': 'p1', 'name': 'first', 'author': {'username': 'someone'}, 'tags': ['dns', None],
+         'malware_families': [{'id': 'm', 'display_name': 'Miner'}], 'indicator_count': '12'},
+        {'id': 'p2', 'name': 'second', 'attack_ids': [{'id': 'T1071'}]},
+    ]},
+}
+FAILURE = {'error': 'Failed to fetch data', 'indicator': '9.9.9.9'}
+
+
+def failure(indicator):
+    return {**FAILURE, 'indicator': indicator}
+
+
+def test_flatten_response_gives_a_row_per_pulse():
+    rows = flatten_response('8.8.8.8', 'ipv4', RESPONSE)
+    assert [row['pulse.id'] for row in rows] == ['p1', 'p2']
+    assert rows[0]['pulse.author'] == 'someone'
+    assert rows[0]['pulse.tags'] == ['dns']
+    assert rows[0]['pulse.malware_families'] == ['Miner']
+    assert rows[0]['pulse.indicator_count'] == 12
+    assert rows[1]['pulse.attack_ids'] == ['T1071']
+    assert all(row['source'] == 'otx' and row['asn'] == 'AS15169 google llc' for row in rows)
+
+
+def test_flatten_response_without_pulses():
+    rows = flatten_response('9.9.9.9', 'ipv4', FAILURE)
+    assert len(rows) == 1
+    assert (rows[0]['indicator'], rows[0]['error'], rows[0]['pulse.id']) == ('9.9.9.9', FAILURE['error'], None)
+
+
+def test_writer_resumes_from_its_parts(tmp_path):
+    reputation = tmp_path / 'ip_reputation.parquet'
+    with ReputationWriter(reputation, flush_rows=1) as writer:
+        writer.add('8.8.8.8', 'ipv4', RESPONSE)
+        writer.add('9.9.9.9', 'ipv4', FAILURE)
+        # Adding a done indicator again is a no-op
+        writer.add('8.8.8.8', 'ipv4', RESPONSE)
+    assert read_reputation(reputation).num_rows == 3
+
+    with ReputationWriter(reputation) as writer:
+        # The failure is written, but retried
+        assert writer.done == {('8.8.8.8', 'ipv4')}
+        writer.add('9.9.9.9', 'ipv4', {'indicator': '9.9.9.9', 'pulse_info': {'count': 0}})
+        assert ('9.9.9.9', 'ipv4') in writer.done
+
+
+def test_compact_drops_superseded_failures(tmp_path):
+    reputation = tmp_path / 'ip_reputation.parquet'
+    for data in (FAILURE, FAILURE, {'indicator': '9.9.9.9', 'pulse_info': {'count': 0}}):
+        with ReputationWriter(reputation) as writer:
+            writer.add('9.9.9.9', 'ipv4', data)
+    with ReputationWriter(reputation) as writer:
+        writer.add('1.1.1.1', 'ipv4', failure('1.1.1.1'))
+        writer.add('1.1.1.1', 'ipv4', failure('1.1.1.1'))
+
+    table = compact_reputation(reputation)
+    rows = table.select(['indicator', 'error']).to_pylist()
+    assert rows == [{'indicator': '1.1.1.1', 'error': FAILURE['error']}, {'indicator': '9.9.9.9', 'error': None}]
+    assert len(list(reputation.iterdir())) == 1
+    assert pq.read_table(reputation).num_rows == 2
+
+
+def test_interrupted_compaction_keeps_the_checkpoint(tmp_path):
+    reputation = tmp_path / 'ip_reputation.parquet'
+    with ReputationWriter(reputation) as writer:
+        writer.add('8.8.8.8', 'ipv4', RESPONSE)
+    # Killed after moving the dataset aside, before moving the compacted copy in
+    os.replace(reputation, f"{reputation}.old")
+    os.makedirs(f"{reputation}.tmp")
+
+    with ReputationWriter(reputation) as writer:
+        assert writer.done == {('8.8.8.8', 'ipv4')}
+    assert compact_reputation(reputation).num_rows == 2
+    assert not os.path.exists(f"{reputation}.old")
+    assert not os.path.exists(f"{reputation}.tmp")
+
+
+def test_manual_summary_finds_the_capture_results(tmp_path):
+    output_dir = tmp_path / 'processed'
+    pcap_file = tmp_path / 'eth_miner.pcap'
+    pcap_file.write_bytes(b'capture')
+    digest = register_capture(str(pcap_file), str(output_dir))
+    raw_dir = output_dir / digest / 'indicators' / 'raw'
+    raw_dir.mkdir(parents=True)
+    (raw_dir / 'otx_ipv4_8.8.8.8.json').write_text(json.dumps(RESPONSE))
+
+    # By path, or by the name it was uploaded under
+    assert capture_digest(str(pcap_file), str(output_dir)) == digest
+    assert capture_digest('eth_miner.pcap', str(output_dir)) == digest
+    assert capture_digest('other.pcap', str(output_dir)) is None
+
+    summarize_otx(str(output_dir / digest / 'indicators'))
+    summary = read_reputation(str(output_dir / digest / 'indicators' / 'ip_reputation.parquet'))
+    assert summary.column('pulse.id').to_pylist() == ['p1', 'p2']
+    assert (output_dir / digest / 'indicators' / 'ip_reputation.html').exists()
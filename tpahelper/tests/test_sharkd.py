@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pytest
+
+from tpahelper.utils.sharkd import SharkdError, SharkdPool
+
+
+@pytest.fixture
+def captures(tmp_path):
+    paths = []
+    for name in ('a.pcap', 'b.pcap', 'c.pcap'):
+        (tmp_path / name).write_bytes(b'')
+        paths.append(str(tmp_path / name))
+    return paths
+
+
+def test_sessions_are_cached_per_capture(fake_sharkd, captures, tmp_path):
+    with SharkdPool(max_sessions=2, socket_dir=str(tmp_path / 'sockets'), sharkd=fake_sharkd) as pool:
+        first = pool.status(captures[0])
+        assert first['method'] == 'status'
+        assert pool.frames(captures[0], filter='modbus', limit=5)['params'] == {
+            'skip': 0, 'limit': 5, 'filter': 'modbus'}
+        pool.status(captures[1])
+        # A third capture evicts the least recently used session
+        pool.status(captures[2])
+        assert len(pool._sessions) == 2
+        with pytest.raises(SharkdError):
+            pool.status(str(tmp_path / 'missing.pcap'))
+    with pytest.raises(SharkdError):
+        pool.status(captures[0])
+
+
+def test_starting_a_daemon_does_not_block_other_sessions(fake_sharkd, captures, tmp_path, monkeypatch):
+    monkeypatch.setenv('SHARKD_SLOW_START', 'sharkd-1.sock')
+    with SharkdPool(workers=2, socket_dir=str(tmp_path / 'sockets'), sharkd=fake_sharkd) as pool:
+        # Daemon 0 serves the first capture, the second one waits for daemon 1 to start
+        pool.status(captures[0])
+        starting = threading.Thread(target=pool.status, args=(captures[1],))
+        starting.start()
+        time.sleep(0.2)
+        start = time.monotonic()
+        pool.status(captures[0])
+        assert time.monotonic() - start < 0.5
+        starting.join()
+
+
+def test_closing_waits_for_busy_sessions_outside_the_pool_lock(fake_sharkd, captures, tmp_path):
+    pool = SharkdPool(socket_dir=str(tmp_path / 'sockets'), sharkd=fake_sharkd)
+    pool.status(captures[0])
+    results = []
+    busy = threading.Thread(target=lambda: results.append(pool.frames(captures[0], filter='slow')))
+    busy.start()
+    time.sleep(0.1)
+    closing = threading.Thread(target=pool.close)
+    closing.start()
+    time.sleep(0.1)
+    # close() waits for the request in flight, without holding the pool lock
+    assert closing.is_alive()
+    assert pool._lock.acquire(timeout=0.1)
+    pool._lock.release()
+    busy.join()
+    closing.join()
+    assert results[0]['params']['filter'] == 'slow'
@@ -0,0 +1,83 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from tpahelper.utils.string_templates import MAX_MEMBERS, cluster_templates, collapse_strings, normalize, \
+    normalize_array
+from tpahelper.utils.strings import strings_schema
+
+SAMPLES = [
+    'connected at 2024-01-02T10:11:12.5Z from 10.1.2.3',
+    'session 3f2b8a1c-1d2e-4f5a-9b8c-0123456789ab opened',
+    'device 00:1a:2b:3c:4d:5e mode 0x1F',
+    'checksum deadbeef12 len -42 ratio 0.75',
+    'uptime 12:30:01 since 2024/01/02',
+]
+
+
+def test_normalize():
+    assert [normalize(value) for value in SAMPLES] == [
+        'connected at <TS> from <IP>',
+        'session <UUID> opened',
+        'device <MAC> mode <HEX>',
+        'checksum <HEX> len <NUM> ratio <NUM>',
+        'uptime <TS> since <TS>',
+    ]
+    # Arrow and Python normalization agree
+    assert normalize_array(pa.array(SAMPLES)).to_pylist() == [normalize(value) for value in SAMPLES]
+
+
+def test_cluster_templates():
+    templates = ['temperature sensor <NUM> reading <NUM> degrees',
+                 'temperature sensor <NUM> reading <NUM> degrees!',
+                 'login failed for user admin']
+    clusters = cluster_templates(templates)
+    assert clusters[0] == clusters[1] != clusters[2]
+
+
+def write_strings(path, rows, row_group_size=None):
+    values, packets = zip(*rows)
+    table = pa.table({'string': pa.array(values).dictionary_encode(), 'packet': pa.array(packets, pa.uint32()),
+                      'offset': pa.array([0] * len(rows), pa.uint32()),
+                      'file_offset': pa.array([0] * len(rows), pa.uint64())}, schema=strings_schema)
+    pq.write_table(table, path, row_group_size=row_group_size)
+
+
+def test_collapse_strings(tmp_path):
+    strings_parquet = str(tmp_path / 'strings.parquet')
+    templates_parquet = str(tmp_path / 'templates.parquet')
+    rows = [('request 7 failed', 9), ('login failed for user admin', 2), ('request 12 failed', 5),
+            ('request 7 failed', 11), ('login failed for user admin', 4), ('request 3 failed', 8)]
+    # Small row groups, so counts are merged across batches
+    write_strings(strings_parquet, rows, row_group_size=2)
+    assert collapse_strings(strings_parquet, templates_parquet) == 2
+
+    table = pq.read_table(templates_parquet).to_pylist()
+    assert table == [
+        {'rank': 1, 'count': 4, 'template': 'request <NUM> failed', 'templates': 1, 'example': 'request 12 failed',
+         'first_packet': 5, 'members': ['request <NUM> failed']},
+        {'rank': 2, 'count': 2, 'template': 'login failed for user admin', 'templates': 1,
+         'example': 'login failed for user admin', 'first_packet': 2, 'members': ['login failed for user admin']},
+    ]
+
+
+def test_collapse_strings_merges_similar_templates(tmp_path):
+    strings_parquet = str(tmp_path / 'strings.parquet')
+    templates_parquet = str(tmp_path / 'templates.parquet')
+    # Near-identical lines differing in a word, not a variable token
+    rows = [(f'temperature sensor 5 reading 20 degrees {unit}', i) for i, unit in
+            enumerate(['celsius'] * 3 + ['celsiuz'] * 2)]
+    rows += [(f'pump station {name} alarm raised now', 10 + i) for i, name in enumerate('abcdefghijklmnopqrstuvwxy')]
+    write_strings(strings_parquet, rows)
+    assert collapse_strings(strings_parquet, templates_parquet) == 2
+
+    table = pq.read_table(templates_parquet).to_pylist()
+    assert [(row['count'], row['templates'], row['first_packet']) for row in table] == [(25, 25, 10), (5, 2, 0)]
+    assert len(table[0]['members']) == MAX_MEMBERS
+    assert table[1]['template'] == 'temperature sensor <NUM> reading <NUM> degrees celsius'
+
+
+def test_collapse_no_strings(tmp_path):
+    strings_parquet = str(tmp_path / 'strings.parquet')
+    pq.write_table(strings_schema.empty_table(), strings_parquet)
+    assert collapse_strings(strings_parquet, str(tmp_path / 'templates.parquet')) == 0
+    assert pq.read_table(tmp_path / 'templates.parquet').num_rows == 0
@@ -0,0 +1,74 @@
+import pyarrow.parquet as pq
+import pytest
+
+from tpahelper.tests.test_pcap import pcapng
+from tpahelper.utils import strings
+from tpahelper.utils.pcap import PcapWriter
+from tpahelper.utils.strings import extract_strings
+
+PACKETS = [
+    b'\x00\x01GET /index.html HTTP/1.1\x00aaaaaaaa\x0012345678\x00xyz\x00bcdfg\x00',
+    b'\x02\x03\x04Hello',
+    b'World\xff\x00 and again: Hello',
+]
+
+
+def read_results(tmp_path):
+    values = (tmp_path / 'strings.txt').read_text().splitlines()
+    table = pq.read_table(tmp_path / 'strings.parquet')
+    occurrences = list(zip(table['string'].cast('string').to_pylist(), table['packet'].to_pylist(),
+                           table['offset'].to_pylist(), table['file_offset'].to_pylist()))
+    return values, occurrences
+
+
+def extract(tmp_path, pcap_file, min_length=4):
+    return extract_strings(pcap_file, str(tmp_path / 'strings.txt'), str(tmp_path / 'strings.parquet'), min_length)
+
+
+@pytest.mark.parametrize('chunk_size', [strings.CHUNK_SIZE, 1])
+def test_extract_strings(tmp_path, monkeypatch, chunk_size):
+    # A chunk size below one packet takes a packet at a time
+    monkeypatch.setattr(strings, 'CHUNK_SIZE', chunk_size)
+    pcap_file = str(tmp_path / 'capture.pcap')
+    with PcapWriter(pcap_file, 1) as writer:
+        for i, data in enumerate(PACKETS):
+            writer.write(i, data)
+    assert extract(tmp_path, pcap_file) == 4
+
+    values, occurrences = read_results(tmp_path)
+    # Repeated characters, digits only, short runs and runs without a vowel are
+    # dropped, and runs never continue into the next packet
+    assert values == ['GET /index.html HTTP/1.1', 'Hello', 'World', ' and again: Hello']
+    assert [(value, packet, offset) for value, packet, offset, _ in occurrences] == [
+        ('GET /index.html HTTP/1.1', 1, 2), ('Hello', 2, 3), ('World', 3, 0), (' and again: Hello', 3, 7)]
+    data = open(pcap_file, 'rb').read()
+    assert all(data[file_offset:file_offset + len(value)] == value.encode()
+               for value, _, _, file_offset in occurrences)
+
+
+def test_extract_strings_min_length(tmp_path):
+    pcap_file = str(tmp_path / 'capture.pcap')
+    with PcapWriter(pcap_file, 1) as writer:
+        writer.write(0, b'\x00abc\x00Hello\x00')
+    assert extract(tmp_path, pcap_file, min_length=3) == 2
+    assert extract(tmp_path, pcap_file, min_length=6) == 0
+    assert read_results(tmp_path) == ([], [])
+
+
+def test_extract_strings_pcapng(tmp_path):
+    pcap_file = tmp_path / 'capture.pcapng'
+    pcap_file.write_bytes(pcapng([(i, data) for i, data in enumerate(PACKETS)]))
+    assert extract(tmp_path, str(pcap_file)) == 4
+    values, occurrences = read_results(tmp_path)
+    data = pcap_file.read_bytes()
+    assert [packet for _, packet, _, _ in occurrences] == [1, 2, 3, 3]
+    assert all(data[file_offset:file_offset + len(value)] == value.encode()
+               for value, _, _, file_offset in occurrences)
+
+
+def test_extract_strings_empty_capture(tmp_path):
+    pcap_file = str(tmp_path / 'capture.pcap')
+    with PcapWriter(pcap_file, 1):
+        pass
+    assert extract(tmp_path, pcap_file) == 0
+    assert read_results(tmp_path) == ([], [])
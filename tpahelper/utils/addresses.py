@@ -0,0 +1,210 @@
+# Vectorized public address classification.
+# Addresses are taken in the packed 16 byte form of the flow table (IPv4
+# stored IPv4-mapped), IPv4 as uint32 and IPv6 as (high, low) uint64 pairs,
+# and looked up with np.searchsorted in sorted tables of the merged
+# non-public ranges. No address is parsed or turned into an ipaddress object.
+#
+# Non-public covers the IANA special-purpose registries: private, shared
+# (CGN), loopback, link local, documentation, benchmarking, multicast and
+# reserved space, and for IPv6 everything outside global unicast 2000::/3.
+# The registry entries marked globally reachable inside those blocks (e.g.
+# 192.0.0.9/32, 2001:3::/32, the NAT64 prefix) are cut out of them again.
+# 6to4 (2002::/16) is public: the addresses embed the site's public IPv4.
+
+import ipaddress
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from tpahelper.utils.flows import address_columns, pack_addresses
+
+non_public_ipv4 = [
+    '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8', '169.254.0.0/16', '172.16.0.0/12',
+    '192.0.0.0/24', '192.0.2.0/24', '192.168.0.0/16', '198.18.0.0/15', '198.51.100.0/24',
+    '203.0.113.0/24', '224.0.0.0/4', '240.0.0.0/4',
+]
+non_public_ipv6 = [
+    '::/3', '4000::/2', '8000::/1',
+    '2001::/23', '2001:db8::/32', '3fff::/20',
+]
+public_ipv4_exceptions = ['192.0.0.9/32', '192.0.0.10/32']
+public_ipv6_exceptions = [
+    '64:ff9b::/96', '2001:1::1/128', '2001:1::2/128', '2001:1::3/128', '2001:3::/32', '2001:4:112::/48',
+    '2001:20::/28', '2001:30::/28',
+]
+
+public_ips_schema = pa.schema([
+    ('ip', pa.string()),
+    ('version', pa.uint8()),
+    ('ip_bytes', pa.binary(16)),
+])
+
+_MAPPED_PREFIX = 0xffff
+_hextet_text = pa.array([format(i, 'x') for i in range(1 << 16)], type=pa.string())
+
+
+def _merged_ranges(networks: list) -> list:
+    # Sorted, merged (first, last) address pairs of the networks
+    ranges = sorted((int(n.network_address), int(n.broadcast_address))
+                    for n in map(ipaddress.ip_network, networks))
+    merged = [list(ranges[0])]
+    for first, last in ranges[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
+
+
+def _range_table(networks: list, exceptions: list = ()) -> list:
+    # Sorted, disjoint (first, last) address pairs of the networks, less the exceptions
+    ranges = _merged_ranges(networks)
+    for cut_first, cut_last in (_merged_ranges(exceptions) if exceptions else []):
+        kept = []
+        for first, last in ranges:
+            if first < cut_first:
+                kept.append([first, min(last, cut_first - 1)])
+            if last > cut_last:
+                kept.append([max(first, cut_last + 1), last])
+        ranges = kept
+    return ranges
+
+
+def _ipv4_table(networks: list, exceptions: list = ()):
+    merged = np.array(_range_table(networks, exceptions), dtype=np.uint32)
+    return merged[:, 0], merged[:, 1]
+
+
+def _ipv6_table(networks: list, exceptions: list = ()):
+    merged = _range_table(networks, exceptions)
+    return tuple(np.array([value >> shift & 0xffff_ffff_ffff_ffff for value in column], dtype=np.uint64)
+                 for column in zip(*merged) for shift in (64, 0))
+
+
+_ipv4_starts, _ipv4_ends = _ipv4_table(non_public_ipv4, public_ipv4_exceptions)
+_ipv6_starts_hi, _ipv6_starts_lo, _ipv6_ends_hi, _ipv6_ends_lo = _ipv6_table(non_public_ipv6, public_ipv6_exceptions)
+
+
+def in_ipv4_ranges(addresses: np.ndarray, starts: np.ndarray = _ipv4_starts, ends: np.ndarray = _ipv4_ends) -> np.ndarray:
+    """True for the uint32 addresses inside one of the sorted, disjoint [start, end] ranges."""
+    k = np.searchsorted(starts, addresses, side='right') - 1
+    return (k >= 0) & (addresses <= ends[np.maximum(k, 0)])
+
+
+def searchsorted_pairs(starts_hi: np.ndarray, starts_lo: np.ndarray, hi: np.ndarray, lo: np.ndarray) -> np.ndarray:
+    """
+    Index of the last of the sorted, distinct 128-bit (starts_hi, starts_lo)
+    values at or below each (hi, lo) value, -1 below the first one.
+    """
+    # Starts and values are merged in one sort, starts ahead of equal values;
+    # the starts sorted before a value are the ones at or below it
+    is_value = np.r_[np.zeros(len(starts_hi), dtype=bool), np.ones(len(hi), dtype=bool)]
+    order = np.lexsort((is_value, np.r_[starts_lo, lo], np.r_[starts_hi, hi]))
+    starts_before = np.cumsum(~is_value[order])
+    k = np.empty(len(hi), dtype=np.int64)
+    k[order[is_value[order]] - len(starts_hi)] = starts_before[is_value[order]] - 1
+    return k
+
+
+def in_ipv6_ranges(hi: np.ndarray, lo: np.ndarray, starts_hi: np.ndarray = _ipv6_starts_hi,
+                   starts_lo: np.ndarray = _ipv6_starts_lo, ends_hi: np.ndarray = _ipv6_ends_hi,
+                   ends_lo: np.ndarray = _ipv6_ends_lo) -> np.ndarray:
+    """True for the 128-bit (hi, lo) addresses inside one of the sorted, disjoint ranges."""
+    k = searchsorted_pairs(starts_hi, starts_lo, hi, lo)
+    safe = np.maximum(k, 0)
+    return (k >= 0) & ((hi < ends_hi[safe]) | ((hi == ends_hi[safe]) & (lo <= ends_lo[safe])))
+
+
+def split_packed(ip_bytes: pa.Array):
+    """
+    (high, low) uint64 halves of a non-null binary(16) array of packed
+    addresses, and whether each one is IPv4-mapped.
+    """
+    halves = np.frombuffer(ip_bytes.buffers()[1], dtype='>u8', count=2 * len(ip_bytes),
+                           offset=ip_bytes.offset * 16).reshape(-1, 2).astype(np.uint64)
+    hi, lo = halves[:, 0], halves[:, 1]
+    return hi, lo, (hi == 0) & (lo >> np.uint64(32) == _MAPPED_PREFIX)
+
+
+def is_public(ip_bytes: pa.Array) -> np.ndarray:
+    """True for the globally routable addresses of a non-null binary(16) array of packed addresses."""
+    hi, lo, ipv4 = split_packed(ip_bytes)
+    public = np.empty(len(ip_bytes), dtype=bool)
+    public[ipv4] = ~in_ipv4_ranges((lo[ipv4] & np.uint64(0xffff_ffff)).astype(np.uint32))
+    public[~ipv4] = ~in_ipv6_ranges(hi[~ipv4], lo[~ipv4])
+    return public
+
+
+def _format_ipv6(hi: np.ndarray, lo: np.ndarray) -> pa.Array:
+    # RFC 5952 text: hextets without leading zeros, the leftmost longest run
+    # of two or more zero hextets shortened to '::'
+    hextets = np.stack([(half >> np.uint64(shift)) & np.uint64(0xffff)
+                        for half in (hi, lo) for shift in (48, 32, 16, 0)], axis=1).astype(np.int64)
+    runs = np.zeros(hextets.shape, dtype=np.int64)
+    for j in range(8):
+        runs[:, j] = (runs[:, j - 1] + 1 if j else 1) * (hextets[:, j] == 0)
+    length = runs.max(axis=1)
+    end = runs.argmax(axis=1)
+    start = np.where(length >= 2, end - length + 1, 8)
+    end = np.where(length >= 2, end, -1)
+    # The first hextet of the run becomes an empty piece (':' at an edge), the
+    # rest are skipped, so joining the pieces with ':' gives the '::'
+    marker = np.where((start == 0) & (end == 7), '::', np.where((start == 0) | (end == 7), ':', ''))
+    pieces = []
+    for j in range(8):
+        text = _hextet_text.take(pa.array(hextets[:, j]))
+        text = pc.if_else(pa.array(start == j), pa.array(marker), text)
+        pieces.append(pc.if_else(pa.array((start < j) & (j <= end)), pa.scalar(None, pa.string()), text))
+    return pc.binary_join_element_wise(*pieces, ':', null_handling='skip')
+
+
+def format_addresses(ip_bytes: pa.Array) -> pa.Array:
+    """Text form of a non-null binary(16) array of packed addresses, as ipaddress would print them."""
+    hi, lo, ipv4 = split_packed(ip_bytes)
+    ipv4_rows = np.flatnonzero(ipv4)
+    ipv6_rows = np.flatnonzero(~ipv4)
+    octets = [pa.array((lo[ipv4_rows] >> np.uint64(shift) & np.uint64(0xff)).astype(np.uint8)).cast(pa.string())
+              for shift in (24, 16, 8, 0)]
+    ipv4_text = pc.binary_join_element_wise(*octets, '.')
+    ipv6_text = _format_ipv6(hi[ipv6_rows], lo[ipv6_rows])
+    positions = np.empty(len(ip_bytes), dtype=np.int64)
+    positions[ipv4_rows] = np.arange(len(ipv4_rows))
+    positions[ipv6_rows] = len(ipv4_rows) + np.arange(len(ipv6_rows))
+    return pa.concat_arrays([ipv4_text, ipv6_text]).take(pa.array(positions))
+
+
+def address_column(flows_parquet, name_col: str) -> pa.ChunkedArray:
+    """The packed addresses of one side of the flows in flows_parquet, null where missing."""
+    columns = pq.read_schema(flows_parquet).names
+    bytes_col = address_columns[name_col]
+    if bytes_col in columns:
+        return pq.read_table(flows_parquet, columns=[bytes_col])[bytes_col]
+    if name_col in columns:
+        # Flow tables written before the packed columns existed
+        names = pq.read_table(flows_parquet, columns=[name_col])[name_col].to_pandas()
+        return pa.chunked_array([pa.array(pack_addresses(names), type=pa.binary(16))])
+    return pa.chunked_array([], type=pa.binary(16))
+
+
+def distinct_addresses(flows_parquet) -> pa.Array:
+    """The distinct packed addresses seen on either side of the flows in flows_parquet."""
+    chunks = [chunk for name_col in address_columns for chunk in address_column(flows_parquet, name_col).chunks]
+    return pc.unique(pa.chunked_array(chunks, type=pa.binary(16))).drop_null()
+
+
+def public_addresses(flows_parquet, output_parquet) -> pa.Table:
+    """
+    Writes the distinct public addresses seen on either side of the flows in
+    flows_parquet to output_parquet, sorted by address, and returns them.
+    """
+    unique = distinct_addresses(flows_parquet)
+    public = unique.filter(pa.array(is_public(unique)))
+    hi, lo, ipv4 = split_packed(public)
+    order = np.lexsort((lo, hi))
+    public = public.take(pa.array(order))
+    result = pa.Table.from_arrays([format_addresses(public), pa.array(np.where(ipv4[order], 4, 6).astype(np.uint8)),
+                                   public], schema=public_ips_schema)
+    pq.write_table(result, output_parquet)
+    return result
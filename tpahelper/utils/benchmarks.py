@@ -0,0 +1,547 @@
+# Benchmarks for the hot paths of the analysis pipeline.
+# Each benchmark builds its own synthetic input, so no capture is required.
+#
+# Usage:
+#   python -m tpahelper.utils.benchmarks <benchmark> [sizes...]
+#   python -m tpahelper.utils.benchmarks flatten 100000 1000000
+#   python -m tpahelper.utils.benchmarks schema
+#   python -m tpahelper.utils.benchmarks strings 100000
+#   python -m tpahelper.utils.benchmarks templates 1000000
+#   python -m tpahelper.utils.benchmarks dnp3 1000000
+#   python -m tpahelper.utils.benchmarks otx 10000
+#   python -m tpahelper.utils.benchmarks addresses 10000000
+#   python -m tpahelper.utils.benchmarks blocklists 10000000
+
+import asyncio
+import ipaddress
+import json
+import os
+import random
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import dpath
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import requests
+from aiohttp import web
+from tabulate import tabulate
+
+from tpahelper.utils.addresses import format_addresses, is_public, public_addresses
+from tpahelper.utils.blocklists import load_blocklists, match_blocklists
+from tpahelper.utils.flows import (
+    expand_dict_column,
+    explode_columns,
+    renamed_columns,
+    stream_flows_to_parquet
+)
+from tpahelper.utils.otx import indicator_url, query_indicators
+from tpahelper.utils.pcap import PcapReader, PcapWriter
+from tpahelper.utils.point_values import PointValueWriter
+from tpahelper.utils.processors import DNP3Processor
+from tpahelper.utils.string_templates import collapse_strings
+from tpahelper.utils.strings import extract_strings, strings_schema
+
+
+def synthetic_flow_records(n: int, seed: int = 0):
+    """Generator of flow records shaped like the raw ndpiReader json lines output."""
+    rng = random.Random(seed)
+    for i in range(n):
+        record = {
+            'src_name': f"10.0.{rng.randint(0, 15)}.{rng.randint(1, 254)}",
+            'dst_name': rng.choice(['8.8.8.8', '192.168.1.5', '2001:4860::8888', '93.184.216.34']),
+            'src_port': rng.randint(1024, 65535),
+            'dst_port': rng.choice([53, 80, 443, 502, 20000]),
+            'proto': rng.choice(['TCP', 'UDP']),
+            'l7_protocol_name': rng.choice(['DNS', 'HTTP', 'TLS', 'DNP3', 'Modbus']),
+            'first_seen': 1700000000000 + i,
+            'last_seen': 1700000000000 + i + rng.randint(0, 60000),
+            'xfer': {'src2dst_packets': rng.randint(1, 100), 'dst2src_packets': rng.randint(0, 100),
+                     'src2dst_bytes': rng.randint(60, 10 ** 6), 'dst2src_bytes': rng.randint(0, 10 ** 6)},
+            'iat': {'flow_min': rng.randint(0, 10), 'flow_avg': rng.random() * 100,
+                    'flow_max': rng.randint(100, 1000), 'flow_stddev': rng.random() * 10},
+            'pktlen': {'c_to_s_min': 60, 'c_to_s_avg': rng.random() * 1500,
+                       'c_to_s_max': 1514, 'c_to_s_stddev': rng.random() * 100},
+            'tcp_flags': {'cwr_count': 0, 'ece_count': 0, 'urg_count': 0, 'ack_count': rng.randint(0, 50),
+                          'psh_count': rng.randint(0, 50), 'rst_count': 0, 'syn_count': rng.randint(0, 2),
+                          'fin_count': rng.randint(0, 2)},
+        }
+        if rng.random() < 0.3:
+            record['host_server_name'] = rng.choice(['example.com', 'dns.google', 'update.vendor.local'])
+        yield record
+
+
+def synthetic_flows(n: int, seed: int = 0) -> pd.DataFrame:
+    """Builds a dataframe shaped like the raw ndpiReader flow output."""
+    return pd.DataFrame(list(synthetic_flow_records(n, seed)))
+
+
+def write_synthetic_flows(flows_file, n: int, seed: int = 0):
+    """Writes synthetic flows to flows_file in the ndpiReader json lines format."""
+    with open(flows_file, 'w') as out_file:
+        for record in synthetic_flow_records(n, seed):
+            out_file.write(json.dumps(record) + "\n")
+
+
+def _apply_series_expand(series: pd.Series, prefix: str) -> pd.DataFrame:
+    # Previous per-row implementation, kept as the benchmark baseline.
+    expanded_df = series.apply(pd.Series)
+    expanded_df.columns = [f"{prefix}_{c}" for c in expanded_df.columns]
+    return expanded_df
+
+
+def _fillna_flow_frame(df: pd.DataFrame) -> pd.DataFrame:
+    # Previous untyped flow table, gaps filled with '-' in object columns.
+    for col in explode_columns:
+        df = df.join(expand_dict_column(df[col], col))
+    df = df.drop(columns=explode_columns).fillna('-').rename(columns=renamed_columns)
+    df["first_seen_utc"] = pd.to_datetime(df["first_seen_ms"], unit="ms", utc=True)
+    df["last_seen_utc"] = pd.to_datetime(df["last_seen_ms"], unit="ms", utc=True)
+    return df
+
+
+def _time(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_flatten(sizes):
+    rows = []
+    for n in sizes:
+        df = synthetic_flows(n)
+        outputs = []
+        for name, expand in (('apply(pd.Series)', _apply_series_expand), ('columnar', expand_dict_column)):
+            elapsed = 0.0
+            expanded = []
+            for col in explode_columns:
+                seconds, result = _time(expand, df[col], col)
+                elapsed += seconds
+                expanded.append(result)
+            outputs.append(expanded)
+            rows.append((n, name, round(elapsed, 3), round(n / elapsed)))
+
+        # Both implementations must agree before the timings mean anything
+        for baseline, columnar in zip(*outputs):
+            pd.testing.assert_frame_equal(columnar, baseline, check_dtype=False)
+
+    print(tabulate(rows, headers=['flows', 'implementation', 'seconds', 'flows/s'], tablefmt='psql'))
+
+
+def bench_schema(sizes):
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            flows_file = os.path.join(tmp, "ndpi_flows.json")
+            write_synthetic_flows(flows_file, n)
+
+            untyped_parquet = os.path.join(tmp, "untyped.parquet")
+            _fillna_flow_frame(pd.read_json(flows_file, lines=True)).to_parquet(untyped_parquet)
+            typed_parquet = os.path.join(tmp, "typed.parquet")
+            stream_flows_to_parquet(flows_file, typed_parquet)
+
+            for name, path in (("fillna('-')", untyped_parquet), ('typed', typed_parquet)):
+                scan_seconds, df = _time(pd.read_parquet, path)
+                rows.append((n, name, round(os.path.getsize(path) / 2 ** 20, 2),
+                             round(df.memory_usage(deep=True).sum() / 2 ** 20, 2), round(scan_seconds, 3)))
+
+    print(tabulate(rows, headers=['flows', 'schema', 'parquet MB', 'memory MB', 'read seconds'], tablefmt='psql'))
+
+
+def write_synthetic_pcap(pcap_file, n: int, seed: int = 0):
+    """Writes n TCP packets mixing text and binary payloads, shaped like a chatty ICS capture."""
+    rng = random.Random(seed)
+    words = [b'status', b'setpoint', b'pump', b'valve', b'alarm', b'temperature', b'GET /api/v1/tags HTTP/1.1']
+    header = bytes(12) + b'\x08\x00' + struct.pack('!BBHHHBBH4s4s', 0x45, 0, 0, 0, 0, 64, 6, 0,
+                                                    bytes([10, 0, 0, 1]), bytes([10, 0, 0, 2]))
+    with PcapWriter(pcap_file, 1) as writer:
+        for i in range(n):
+            payload = rng.randbytes(rng.randint(8, 64))
+            if rng.random() < 0.6:
+                payload += b' '.join(rng.choices(words, k=rng.randint(1, 4))) + b' %d' % rng.randint(0, 10 ** 6)
+            payload += rng.randbytes(rng.randint(0, 32))
+            tcp = struct.pack('!HHIIBBHHH', 40000 + i % 1000, 502, i, 0, 0x50, 0x18, 8192, 0, 0)
+            writer.write(1_700_000_000_000_000_000 + i * 1000, header + tcp + payload)
+
+
+def _regex_strings(pcap_file, min_length: int = 4) -> int:
+    # Per packet regex scan with the same filter, the pure Python baseline.
+    pattern = re.compile(rb'[\t\x20-\x7e]{%d,}' % min_length)
+    seen = set()
+    with PcapReader(pcap_file) as reader:
+        for record in reader:
+            for match in pattern.finditer(record.data):
+                value = match.group().decode('ascii')
+                letters = sum(c.isalpha() for c in value)
+                words = sum(c.isalnum() or c in ' \t.,:;-_/' for c in value)
+                if (words * 5 >= len(value) * 4 and letters >= 3 and any(c in 'aeiouyAEIOUY' for c in value)
+                        and len(set(value)) > 1):
+                    seen.add(value)
+    return len(seen)
+
+
+def bench_strings(sizes):
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            pcap_file = os.path.join(tmp, "strings.pcap")
+            write_synthetic_pcap(pcap_file, n)
+            strings_file = os.path.join(tmp, "strings.txt")
+
+            seconds, unique = _time(extract_strings, pcap_file, strings_file, os.path.join(tmp, "strings.parquet"))
+            rows.append((n, 'numpy', round(seconds, 3), unique))
+            seconds, unique = _time(_regex_strings, pcap_file)
+            rows.append((n, 'python regex', round(seconds, 3), unique))
+
+            if shutil.which('strictstrings'):
+                command = f"strictstrings -q {pcap_file} > {strings_file}.ext"
+                seconds, _ = _time(lambda: subprocess.run(command, shell=True))
+                with open(f"{strings_file}.ext") as infile:
+                    rows.append((n, 'strictstrings', round(seconds, 3), len(set(infile.read().splitlines()))))
+            else:
+                rows.append((n, 'strictstrings', 'not installed', None))
+
+    print(tabulate(rows, headers=['packets', 'extractor', 'seconds', 'unique strings'], tablefmt='psql'))
+
+
+def write_synthetic_strings(strings_parquet, n: int, seed: int = 0):
+    """Writes n string occurrences in the extract_strings format, mostly near-duplicate ICS chatter."""
+    rng = random.Random(seed)
+    tags = ['pump', 'valve', 'status', 'alarm', 'setpoint']
+    values = []
+    for _ in range(n):
+        kind = rng.random()
+        if kind < 0.5:
+            values.append(f"{rng.choice(tags)} value={rng.randint(0, 10 ** 4)} "
+                          f"ts=2024-01-{rng.randint(10, 28)}T{rng.randint(10, 23)}:{rng.randint(10, 59)}:00Z")
+        elif kind < 0.8:
+            values.append(f"GET /api/v1/tags/{rng.choice(tags)}{rng.choice(['', 's', '_x'])} HTTP/1.1")
+        else:
+            values.append(''.join(rng.choices('abcdefghijklmnop ', k=12)))
+    pq.write_table(pa.Table.from_arrays([
+        pa.array(values).dictionary_encode(),
+        pa.array(range(1, n + 1), type=pa.uint32()),
+        pa.array([0] * n, type=pa.uint32()),
+        pa.array([0] * n, type=pa.uint64()),
+    ], schema=strings_schema), strings_parquet, row_group_size=100_000)
+
+
+def bench_templates(sizes):
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            strings_parquet = os.path.join(tmp, "strings.parquet")
+            write_synthetic_strings(strings_parquet, n)
+            seconds, templates = _time(collapse_strings, strings_parquet, os.path.join(tmp, "templates.parquet"))
+            rows.append((n, templates, round(seconds, 3), round(n / seconds)))
+
+    print(tabulate(rows, headers=['strings', 'templates', 'seconds', 'strings/s'], tablefmt='psql'))
+
+
+def synthetic_dnp3_packets(n: int, seed: int = 0):
+    """Generator of packets shaped like the tshark -T json output of a DNP3 capture."""
+    rng = random.Random(seed)
+    processor = DNP3Processor(None, '')
+    for i in range(n):
+        seconds = 1700000000 + i // 100
+        frame_time = time.strftime('%b %d, %Y %H:%M:%S', time.gmtime(seconds)) + f".{i % 100:02d}0000000 UTC"
+        objects = {}
+        for o in range(rng.randint(1, 3)):
+            point_type = rng.choice(processor.target_points)
+            timestamped = rng.random() < 0.3
+            points = {}
+            for index in rng.sample(range(64), rng.randint(1, 8)):
+                point = {'dnp3.al.index': str(index), 'dnp3.al.ana.quality': '0x01'}
+                if timestamped:
+                    point['dnp3.al.timestamp'] = f"{seconds}.{rng.randint(0, 999):03d}"
+                point[point_type] = str(rng.randint(-32768, 32767) if point_type.endswith('int')
+                                        else round(rng.uniform(-1000, 1000), 3))
+                points[f"Point Number {index}"] = point
+            objects[f"Object {o}"] = {'dnp3.al.obj': str(rng.choice([7681, 7682, 7683, 10241])),
+                                      'dnp3.al.objq.range': '0x00', 'Point Numbers': points}
+
+        yield {
+            '_index': 'packets-2023-11-14',
+            '_source': {'layers': {
+                'frame': {'frame.time': frame_time, 'frame.time_utc': frame_time,
+                          'frame.time_epoch': f"{seconds}.{i % 100:02d}0000000",
+                          'frame.number': str(i + 1), 'frame.len': str(rng.randint(60, 292))},
+                'ip': {'ip.src': '10.0.0.2', 'ip.dst': '10.0.0.1', 'ip.proto': '6'},
+                'tcp': {'tcp.srcport': '20000', 'tcp.dstport': str(40000 + i % 1000)},
+                'dnp3': {'Data Link Layer': {'dnp3.start': '0x0564', 'dnp3.len': '68'},
+                         'Application Layer': {'dnp3.al.func': '129',
+                                               'RESPONSE Data Objects': objects}},
+            }},
+        }
+
+
+def _dpath_point_values(packet: dict, target_field: str, custom_timestamp: str = None) -> list:
+    # Previous implementation, one dpath '**' search of the packet per field and target.
+    all_values = []
+    if list(dpath.search(packet, f'**/{target_field}', yielded=True)):
+        time_search = list(dpath.search(packet, '**/frame.time', yielded=True))
+        utc_time_search = list(dpath.search(packet, '**/frame.time_utc', yielded=True))
+        custom_timestamps = []
+        if custom_timestamp:
+            custom_timestamps = [ts for p, ts in dpath.search(packet, f'**/{custom_timestamp}', yielded=True)]
+        point_numbers = [v for p, v in dpath.search(packet, '**/dnp3.al.index', yielded=True)]
+        point_values = [v for p, v in dpath.search(packet, f'**/{target_field}', yielded=True)]
+
+        timestamped = len(custom_timestamps) == len(point_numbers) == len(point_values)
+        for j, (pn, pv) in enumerate(zip(point_numbers, point_values)):
+            all_values.append({
+                'type': target_field,
+                'frame.time': time_search[0][1] if time_search else None,
+                'frame.time_utc': utc_time_search[0][1] if utc_time_search else None,
+                'dnp3.al.timestamp': custom_timestamps[j] if timestamped else None,
+                'al.index': pn,
+                'value': pv
+            })
+    return all_values
+
+
+def _extract_dnp3(processor: DNP3Processor, packets, values_parquet) -> float:
+    # Seconds spent appending the point values of packets to values_parquet
+    elapsed = 0.0
+    with PointValueWriter(values_parquet, processor.target_points) as writer:
+        for packet in packets:
+            start = time.perf_counter()
+            processor.add_packet_values(writer, packet)
+            elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def bench_dnp3(sizes, baseline_packets: int = 2_000):
+    processor = DNP3Processor(None, '')
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        values_parquet = os.path.join(tmp, "dnp3_points.parquet")
+        for n in sizes:
+            # The dpath baseline takes milliseconds per packet, so it runs on a sample
+            # and its values are checked against the single pass extractor on the same packets
+            sample = min(n, baseline_packets)
+            elapsed = 0.0
+            expected = []
+            for packet in synthetic_dnp3_packets(sample):
+                start = time.perf_counter()
+                for target_point in processor.target_points:
+                    expected += _dpath_point_values(packet, target_point, processor.custom_timestamp)
+                elapsed += time.perf_counter() - start
+            rows.append((n, 'dpath **', round(elapsed * n / sample, 3), round(sample / elapsed),
+                         f"extrapolated from {sample}" if sample < n else ''))
+
+            _extract_dnp3(processor, synthetic_dnp3_packets(sample), values_parquet)
+            values = pq.read_table(values_parquet)
+            assert list(zip(values['type'].cast(pa.string()).to_pylist(), values['index'].to_pylist(),
+                            values['value'].to_pylist())) == \
+                [(row['type'], int(row['al.index']), float(row['value'])) for row in expected]
+
+            elapsed = _extract_dnp3(processor, synthetic_dnp3_packets(n), values_parquet)
+            rows.append((n, 'single pass', round(elapsed, 3), round(n / elapsed),
+                         f"{pq.read_metadata(values_parquet).num_rows} values"))
+
+    print(tabulate(rows, headers=['packets', 'extractor', 'seconds', 'packets/s', ''], tablefmt='psql'))
+
+
+@contextmanager
+def otx_stub_server(latency: float = 0.05, error_rate: float = 0.05, seed: int = 0):
+    """
+    Local stand-in for the OTX API on a free port, yielding its base URL.
+    Every request waits `latency` seconds, error_rate of them are answered
+    with 429 or 503 so retries get exercised.
+    """
+    rng = random.Random(seed)
+    stats = {'requests': 0, 'errors': 0}
+
+    async def general(request):
+        stats['requests'] += 1
+        await asyncio.sleep(latency)
+        if rng.random() < error_rate:
+            stats['errors'] += 1
+            return web.Response(status=rng.choice([429, 503]), headers={'Retry-After': '0'})
+        indicator = request.match_info['indicator']
+        return web.json_response({'indicator': indicator, 'type': request.match_info['type'],
+                                  'reputation': 0, 'pulse_info': {'count': 0, 'pulses': []}})
+
+    app = web.Application()
+    app.router.add_get('/api/v1/indicators/{type}/{indicator}/general', general)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app, access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{port}", stats
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def bench_otx(sizes, latency: float = 0.05, concurrency: int = 64):
+    rows = []
+    for n in sizes:
+        indicators = [(f"{(i >> 24) % 223 + 1}.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}", 'ipv4')
+                      for i in range(n)]
+        # One blocking request at a time, as one task per indicator did, on a sample
+        sample = min(n, 100)
+        with otx_stub_server(latency, error_rate=0) as (base_url, _):
+            start = time.perf_counter()
+            for indicator, indicator_type in indicators[:sample]:
+                requests.get(indicator_url(indicator, indicator_type, base_url)).json()
+            elapsed = time.perf_counter() - start
+        rows.append((n, 'sequential **', round(elapsed * n / sample, 3), round(sample / elapsed),
+                     f"extrapolated from {sample}" if sample < n else ''))
+
+        with otx_stub_server(latency) as (base_url, server), tempfile.TemporaryDirectory() as tmp_dir:
+            start = time.perf_counter()
+            stats = query_indicators(indicators, tmp_dir, concurrency=concurrency, rate=0,
+                                     backoff=0.01, base_url=base_url)
+            elapsed = time.perf_counter() - start
+            assert stats['fetched'] == n and len(os.listdir(tmp_dir)) == n
+        rows.append((n, f"async x{concurrency}", round(elapsed, 3), round(n / elapsed),
+                     f"{server['errors']} retried"))
+
+    print(tabulate(rows, headers=['indicators', 'client', 'seconds', 'indicators/s', ''], tablefmt='psql'))
+
+
+def synthetic_packed_addresses(n: int, ipv6_share: float = 0.3, seed: int = 0) -> pa.Array:
+    """n packed binary(16) addresses, IPv4-mapped or IPv6, about half of them in non-public ranges."""
+    rng = np.random.default_rng(seed)
+    packed = np.zeros((n, 16), dtype=np.uint8)
+    ipv6 = rng.random(n) < ipv6_share
+    ipv4 = ~ipv6
+    packed[ipv4, 10:12] = 0xff
+    packed[ipv4, 12:] = rng.integers(0, 256, (ipv4.sum(), 4))
+    # Half the IPv4 addresses private, half the IPv6 ones outside 2000::/3
+    private = ipv4 & (rng.random(n) < 0.5)
+    packed[private, 12] = rng.choice([10, 127, 169, 172, 192, 224], private.sum())
+    packed[ipv6] = rng.integers(0, 256, (ipv6.sum(), 16))
+    packed[ipv6, 0] = np.where(rng.random(ipv6.sum()) < 0.5, 0x20 | packed[ipv6, 0] & 0x1f, packed[ipv6, 0])
+    return pa.FixedSizeBinaryArray.from_buffers(pa.binary(16), n, [None, pa.py_buffer(packed.tobytes())])
+
+
+def _ipaddress_public(address: str) -> bool:
+    # Previous per-address filter, kept as the benchmark baseline.
+    ip = ipaddress.ip_address(address)
+    return not (ip.is_private or ip.is_reserved or ip.is_link_local or ip.is_loopback or ip.is_multicast)
+
+
+def bench_addresses(sizes, baseline_addresses: int = 200_000):
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in sizes:
+            packed = synthetic_packed_addresses(n)
+            names = format_addresses(packed)
+            flows_parquet = os.path.join(tmp, "flows.parquet")
+            order = pa.array(np.random.default_rng(1).permutation(n))
+            pq.write_table(pa.table({'src_name': names.dictionary_encode(),
+                                     'dst_name': names.take(order).dictionary_encode(),
+                                     'src_ip_bytes': packed, 'dst_ip_bytes': packed.take(order)}), flows_parquet)
+
+            # The baseline parses every address with ipaddress, so it runs on a sample
+            sample = names.slice(0, min(n, baseline_addresses)).to_pylist()
+            assert sample == [str(ipaddress.ip_address(a)) for a in sample]
+            seconds, _ = _time(lambda: [a for a in sample if _ipaddress_public(a)])
+            # src and dst were each checked separately
+            seconds *= 2 * n / len(sample)
+            rows.append((n, 'ipaddress **', round(seconds, 3), round(n / seconds),
+                         f"extrapolated from {len(sample)}" if len(sample) < n else ''))
+
+            seconds, table = _time(public_addresses, flows_parquet, os.path.join(tmp, "public_ips.parquet"))
+            assert table.num_rows == len(pc.unique(packed.filter(pa.array(is_public(packed)))))
+            rows.append((n, 'searchsorted', round(seconds, 3), round(n / seconds), f"{table.num_rows} public"))
+
+    print(tabulate(rows, headers=['addresses', 'classifier', 'seconds', 'addresses/s', ''], tablefmt='psql'))
+
+
+def write_synthetic_feeds(blocklist_dir, feeds: int, entries: int, seed: int = 0):
+    # Feeds of IPv4 addresses, about a third of them /16-/32 blocks, and some IPv6 /32-/64 blocks
+    rng = random.Random(seed)
+    os.makedirs(blocklist_dir, exist_ok=True)
+    for feed in range(feeds):
+        with open(os.path.join(blocklist_dir, f"feed{feed}.netset"), 'w') as outfile:
+            outfile.write(f"# synthetic feed {feed}\n")
+            for _ in range(entries):
+                if rng.random() < 0.05:
+                    outfile.write(f"2{rng.randrange(0x1000):03x}:{rng.randrange(0x10000):x}::/{rng.randrange(32, 65)}\n")
+                    continue
+                address = '.'.join(str(rng.randrange(256)) for _ in range(4))
+                outfile.write(f"{address}/{rng.randrange(16, 33)}\n" if rng.random() < 0.3 else f"{address}\n")
+
+
+def _ipaddress_listed(address: str, networks: list) -> list:
+    # Per-address scan of every feed network, as a naive lookup would do it.
+    ip = ipaddress.ip_address(address)
+    return [feed for feed, network in networks if ip.version == network.version and ip in network]
+
+
+def bench_blocklists(sizes, feeds: int = 4, entries: int = 250_000, baseline_addresses: int = 20):
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        blocklist_dir = os.path.join(tmp, "blocklists")
+        index_file = os.path.join(tmp, "blocklist_index.npz")
+        write_synthetic_feeds(blocklist_dir, feeds, entries)
+        seconds, index = _time(load_blocklists, blocklist_dir, index_file)
+        rows.append(('', 'build index', round(seconds, 3), '',
+                     f"{feeds * entries} entries, {len(index.starts_hi)} segments"))
+        seconds, index = _time(load_blocklists, blocklist_dir, index_file)
+        rows.append(('', 'load index', round(seconds, 3), '', f"{os.path.getsize(index_file) // 1024 ** 2} MiB"))
+
+        networks = []
+        for name in index.feeds:
+            with open(os.path.join(blocklist_dir, name)) as infile:
+                networks += [(name, ipaddress.ip_network(line.strip(), strict=False))
+                             for line in infile if not line.startswith('#')]
+        for n in sizes:
+            packed = synthetic_packed_addresses(n)
+            names = format_addresses(packed)
+            flows_parquet = os.path.join(tmp, "flows.parquet")
+            pq.write_table(pa.table({'src_ip_bytes': packed, 'dst_ip_bytes': packed}), flows_parquet)
+
+            # The baseline scans every network for every address, so it runs on a small sample
+            sample = names.slice(0, min(n, baseline_addresses)).to_pylist()
+            seconds, _ = _time(lambda: [_ipaddress_listed(a, networks) for a in sample])
+            seconds *= n / len(sample)
+            rows.append((n, 'network scan **', round(seconds, 3), round(n / seconds),
+                         f"extrapolated from {len(sample)}" if len(sample) < n else ''))
+
+            seconds, table = _time(match_blocklists, flows_parquet, index, os.path.join(tmp, "matches.parquet"))
+            rows.append((n, 'sorted intervals', round(seconds, 3), round(n / seconds), f"{table.num_rows} hits"))
+
+    print(tabulate(rows, headers=['addresses', 'matcher', 'seconds', 'addresses/s', ''], tablefmt='psql'))
+
+
+benchmarks = {
+    'flatten': (bench_flatten, [100_000, 1_000_000]),
+    'schema': (bench_schema, [100_000, 500_000]),
+    'strings': (bench_strings, [100_000, 1_000_000]),
+    'templates': (bench_templates, [100_000, 1_000_000]),
+    'dnp3': (bench_dnp3, [1_000_000]),
+    'otx': (bench_otx, [10_000]),
+    'addresses': (bench_addresses, [1_000_000, 10_000_000]),
+    'blocklists': (bench_blocklists, [1_000_000, 10_000_000]),
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(f"Usage: python -m tpahelper.utils.benchmarks [{'|'.join(benchmarks)}] [sizes...]")
+        sys.exit(1)
+
+    func, default_sizes = benchmarks[sys.argv[1]]
+    func([int(s) for s in sys.argv[2:]] or default_sizes)
@@ -0,0 +1,214 @@
+# Offline blocklist matching.
+# Every file in the blocklist directory is a feed of IP addresses, CIDR
+# blocks or first-last ranges, one per line (the first field of the line, so
+# plain lists, netset/ipset files, Spamhaus DROP style "cidr ; id" lines and
+# CSVs starting with the address all load; comments and headers are skipped).
+#
+# The feeds are compiled into a sorted-interval index over the packed 128-bit
+# address space (IPv4 IPv4-mapped, as in the flow table): the sorted starts of
+# the disjoint segments between all range boundaries, and for every segment a
+# bitmask of the feeds covering it. The index is saved as an uncompressed
+# .npz next to the results and rebuilt only when a feed file changes. Lookups
+# are one np.searchsorted pass over the distinct addresses of a capture.
+
+import ipaddress
+import json
+import os
+import re
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from tpahelper.utils.addresses import distinct_addresses, format_addresses, searchsorted_pairs, split_packed
+
+_FIELD_SEPARATORS = re.compile(r'[\s,;|]+')
+_COMMENTS = ('#', ';', '//')
+_MAPPED = 0xffff << 32
+_MAX = (1 << 128) - 1
+
+blocklist_schema = pa.schema([
+    ('ip', pa.string()),
+    ('version', pa.uint8()),
+    ('ip_bytes', pa.binary(16)),
+    ('feed', pa.dictionary(pa.int32(), pa.string())),
+])
+
+
+def _packed_int(address) -> int:
+    # Address as an integer of the packed 16 byte form
+    return int(address) | _MAPPED if address.version == 4 else int(address)
+
+
+def _ipv6_ranges(first: int, last: int) -> list:
+    # IPv6 ranges leave out the IPv4-mapped block, IPv4 addresses live there
+    mapped_last = _MAPPED | 0xffff_ffff
+    if last < _MAPPED or first > mapped_last:
+        return [(first, last)]
+    return ([(first, _MAPPED - 1)] if first < _MAPPED else []) + ([(mapped_last + 1, last)] if last > mapped_last else [])
+
+
+def parse_entry(text: str) -> list:
+    """Packed integer (first, last) ranges of an address, CIDR block or first-last range, empty if invalid."""
+    try:
+        if '-' in text:
+            first, last = (ipaddress.ip_address(part.strip()) for part in text.split('-', 1))
+            if first.version != last.version or last < first:
+                return []
+        else:
+            network = ipaddress.ip_network(text, strict=False)
+            first, last = network.network_address, network.broadcast_address
+    except ValueError:
+        return []
+    if first.version == 4:
+        return [(_packed_int(first), _packed_int(last))]
+    return _ipv6_ranges(int(first), int(last))
+
+
+def read_feed(feed_file) -> list:
+    """The (first, last) ranges listed in a feed file."""
+    ranges = []
+    with open(feed_file, 'r', errors='replace') as infile:
+        for line in infile:
+            line = line.strip()
+            if not line or line.startswith(_COMMENTS):
+                continue
+            ranges += parse_entry(_FIELD_SEPARATORS.split(line, 1)[0].strip('"\''))
+    return ranges
+
+
+def feed_files(blocklist_dir) -> dict:
+    """Feed name (path relative to blocklist_dir) to file, skipping hidden files."""
+    feeds = {}
+    for root, dirs, files in os.walk(blocklist_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if not name.startswith('.'):
+                path = os.path.join(root, name)
+                feeds[os.path.relpath(path, blocklist_dir)] = path
+    return feeds
+
+
+def _signature(feeds: dict) -> str:
+    return json.dumps(sorted((name, os.stat(path).st_size, os.stat(path).st_mtime_ns)
+                             for name, path in feeds.items()))
+
+
+def _split(values: list):
+    return (np.array([v >> 64 for v in values], dtype=np.uint64),
+            np.array([v & 0xffff_ffff_ffff_ffff for v in values], dtype=np.uint64))
+
+
+class BlocklistIndex:
+    """
+    Sorted-interval index of the feeds: segment i covers the addresses from
+    (starts_hi[i], starts_lo[i]) up to the next start, and masks[i] holds a
+    bit per feed listing it.
+    """
+
+    def __init__(self, feeds: list, starts_hi: np.ndarray, starts_lo: np.ndarray, masks: np.ndarray,
+                 signature: str = ''):
+        self.feeds = feeds
+        self.starts_hi = starts_hi
+        self.starts_lo = starts_lo
+        self.masks = masks
+        self.signature = signature
+
+    @classmethod
+    def build(cls, feed_ranges: dict, signature: str = ''):
+        """Index of {feed name: [(first, last), ...]}."""
+        feeds = sorted(name for name, ranges in feed_ranges.items() if ranges)
+        words = max(1, (len(feeds) + 63) // 64)
+        # Every range starts a segment, and ends one unless it reaches the top of the space
+        boundaries = sorted({first for name in feeds for first, _ in feed_ranges[name]}
+                            | {last + 1 for name in feeds for _, last in feed_ranges[name] if last < _MAX})
+        starts_hi, starts_lo = _split(boundaries)
+        masks = np.zeros((len(boundaries), words), dtype=np.uint64)
+
+        for bit, name in enumerate(feeds):
+            firsts, lasts = zip(*feed_ranges[name])
+            delta = np.zeros(len(boundaries) + 1, dtype=np.int64)
+            np.add.at(delta, searchsorted_pairs(starts_hi, starts_lo, *_split(firsts)), 1)
+            ends = [last + 1 for last in lasts if last < _MAX]
+            if ends:
+                np.add.at(delta, searchsorted_pairs(starts_hi, starts_lo, *_split(ends)), -1)
+            covered = np.cumsum(delta)[:len(boundaries)] > 0
+            masks[covered, bit // 64] |= np.uint64(1 << (bit % 64))
+
+        # Neighbouring segments listed by the same feeds are one segment
+        keep = np.r_[True, (masks[1:] != masks[:-1]).any(axis=1)] if len(masks) else np.zeros(0, dtype=bool)
+        return cls(feeds, starts_hi[keep], starts_lo[keep], masks[keep], signature)
+
+    def save(self, index_file):
+        tmp_file = f"{index_file}.tmp.npz"
+        np.savez(tmp_file, feeds=np.array(self.feeds, dtype=str), starts_hi=self.starts_hi,
+                 starts_lo=self.starts_lo, masks=self.masks, signature=np.array(self.signature))
+        os.replace(tmp_file, index_file)
+
+    @classmethod
+    def load(cls, index_file):
+        with np.load(index_file) as data:
+            return cls(data['feeds'].tolist(), data['starts_hi'], data['starts_lo'], data['masks'],
+                       str(data['signature']))
+
+    def lookup(self, ip_bytes: pa.Array) -> np.ndarray:
+        """Feed bitmask rows of a non-null binary(16) array of packed addresses."""
+        if not len(self.starts_hi):
+            return np.zeros((len(ip_bytes), self.masks.shape[1]), dtype=np.uint64)
+        hi, lo, _ = split_packed(ip_bytes)
+        k = searchsorted_pairs(self.starts_hi, self.starts_lo, hi, lo)
+        masks = self.masks[np.maximum(k, 0)]
+        masks[k < 0] = 0
+        return masks
+
+    def matches(self, ip_bytes: pa.Array):
+        """(address positions, feed numbers) of every address listed by a feed, one pair per feed."""
+        masks = self.lookup(ip_bytes)
+        listed = np.flatnonzero(masks.any(axis=1))
+        positions, feed_numbers = [], []
+        for bit in range(len(self.feeds)):
+            hit = listed[(masks[listed, bit // 64] >> np.uint64(bit % 64)) & np.uint64(1) == 1]
+            positions.append(hit)
+            feed_numbers.append(np.full(len(hit), bit, dtype=np.int32))
+        if not positions:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+        return np.concatenate(positions), np.concatenate(feed_numbers)
+
+
+def load_blocklists(blocklist_dir, index_file) -> BlocklistIndex:
+    """The index of the feeds in blocklist_dir, from index_file unless a feed changed since it was built."""
+    feeds = feed_files(blocklist_dir) if os.path.isdir(blocklist_dir) else {}
+    signature = _signature(feeds)
+    if os.path.exists(index_file):
+        try:
+            index = BlocklistIndex.load(index_file)
+            if index.signature == signature:
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+    index = BlocklistIndex.build({name: read_feed(path) for name, path in feeds.items()}, signature)
+    os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+    index.save(index_file)
+    return index
+
+
+def match_blocklists(flows_parquet, index: BlocklistIndex, output_parquet) -> pa.Table:
+    """
+    Writes a row per address seen on either side of the flows and feed
+    listing it to output_parquet, sorted by address then feed, and returns them.
+    """
+    unique = distinct_addresses(flows_parquet)
+    positions, feed_numbers = index.matches(unique)
+    hi, lo, ipv4 = split_packed(unique)
+    order = np.lexsort((feed_numbers, lo[positions], hi[positions]))
+    positions, feed_numbers = positions[order], feed_numbers[order]
+    listed = unique.take(pa.array(positions))
+    result = pa.Table.from_arrays([
+        format_addresses(listed),
+        pa.array(np.where(ipv4[positions], 4, 6).astype(np.uint8)),
+        listed,
+        pa.DictionaryArray.from_arrays(pa.array(feed_numbers, type=pa.int32()),
+                                       pa.array(index.feeds, type=pa.string())),
+    ], schema=blocklist_schema)
+    pq.write_table(result, output_parquet)
+    return result
@@ -0,0 +1,218 @@
+# Content addressed result cache.
+# Results are stored under <output_dir>/<sha256 of the pcap>, so the same
+# capture uploaded under a different name reuses the completed results, and
+# different captures sharing a name no longer collide. Filenames are kept in
+# an index as aliases of the digest.
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+INDEX_FILE = "index.json"
+LOCK_FILE = ".index.lock"
+CHUNK_SIZE = 1024 * 1024
+
+# Marker files written by AllTasks and the dashboard.
+COMPLETE_MARKER = "all_tasks_complete.txt"
+FAILED_MARKER = "did_not_complete.txt"
+QUEUED_MARKER = "task_created.txt"
+
+# In-process memo of digests keyed by (path, size, mtime), avoids re-reading
+# the index for every task instantiation.
+_digest_memo = {}
+
+
+def _read_index(output_dir) -> dict:
+    # The index is replaced atomically, so readers need no lock
+    try:
+        with open(os.path.join(output_dir, INDEX_FILE), 'r') as infile:
+            index = json.load(infile)
+    except (FileNotFoundError, ValueError):
+        index = {}
+    index.setdefault('files', {})
+    index.setdefault('digests', {})
+    index.setdefault('aliases', {})
+    return index
+
+
+@contextmanager
+def _locked_index(output_dir):
+    """Yields the cache index under an exclusive lock, writing it back on exit if it changed."""
+    os.makedirs(output_dir, exist_ok=True)
+    index_path = os.path.join(output_dir, INDEX_FILE)
+    with open(os.path.join(output_dir, LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = _read_index(output_dir)
+        before = json.dumps(index, sort_keys=True)
+
+        yield index
+
+        if json.dumps(index, sort_keys=True) != before:
+            tmp_path = f"{index_path}.tmp"
+            with open(tmp_path, 'w') as outfile:
+                json.dump(index, outfile, indent=1)
+            os.replace(tmp_path, index_path)
+
+
+def hash_pcap(pcap_file) -> str:
+    """Hashes a capture in a single streaming pass."""
+    digest = hashlib.sha256()
+    with open(pcap_file, 'rb') as infile:
+        while chunk := infile.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def lookup_capture(pcap_file, output_dir):
+    """
+    Returns the digest of pcap_file if it was registered and hasn't changed
+    since, None otherwise. Never hashes the file or writes the index.
+    """
+    pcap_path = os.path.abspath(pcap_file)
+    try:
+        stat = os.stat(pcap_path)
+    except FileNotFoundError:
+        return None
+    memo_key = (pcap_path, stat.st_size, stat.st_mtime_ns)
+    if memo_key in _digest_memo:
+        return _digest_memo[memo_key]
+    seen = _read_index(output_dir)['files'].get(pcap_path)
+    if seen and seen['size'] == stat.st_size and seen['mtime_ns'] == stat.st_mtime_ns:
+        _digest_memo[memo_key] = seen['digest']
+        return seen['digest']
+    return None
+
+
+def register_capture(pcap_file, output_dir) -> str:
+    """
+    Returns the digest keying the results of pcap_file, hashing it only when
+    the file is new or has changed since it was last seen. The filename is
+    recorded as an alias of the digest. Called once per capture, at upload
+    or when its analysis is submitted; lookup_capture finds it afterwards.
+    """
+    pcap_path = os.path.abspath(pcap_file)
+    stat = os.stat(pcap_path)
+    memo_key = (pcap_path, stat.st_size, stat.st_mtime_ns)
+    if memo_key in _digest_memo:
+        return _digest_memo[memo_key]
+
+    with _locked_index(output_dir) as index:
+        seen = index['files'].get(pcap_path)
+        if seen and seen['size'] == stat.st_size and seen['mtime_ns'] == stat.st_mtime_ns:
+            digest = seen['digest']
+        else:
+            digest = hash_pcap(pcap_path)
+            index['files'][pcap_path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}
+
+        name = os.path.basename(pcap_path)
+        entry = index['digests'].setdefault(digest, {'name': name, 'last_used': time.time()})
+        index['aliases'][name] = digest
+        entry['last_used'] = time.time()
+
+    _digest_memo[memo_key] = digest
+    return digest
+
+
+def resolve_alias(filename, output_dir):
+    """Returns the digest a filename currently points to, or None."""
+    return _read_index(output_dir)['aliases'].get(filename)
+
+
+def capture_name(digest, output_dir):
+    """Returns the name results of digest were first created under, used in the result filenames."""
+    entry = _read_index(output_dir)['digests'].get(digest)
+    return entry['name'] if entry else None
+
+
+def touch_results(digest, output_dir):
+    """Marks the results of digest as recently used."""
+    with _locked_index(output_dir) as index:
+        if digest in index['digests']:
+            index['digests'][digest]['last_used'] = time.time()
+
+
+def _dir_size(path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+def _is_running(path) -> bool:
+    return (os.path.exists(os.path.join(path, QUEUED_MARKER))
+            and not os.path.exists(os.path.join(path, COMPLETE_MARKER))
+            and not os.path.exists(os.path.join(path, FAILED_MARKER)))
+
+
+def evict_results(output_dir, max_bytes: int, keep=()) -> list:
+    """
+    Removes the least recently used result sets until the cache fits in
+    max_bytes. Result sets in keep or still being processed are never evicted.
+    Returns the evicted digests.
+    """
+    evicted = []
+    with _locked_index(output_dir) as index:
+        entries = [(entry['last_used'], digest) for digest, entry in index['digests'].items()]
+        sizes = {digest: _dir_size(os.path.join(output_dir, digest)) for _, digest in entries}
+        total = sum(sizes.values())
+
+        for _, digest in sorted(entries):
+            if total <= max_bytes:
+                break
+            path = os.path.join(output_dir, digest)
+            if digest in keep or _is_running(path):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= sizes[digest]
+            evicted.append(digest)
+
+            del index['digests'][digest]
+            index['aliases'] = {k: v for k, v in index['aliases'].items() if v != digest}
+
+    return evicted
+
+
+def cached_file(cache_dir, name, build, max_bytes: int) -> str:
+    """
+    Returns the path of name in the LRU disk cache cache_dir, calling
+    build(path) to create it on a miss. File mtimes track recency, the least
+    recently used files are removed once the cache grows past max_bytes.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, name)
+    with open(os.path.join(cache_dir, LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            os.utime(path)
+            return path
+
+        tmp_path = f"{path}.tmp"
+        try:
+            build(tmp_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+
+        entries = []
+        for entry in os.scandir(cache_dir):
+            if entry.is_file() and entry.name != LOCK_FILE and entry.path != path:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = os.path.getsize(path) + sum(size for _, size, _ in entries)
+        for _, size, old_path in sorted(entries):
+            if total <= max_bytes:
+                break
+            os.remove(old_path)
+            total -= size
+
+    return path
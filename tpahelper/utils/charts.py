@@ -0,0 +1,134 @@
+# Bounded point value charts.
+# Series are downsampled to at most max_points samples each (min/max
+# envelope or LTTB) and drawn with WebGL traces. Points can be split over
+# pages of page_size series, so the size and render time of every chart file
+# stay bounded however long the capture is and however many points it has.
+
+import glob
+import html
+import os
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import pyarrow.parquet as pq
+
+from tpahelper.utils.point_values import read_point_series, series_stats_path
+
+MAX_POINTS = 2000
+PAGE_SIZE = 20
+
+
+def minmax_indices(codes: np.ndarray, values: np.ndarray, max_points: int = MAX_POINTS) -> np.ndarray:
+    """
+    Indices of the min/max envelope of every series, for rows sorted by
+    series code (then time). Each series longer than max_points is cut into
+    max_points / 2 buckets keeping the lowest and highest value of each,
+    plus its first and last rows; shorter series are kept whole.
+    """
+    if not len(codes):
+        return np.arange(0)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    lengths = np.diff(np.r_[starts, len(codes)])
+    row_lengths = np.repeat(lengths, lengths)
+    buckets = max(1, max_points // 2)
+    position = np.arange(len(codes)) - np.repeat(starts, lengths)
+    key = np.repeat(np.arange(len(starts)), lengths) * buckets + position * buckets // row_lengths
+
+    order = np.lexsort((values, key))
+    changes = key[order][1:] != key[order][:-1]
+    keep = row_lengths <= max_points
+    keep[order[np.r_[True, changes]]] = True
+    keep[order[np.r_[changes, True]]] = True
+    keep[starts] = True
+    keep[starts + lengths - 1] = True
+    return np.flatnonzero(keep)
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, max_points: int = MAX_POINTS) -> np.ndarray:
+    """Indices of the Largest-Triangle-Three-Buckets downsampling of one series to max_points samples."""
+    n = len(x)
+    if n <= max_points or max_points < 3:
+        return np.arange(n)
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    # Buckets between the fixed first and last rows
+    edges = (np.arange(max_points - 1) * (n - 2) / (max_points - 2)).astype(np.int64) + 1
+    edges[-1] = n - 1
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        areas = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+
+def downsample(df, max_points: int = MAX_POINTS, method: str = 'minmax'):
+    """Downsamples a long (point, time, value) frame sorted by point then time, per point."""
+    codes = pd.factorize(df['point'])[0]
+    values = df['value'].to_numpy()
+    if method == 'lttb':
+        times = df['time'].astype('int64').to_numpy()
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        ends = np.r_[starts[1:], len(codes)]
+        indices = np.concatenate([start + lttb_indices(times[start:end], values[start:end], max_points)
+                                  for start, end in zip(starts, ends)]) if len(starts) else np.arange(0)
+    else:
+        indices = minmax_indices(codes, values, max_points)
+    return df.iloc[indices]
+
+
+def point_figure(df, title: str, labels: dict) -> go.Figure:
+    fig = go.Figure()
+    for point, series in df.groupby('point', observed=True, sort=False):
+        fig.add_trace(go.Scattergl(x=series['time'], y=series['value'], mode='lines', name=str(point)))
+    fig.update_layout(title=title, xaxis_title=labels.get('time', 'time'),
+                      yaxis_title=labels.get('value', 'value'), legend_title_text=labels.get('point', 'point'))
+    return fig
+
+
+def write_point_charts(series_parquet, output_html, title: str, labels: dict = None,
+                       max_points: int = MAX_POINTS, page_size: int = PAGE_SIZE, method: str = 'minmax') -> list:
+    """
+    Writes downsampled WebGL charts of the series store series_parquet.
+    With page_size 0, or no more points than page_size, all points go to
+    output_html. Otherwise every page_size points (1 for a chart per point)
+    go to a page next to it, plotly.js is shared between the pages, and
+    output_html links to them. Returns the files written.
+    """
+    labels = labels or {}
+    stem, _ = os.path.splitext(output_html)
+    # Pages of an earlier run would otherwise linger next to the new charts
+    for old_page in glob.glob(f"{glob.escape(stem)}_[0-9][0-9][0-9][0-9].html"):
+        os.remove(old_page)
+    points = pq.read_table(series_stats_path(series_parquet), columns=['point'])['point'].to_pylist()
+
+    if not page_size or len(points) <= page_size:
+        df = downsample(read_point_series(series_parquet), max_points, method)
+        point_figure(df, title, labels).write_html(output_html)
+        return [output_html]
+
+    pages = []
+    for first in range(0, len(points), page_size):
+        page_points = points[first:first + page_size]
+        page_html = f"{stem}_{first // page_size + 1:04d}.html"
+        df = downsample(read_point_series(series_parquet, page_points), max_points, method)
+        point_figure(df, f"{title} ({page_points[0]} - {page_points[-1]})", labels).write_html(
+            page_html, include_plotlyjs='directory')
+        pages.append((page_html, page_points))
+
+    with open(output_html, 'w') as f:
+        f.write(f"<html><head><meta charset=\"utf-8\"><title>{html.escape(title)}</title></head><body>\n")
+        f.write(f"<h1>{html.escape(title)}</h1>\n<ul>\n")
+        for page_html, page_points in pages:
+            name = ', '.join(page_points) if len(page_points) <= 3 else f"{page_points[0]} - {page_points[-1]}"
+            f.write(f"<li><a href=\"{html.escape(os.path.basename(page_html))}\">{html.escape(name)}</a></li>\n")
+        f.write("</ul>\n</body></html>\n")
+    plotly_js = os.path.join(os.path.dirname(output_html), 'plotly.min.js')
+    return [output_html] + [page_html for page_html, _ in pages] + [plotly_js]
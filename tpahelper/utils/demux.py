@@ -0,0 +1,506 @@
+# Single pass protocol demultiplexer.
+# Reads a capture once and writes the packets of every protocol to its own
+# pcap at the same time, instead of running tcpdump over the capture once
+# per protocol. Protocol filters use the tcpdump expressions from
+# ndpi_protocol_map, compiled by a small parser covering the subset of the
+# pcap-filter syntax used there.
+# Alternatively packets are routed by their 5-tuple through an index of the
+# ndpi flow table, so segmentation follows nDPI's classification exactly.
+
+import re
+import socket
+
+from termcolor import colored
+
+from tpahelper.utils.pcap import (
+    IPPROTO_SCTP,
+    IPPROTO_TCP,
+    IPPROTO_UDP,
+    PORT_PROTOCOLS,
+    PcapReader,
+    PcapWriter,
+    decode_packet
+)
+
+protocol_numbers = {
+    'icmp': 1, 'igmp': 2, 'ipip': 4, 'tcp': IPPROTO_TCP, 'udp': IPPROTO_UDP, 'gre': 47,
+    'esp': 50, 'ah': 51, 'icmp6': 58, 'ospf': 89, 'pim': 103, 'vrrp': 112, 'sctp': IPPROTO_SCTP,
+}
+
+port_names = {'http': 80, 'https': 443, 'domain': 53, 'ftp': 21, 'ssh': 22, 'telnet': 23, 'smtp': 25}
+
+_token_pattern = re.compile(
+    r"\s*(\d+\.\d+\.\d+\.\d+|0x[0-9a-fA-F]+|\d+|>>|<<|>=|<=|!=|==|&&|\|\||"
+    r"[()\[\]:=<>&|+\-*/!]|[A-Za-z_][\w.\-]*)"
+)
+
+_relational = {
+    '=': lambda a, b: a == b, '==': lambda a, b: a == b, '!=': lambda a, b: a != b,
+    '>': lambda a, b: a > b, '<': lambda a, b: a < b, '>=': lambda a, b: a >= b, '<=': lambda a, b: a <= b,
+}
+
+# Arithmetic operators from lowest to highest precedence, as in C
+_arithmetic = [
+    {'|': lambda a, b: a | b},
+    {'&': lambda a, b: a & b},
+    {'<<': lambda a, b: a << b, '>>': lambda a, b: a >> b},
+    {'+': lambda a, b: a + b, '-': lambda a, b: a - b},
+    {'*': lambda a, b: a * b, '/': lambda a, b: a // b if b else 0},
+]
+
+
+class FilterError(ValueError):
+    pass
+
+
+def _tokenize(expression: str) -> list:
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = _token_pattern.match(expression, pos)
+        if not match or match.end() == pos:
+            raise FilterError(f"Unexpected character in filter: {expression[pos:]}")
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent parser producing an AST of tuples:
+    ('and'|'or', a, b), ('not', a), ('port', ports, proto), ('proto', number, version),
+    ('version', 4|6), ('host', addresses), ('cmp', op, left, right)
+    with arithmetic nodes ('num', n), ('load', base, offset, size), ('op', op, a, b).
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+
+    def peek(self, ahead: int = 0):
+        pos = self.pos + ahead
+        return self.tokens[pos] if pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise FilterError(f"Unexpected end of filter: {self.expression}")
+        self.pos += 1
+        return token
+
+    def expect(self, token):
+        if self.next() != token:
+            raise FilterError(f"Expected '{token}' in filter: {self.expression}")
+
+    def parse(self):
+        node = self.boolean()
+        if self.peek() is not None:
+            raise FilterError(f"Unsupported filter syntax near '{self.peek()}': {self.expression}")
+        return node
+
+    def boolean(self):
+        # 'and' and 'or' share one precedence level and associate left, as in pcap-filter
+        node = self.unary()
+        while self.peek() in ('and', '&&', 'or', '||'):
+            op = 'and' if self.next() in ('and', '&&') else 'or'
+            node = (op, node, self.unary())
+        return node
+
+    def unary(self):
+        token = self.peek()
+        if token in ('not', '!'):
+            self.next()
+            return 'not', self.unary()
+        if token == '(':
+            start = self.pos
+            try:
+                self.next()
+                node = self.boolean()
+                self.expect(')')
+                if self.peek() not in _relational and not any(self.peek() in level for level in _arithmetic):
+                    return node
+            except FilterError:
+                pass
+            # The parenthesis opened an arithmetic expression
+            self.pos = start
+            return self.comparison()
+        return self.primitive()
+
+    def primitive(self):
+        token = self.peek()
+        if token is None:
+            raise FilterError(f"Unexpected end of filter: {self.expression}")
+        if token[0].isdigit() or self.peek(1) == '[':
+            return self.comparison()
+
+        self.next()
+        if token in ('tcp', 'udp', 'sctp'):
+            if self.peek() == 'port':
+                self.next()
+                return 'port', self.port_value(), protocol_numbers[token]
+            return 'proto', protocol_numbers[token], None
+        if token in ('ip', 'ip6'):
+            version = 4 if token == 'ip' else 6
+            if self.peek() == 'proto':
+                self.next()
+                return 'proto', self.proto_value(), version
+            return 'version', version
+        if token == 'port':
+            return 'port', self.port_value(), None
+        if token == 'proto':
+            return 'proto', self.proto_value(), None
+        if token == 'icmp':
+            return 'proto', 1, 4
+        if token == 'icmp6':
+            return 'proto', 58, 6
+        if token in protocol_numbers:
+            return 'proto', protocol_numbers[token], None
+        if token == 'host':
+            return 'host', _resolve_host(self.next())
+        raise FilterError(f"Unsupported filter syntax near '{token}': {self.expression}")
+
+    def port_value(self):
+        token = self.next()
+        if token.isdigit():
+            return frozenset([int(token)])
+        if token in port_names:
+            return frozenset([port_names[token]])
+        try:
+            return frozenset([socket.getservbyname(token)])
+        except OSError:
+            raise FilterError(f"Unknown port name '{token}': {self.expression}")
+
+    def proto_value(self):
+        token = self.next()
+        if token.isdigit():
+            return int(token)
+        if token in protocol_numbers:
+            return protocol_numbers[token]
+        raise FilterError(f"Unknown protocol '{token}': {self.expression}")
+
+    def comparison(self):
+        left = self.arithmetic()
+        op = self.next()
+        if op not in _relational:
+            raise FilterError(f"Expected a comparison near '{op}': {self.expression}")
+        return 'cmp', op, left, self.arithmetic()
+
+    def arithmetic(self, level: int = 0):
+        if level == len(_arithmetic):
+            return self.atom()
+        node = self.arithmetic(level + 1)
+        while self.peek() in _arithmetic[level]:
+            op = self.next()
+            node = ('op', op, node, self.arithmetic(level + 1))
+        return node
+
+    def atom(self):
+        token = self.next()
+        if token == '(':
+            node = self.arithmetic()
+            self.expect(')')
+            return node
+        if token.startswith('0x'):
+            return 'num', int(token, 16)
+        if token.isdigit():
+            return 'num', int(token)
+        if token in ('tcp', 'udp', 'ip', 'ip6', 'icmp') and self.peek() == '[':
+            self.next()
+            offset = self.arithmetic()
+            size = 1
+            if self.peek() == ':':
+                self.next()
+                size = int(self.next())
+                if size not in (1, 2, 4):
+                    raise FilterError(f"Invalid load size {size}: {self.expression}")
+            self.expect(']')
+            return 'load', token, offset, size
+        raise FilterError(f"Unsupported arithmetic near '{token}': {self.expression}")
+
+
+def _resolve_host(name: str) -> frozenset:
+    # Hostnames are resolved once at compile time, as tcpdump does
+    try:
+        infos = socket.getaddrinfo(name, None)
+    except OSError:
+        print(colored(f"Could not resolve host '{name}', the filter will not match it", 'yellow'))
+        return frozenset()
+    return frozenset(socket.inet_pton(family, sockaddr[0]) for family, _, _, _, sockaddr in infos
+                     if family in (socket.AF_INET, socket.AF_INET6))
+
+
+def _compile_arithmetic(node):
+    kind = node[0]
+    if kind == 'num':
+        value = node[1]
+        return lambda p: value
+    if kind == 'op':
+        func = next(level[node[1]] for level in _arithmetic if node[1] in level)
+        left, right = _compile_arithmetic(node[2]), _compile_arithmetic(node[3])
+
+        def binary(p):
+            a = left(p)
+            if a is None:
+                return None
+            b = right(p)
+            return None if b is None else func(a, b)
+        return binary
+
+    _, base, offset_node, size = node
+    offset = _compile_arithmetic(offset_node)
+    proto = protocol_numbers.get(base)
+
+    def load(p):
+        # Loads outside the packet or the requested header reject, as in BPF
+        if base in ('ip', 'ip6'):
+            if p.version != (4 if base == 'ip' else 6):
+                return None
+            start = p.l3_offset
+        else:
+            if p.proto != proto or p.l4_offset is None:
+                return None
+            start = p.l4_offset
+        rel = offset(p)
+        if rel is None:
+            return None
+        pos = start + rel
+        if pos < 0 or pos + size > len(p.data):
+            return None
+        return int.from_bytes(p.data[pos:pos + size], 'big')
+    return load
+
+
+def _compile(node):
+    kind = node[0]
+    if kind in ('and', 'or'):
+        left, right = _compile(node[1]), _compile(node[2])
+        if kind == 'and':
+            return lambda p: left(p) and right(p)
+        return lambda p: left(p) or right(p)
+    if kind == 'not':
+        inner = _compile(node[1])
+        return lambda p: not inner(p)
+    if kind == 'port':
+        _, ports, proto = node
+        protos = PORT_PROTOCOLS if proto is None else {proto}
+        return lambda p: p.proto in protos and (p.sport in ports or p.dport in ports)
+    if kind == 'proto':
+        _, number, version = node
+        if version:
+            return lambda p: p.version == version and p.proto == number
+        return lambda p: p.proto == number
+    if kind == 'version':
+        version = node[1]
+        return lambda p: p.version == version
+    if kind == 'host':
+        addresses = node[1]
+        return lambda p: p.src in addresses or p.dst in addresses
+    _, op, left_node, right_node = node
+    func = _relational[op]
+    left, right = _compile_arithmetic(left_node), _compile_arithmetic(right_node)
+
+    def compare(p):
+        a = left(p)
+        if a is None:
+            return False
+        b = right(p)
+        return b is not None and func(a, b)
+    return compare
+
+
+def _port_route(node):
+    # Returns (proto, ports) when the filter is only a union of port tests,
+    # so it can be served by a port lookup instead of being evaluated.
+    if node[0] == 'port':
+        return node[2], node[1]
+    if node[0] == 'or':
+        left, right = _port_route(node[1]), _port_route(node[2])
+        if left and right and left[0] == right[0]:
+            return left[0], left[1] | right[1]
+    return None
+
+
+class CompiledFilter:
+    """A tcpdump filter expression compiled to a Python predicate over PacketInfo."""
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        ast = _Parser(expression).parse()
+        self.match = _compile(ast)
+        self.port_route = _port_route(ast)
+
+
+def compile_filter(expression: str) -> CompiledFilter:
+    """Compiles a tcpdump filter, raising FilterError for unsupported syntax."""
+    return CompiledFilter(expression)
+
+
+def _route_packets(pcap_file, paths: list, route, index=None) -> dict:
+    # Single pass over the capture, writing each packet to the outputs
+    # returned by route(record, info). Every output file is created.
+    # Packets are also added to index, a PacketIndexBuilder, when given.
+    writers = [None] * len(paths)
+    with PcapReader(pcap_file) as reader:
+        try:
+            for record in reader:
+                info = decode_packet(record.linktype, record.data)
+                if index is not None:
+                    index.add(record, info)
+                for i in route(record, info):
+                    writer = writers[i]
+                    if writer is None:
+                        writer = writers[i] = PcapWriter(paths[i], record.linktype, reader.snaplen,
+                                                         reader.nanosecond)
+                    writer.write_record(record)
+        finally:
+            for i, path in enumerate(paths):
+                if writers[i] is None:
+                    writers[i] = PcapWriter(path, reader.linktype or 1, reader.snaplen, reader.nanosecond)
+                writers[i].close()
+
+    return {path: writer.count for path, writer in zip(paths, writers)}
+
+
+def demultiplex(pcap_file, outputs: dict, index=None) -> dict:
+    """
+    Splits a capture into per protocol pcaps in a single read.
+    outputs maps each output pcap path to its CompiledFilter. Every output file
+    is created, even when no packet matches. The packet index of the capture is
+    built in the same read when a PacketIndexBuilder is passed as index.
+    Returns the packet count per output.
+    """
+    paths = list(outputs)
+    # Port-only filters are indexed by (proto, port), everything else is evaluated
+    port_routes = {}
+    generic_routes = []
+    for i, path in enumerate(paths):
+        route = outputs[path].port_route
+        if route:
+            proto, ports = route
+            for proto in (PORT_PROTOCOLS if proto is None else {proto}):
+                table = port_routes.setdefault(proto, {})
+                for port in ports:
+                    table.setdefault(port, set()).add(i)
+        else:
+            generic_routes.append((i, outputs[path].match))
+
+    def route(record, info):
+        targets = set()
+        if info.sport is not None:
+            table = port_routes.get(info.proto)
+            if table:
+                targets.update(table.get(info.sport, ()))
+                targets.update(table.get(info.dport, ()))
+        for i, match in generic_routes:
+            if match(info):
+                targets.add(i)
+        return targets
+
+    return _route_packets(pcap_file, paths, route, index)
+
+
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+
+def flow_tuple(proto, src: bytes, sport, dst: bytes, dport):
+    """Direction independent 5-tuple, addresses in 16 byte form."""
+    a = (src, sport or 0)
+    b = (dst, dport or 0)
+    return (proto, a, b) if a <= b else (proto, b, a)
+
+
+def packet_flow_key(info):
+    """Returns the 5-tuple key of a decoded packet, or None for non-IP packets."""
+    if info.src is None or info.proto is None:
+        return None
+    src = info.src if len(info.src) == 16 else IPV4_MAPPED_PREFIX + info.src
+    dst = info.dst if len(info.dst) == 16 else IPV4_MAPPED_PREFIX + info.dst
+    return flow_tuple(info.proto, src, info.sport, dst, info.dport)
+
+
+def _proto_number(proto):
+    if proto is None:
+        return None
+    if isinstance(proto, int):
+        return proto
+    proto = str(proto)
+    if proto.isdigit():
+        return int(proto)
+    return protocol_numbers.get(proto.lower())
+
+
+class FlowIndex:
+    """
+    Hash index from the direction independent 5-tuple of every ndpi flow to its
+    l7_protocol_name, used to route packets by nDPI's own classification.
+    A tuple reused by flows of different protocols is resolved by timestamp.
+    """
+
+    columns = ['src_ip_bytes', 'dst_ip_bytes', 'src_port', 'dst_port', 'proto',
+               'l7_protocol_name', 'first_seen_ms', 'last_seen_ms']
+
+    def __init__(self):
+        self.routes = {}
+        self.overlaps = {}
+        self.protocols = set()
+
+    @classmethod
+    def from_parquet(cls, flows_parquet, batch_size: int = 100000):
+        import pyarrow.parquet as pq
+
+        index = cls()
+        parquet = pq.ParquetFile(flows_parquet)
+        for batch in parquet.iter_batches(batch_size=batch_size, columns=cls.columns):
+            for flow in batch.to_pylist():
+                index.add(flow)
+        return index
+
+    def add(self, flow: dict):
+        protocol = flow['l7_protocol_name']
+        proto = _proto_number(flow['proto'])
+        if protocol is None or proto is None or flow['src_ip_bytes'] is None or flow['dst_ip_bytes'] is None:
+            return
+        key = flow_tuple(proto, flow['src_ip_bytes'], flow['src_port'], flow['dst_ip_bytes'], flow['dst_port'])
+        self.protocols.add(protocol)
+
+        interval = (flow['first_seen_ms'] or 0, flow['last_seen_ms'] or 0, protocol)
+        current = self.routes.get(key)
+        if current is None:
+            self.routes[key] = interval
+        elif key in self.overlaps:
+            self.overlaps[key].append(interval)
+        elif current[2] != protocol:
+            self.overlaps[key] = [current, interval]
+
+    def lookup(self, info, ts_ns: int):
+        key = packet_flow_key(info)
+        if key is None:
+            return None
+        interval = self.routes.get(key)
+        if interval is None:
+            return None
+        if key not in self.overlaps:
+            return interval[2]
+        # Pick the flow whose time range is closest to the packet
+        ts_ms = ts_ns // 1_000_000
+        return min(self.overlaps[key],
+                   key=lambda i: 0 if i[0] <= ts_ms <= i[1] else min(abs(ts_ms - i[0]), abs(ts_ms - i[1])))[2]
+
+
+def demultiplex_flows(pcap_file, flow_index: FlowIndex, outputs: dict, index=None) -> dict:
+    """
+    Splits a capture into per protocol pcaps in a single read, routing each
+    packet by a 5-tuple lookup in flow_index. outputs maps l7_protocol_name to
+    the output pcap path. index is handled as in demultiplex.
+    Returns the packet count per output.
+    """
+    protocols = list(outputs)
+    paths = [outputs[protocol] for protocol in protocols]
+    targets = {protocol: (i,) for i, protocol in enumerate(protocols)}
+
+    def route(record, info):
+        return targets.get(flow_index.lookup(info, record.ts_ns), ())
+
+    return _route_packets(pcap_file, paths, route, index)
@@ -53,6 +53,15 @@ tcpdump_flow = (
     """port {} and port {}"""
 )
 
+# Description: Dumps the packets matching a filter expression to an output pcap file.
+# Positional arguments:
+# 1. pcap file
+# 2. output pcap file
+# 3. filter expression, quoted as one shell word
+tcpdump_filter = (
+    """tcpdump -r "{}" -nn -w "{}" {}"""
+)
+
 # Description: Dumps a specific protocol to an output pcap file.
 # Note: additional filters expected to be prepended to the command.
 # for demo purposes, the ndpi_protocol_map file in utils is used
@@ -84,6 +93,20 @@ tshark_protocol = (
 # 3. summary file
 ndpi_extract = "ndpiReader -i {} -K json -k {} > {}"
 
+# Description: Prints the capture duration in seconds using capinfos,
+# as a single "file,duration" table row.
+# Positional arguments:
+# 1. pcap file
+capinfos_duration = "capinfos -T -m -r -u {}"
+
+# Description: Splits a capture into consecutive time windows using editcap.
+# The shards are written as <prefix>_<n>_<timestamp>.<ext>.
+# Positional arguments:
+# 1. window length in seconds
+# 2. pcap file
+# 3. output shard prefix
+editcap_time_split = "editcap -i {} {} {}"
+
 
 # Description: Queries specific indicator values using the AlienVault OTX API.
 # Positional arguments:
@@ -0,0 +1,339 @@
+# Declarative protocol processors.
+# A protocol declares the tshark fields it needs and the shape of its rows,
+# the shared engine dissects its pcap once with tshark -T fields, streams
+# the output and writes typed rows to {name}_values.parquet in batches.
+#
+# Packet fields give one value per packet. Row fields may occur several times
+# in a packet (registers, information objects, items); a packet gives one row
+# per occurrence, with every row field occurring that many times aligned to
+# it and the others left empty. A packet without any still gives one row.
+#
+# Adding a protocol is a subclass with its name (as in the protocol pcap
+# names), display filter and fields, registered in protocols.processor_map.
+
+import os
+import subprocess
+from functools import lru_cache
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from termcolor import colored
+
+from tpahelper.utils.point_values import epoch_ns
+from tpahelper.utils.processors import tshark_process
+
+BATCH_SIZE = 100_000
+# Joins the occurrences of a field within a packet, never part of a value
+AGGREGATOR = '\x1f'
+
+TIME = pa.timestamp('ns', tz='UTC')
+LABEL = pa.dictionary(pa.int32(), pa.string())
+
+
+@lru_cache(maxsize=None)
+def tshark_field_names() -> frozenset:
+    """Names of the fields known to the installed tshark, empty when it can't be listed."""
+    try:
+        result = subprocess.run(['tshark', '-G', 'fields'], capture_output=True, text=True)
+    except OSError:
+        return frozenset()
+    return frozenset(line.split('\t')[2] for line in result.stdout.splitlines()
+                     if line.startswith('F\t') and line.count('\t') >= 2)
+
+
+def _to_int(value):
+    # Decimal unless hex: base 0 would reject leading zeros such as "08"
+    return int(value, 16) if value[:2] in ('0x', '0X') else int(value, 10)
+
+
+def _to_bool(value):
+    return value not in ('0', 'False', 'false')
+
+
+def _int_converter(arrow_type):
+    # Values outside the column type (malformed packets, fields wider than
+    # declared) are left empty instead of failing the whole batch
+    width = arrow_type.bit_width
+    low, high = (-(1 << (width - 1)), (1 << (width - 1)) - 1) if pa.types.is_signed_integer(arrow_type) \
+        else (0, (1 << width) - 1)
+
+    def to_int(value):
+        number = _to_int(value)
+        if not low <= number <= high:
+            raise ValueError(f"{value} out of range for {arrow_type}")
+        return number
+    return to_int
+
+
+def _converter(arrow_type):
+    # tshark -T fields text to a Python value of the column type
+    if pa.types.is_timestamp(arrow_type):
+        return epoch_ns
+    if pa.types.is_integer(arrow_type):
+        return _int_converter(arrow_type)
+    if pa.types.is_floating(arrow_type):
+        return float
+    if pa.types.is_boolean(arrow_type):
+        return _to_bool
+    return str
+
+
+def _convert(converter, value):
+    if not value:
+        return None
+    try:
+        return converter(value)
+    except ValueError:
+        return None
+
+
+class RowWriter:
+    """
+    Accumulates rows column by column and writes them to a parquet file in
+    batches of batch_size rows.
+
+    Usage:
+        with RowWriter(values_parquet, schema) as writer:
+            writer.add([value, ...])
+    """
+
+    def __init__(self, values_parquet, schema: pa.Schema, batch_size: int = BATCH_SIZE):
+        self.values_parquet = values_parquet
+        self.schema = schema
+        self.batch_size = batch_size
+        self.count = 0
+        self._tmp_file = f"{values_parquet}.tmp"
+        self._writer = pq.ParquetWriter(self._tmp_file, schema)
+        self._columns = [[] for _ in schema]
+
+    def add(self, row: list):
+        for column, value in zip(self._columns, row):
+            column.append(value)
+        if len(self._columns[0]) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._columns[0]:
+            return
+        arrays = []
+        for column, field in zip(self._columns, self.schema):
+            if pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(column, type=field.type.value_type).dictionary_encode())
+            elif pa.types.is_timestamp(field.type):
+                arrays.append(pa.array(column, type=pa.int64()).cast(field.type))
+            else:
+                arrays.append(pa.array(column, type=field.type))
+        self._writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.count += len(self._columns[0])
+        self._columns = [[] for _ in self.schema]
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+        os.replace(self._tmp_file, self.values_parquet)
+
+    def abort(self):
+        self._writer.close()
+        os.remove(self._tmp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class FieldProcessor:
+    """
+    Base of the declarative processors. Subclasses set:
+        name: protocol name, as in the protocol pcap names
+        display_filter: tshark display filter of the protocol's packets
+        packet_fields: {column: (tshark field, arrow type)}, one value per packet
+        row_fields: {column: (tshark field, arrow type)}, one value per row
+    A tshark field may be a tuple of alternatives, the first one present is used.
+    """
+    name = None
+    display_filter = None
+    common_fields = {
+        'frame': ('frame.number', pa.uint32()),
+        'time': ('frame.time_epoch', TIME),
+        'src': (('ip.src', 'ipv6.src'), LABEL),
+        'dst': (('ip.dst', 'ipv6.dst'), LABEL),
+    }
+    packet_fields = {}
+    row_fields = {}
+
+    def __init__(self, infile, outpath, batch_size: int = BATCH_SIZE, **options):
+        """Options of other processors (e.g. DNP3 charts) are accepted and ignored."""
+        self.infile = infile
+        self.outpath = outpath
+        self.batch_size = batch_size
+        self.output_parquet = os.path.join(self.outpath, f"{self.name}_values.parquet")
+
+        self.packet_columns = {**self.common_fields, **self.packet_fields}
+        self.schema = pa.schema([(column, arrow_type) for column, (_, arrow_type) in
+                                 list(self.packet_columns.items()) + list(self.row_fields.items())])
+        # Every tshark field is requested once, columns refer to their positions
+        self.fields = []
+        known = tshark_field_names()
+        self._packet_positions = [self._positions(f, known) for f, _ in self.packet_columns.values()]
+        self._row_positions = [self._positions(f, known) for f, _ in self.row_fields.values()]
+        self._packet_converters = [_converter(arrow_type) for _, arrow_type in self.packet_columns.values()]
+        self._row_converters = [_converter(arrow_type) for _, arrow_type in self.row_fields.values()]
+
+    def _positions(self, field, known) -> list:
+        positions = []
+        for name in (field,) if isinstance(field, str) else field:
+            # Fields missing from this tshark version would fail the whole run
+            if known and name not in known:
+                print(colored(f"\t{self.name}: tshark has no field {name}, skipping it", 'yellow'))
+                continue
+            if name not in self.fields:
+                self.fields.append(name)
+            positions.append(self.fields.index(name))
+        return positions
+
+    def tshark_command(self) -> list:
+        command = ['tshark', '-r', str(self.infile), '-n', '-T', 'fields',
+                   '-E', 'header=n', '-E', 'separator=/t', '-E', 'quote=n',
+                   '-E', 'occurrence=a', '-E', f"aggregator={AGGREGATOR}"]
+        if self.display_filter:
+            command += ['-Y', self.display_filter]
+        for name in self.fields:
+            command += ['-e', name]
+        return command
+
+    def packet_rows(self, values: list) -> list:
+        """The rows of one packet, from its tshark field values in self.fields order."""
+        def occurrences(positions) -> list:
+            for position in positions:
+                if values[position]:
+                    return values[position].split(AGGREGATOR)
+            return []
+
+        # Packet columns keep the first occurrence
+        packet = [_convert(converter, (occurrences(positions) or [None])[0])
+                  for converter, positions in zip(self._packet_converters, self._packet_positions)]
+        if not self._row_converters:
+            return [packet]
+
+        row_values = [occurrences(positions) for positions in self._row_positions]
+        count = max(1, max(len(v) for v in row_values))
+        columns = [[_convert(converter, value) for value in v] if len(v) == count else [None] * count
+                   for converter, v in zip(self._row_converters, row_values)]
+        return [packet + list(row) for row in zip(*columns)]
+
+    def run(self) -> list:
+        print(colored(f"\nExtracting {self.name} fields with tshark", 'green'))
+        if not self.fields:
+            print(colored(f"\tNo {self.name} fields known to tshark", 'red'))
+            return []
+        command = self.tshark_command()
+        print(colored(f"{subprocess.list2cmdline(command)}\n", "blue"))
+
+        with RowWriter(self.output_parquet, self.schema, self.batch_size) as writer:
+            with tshark_process(command) as process:
+                for line in process.stdout:
+                    values = line.decode(errors='replace').rstrip('\r\n').split('\t')
+                    if len(values) < len(self.fields):
+                        continue
+                    for row in self.packet_rows(values):
+                        writer.add(row)
+
+        print(colored(f"\t{writer.count} {self.name} rows", 'green'))
+        return [self.output_parquet]
+
+
+class ModbusProcessor(FieldProcessor):
+    name = 'Modbus'
+    display_filter = 'mbtcp'
+    packet_fields = {
+        'trans_id': ('mbtcp.trans_id', pa.uint16()),
+        'unit_id': ('mbtcp.unit_id', pa.uint8()),
+        'func_code': ('modbus.func_code', pa.uint8()),
+        'reference_num': ('modbus.reference_num', pa.uint16()),
+        'word_cnt': ('modbus.word_cnt', pa.uint16()),
+        'exception_code': ('modbus.exception_code', pa.uint8()),
+        'request_frame': ('modbus.request_frame', pa.uint32()),
+    }
+    row_fields = {
+        'register': ('modbus.regnum16', pa.uint16()),
+        'value': ('modbus.regval_uint16', pa.uint16()),
+    }
+
+
+class IEC104Processor(FieldProcessor):
+    name = 'IEC60870'
+    display_filter = 'iec60870_104'
+    packet_fields = {
+        'apci_type': ('iec60870_104.type', pa.uint8()),
+        'type_id': ('iec60870_asdu.typeid', pa.uint8()),
+        'cause_tx': ('iec60870_asdu.causetx', pa.uint8()),
+        'asdu_addr': ('iec60870_asdu.addr', pa.uint16()),
+    }
+    row_fields = {
+        'ioa': ('iec60870_asdu.ioa', pa.uint32()),
+        'float': ('iec60870_asdu.float', pa.float64()),
+        'normval': ('iec60870_asdu.normval', pa.float64()),
+        'scaval': ('iec60870_asdu.scaval', pa.int32()),
+        'spi': ('iec60870_asdu.siq.spi', pa.bool_()),
+        'dpi': ('iec60870_asdu.diq.dpi', pa.uint8()),
+    }
+
+
+class S7CommProcessor(FieldProcessor):
+    name = 'S7Comm'
+    display_filter = 's7comm'
+    packet_fields = {
+        'rosctr': ('s7comm.header.rosctr', pa.uint8()),
+        'pdu_ref': ('s7comm.header.pduref', pa.uint16()),
+        'function': ('s7comm.param.func', pa.uint8()),
+        'error_class': ('s7comm.header.errcls', pa.uint8()),
+    }
+    row_fields = {
+        'area': ('s7comm.param.item.area', pa.uint8()),
+        'db': ('s7comm.param.item.db', pa.uint16()),
+        'address': ('s7comm.param.item.address', pa.uint32()),
+        'return_code': ('s7comm.data.returncode', pa.uint8()),
+        'data': ('s7comm.resp.data', pa.string()),
+    }
+
+
+class CIPProcessor(FieldProcessor):
+    name = 'CIP'
+    display_filter = 'cip'
+    packet_fields = {
+        'command': ('enip.command', pa.uint16()),
+        'session': ('enip.session', pa.uint32()),
+    }
+    row_fields = {
+        'service': ('cip.service', pa.uint8()),
+        'class': ('cip.class', pa.uint32()),
+        'instance': ('cip.instance', pa.uint32()),
+        'attribute': ('cip.attribute', pa.uint32()),
+        'status': ('cip.genstat', pa.uint8()),
+        'data': ('cip.data', pa.string()),
+    }
+
+
+class BACnetProcessor(FieldProcessor):
+    name = 'BACnet'
+    display_filter = 'bacapp'
+    packet_fields = {
+        'pdu_type': ('bacapp.type', pa.uint8()),
+        'invoke_id': ('bacapp.invoke_id', pa.uint8()),
+        'confirmed_service': ('bacapp.confirmed_service', pa.uint8()),
+        'unconfirmed_service': ('bacapp.unconfirmed_service', pa.uint8()),
+    }
+    row_fields = {
+        'object_type': ('bacapp.objectType', pa.uint16()),
+        'instance': ('bacapp.instance_number', pa.uint32()),
+        'property': ('bacapp.property_identifier', pa.uint32()),
+        'real': ('bacapp.present_value.real', pa.float64()),
+        'unsigned': ('bacapp.present_value.unsigned', pa.uint64()),
+        'enum': ('bacapp.present_value.enum_index', pa.uint32()),
+        'boolean': ('bacapp.present_value.boolean', pa.bool_()),
+    }
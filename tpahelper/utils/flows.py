@@ -0,0 +1,383 @@
+import ipaddress
+import itertools
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# ndpi flow columns holding nested dicts, widened to <col>_<key> columns.
+explode_columns = ['xfer', 'iat', 'pktlen', 'tcp_flags']
+
+# Columns renamed for compatibility with downstream tasks.
+renamed_columns = {'first_seen': 'first_seen_ms', 'last_seen': 'last_seen_ms'}
+
+# Explicit types for the known flow columns. Other columns keep the type seen
+# in the flows file. Every column is nullable, gaps are stored as nulls.
+flow_column_types = {
+    'src_name': pa.dictionary(pa.int32(), pa.string()),
+    'dst_name': pa.dictionary(pa.int32(), pa.string()),
+    'host_server_name': pa.dictionary(pa.int32(), pa.string()),
+    'l7_protocol_name': pa.dictionary(pa.int32(), pa.string()),
+    'proto': pa.dictionary(pa.int32(), pa.string()),
+    'src_port': pa.uint16(),
+    'dst_port': pa.uint16(),
+    'first_seen_ms': pa.int64(),
+    'last_seen_ms': pa.int64(),
+    'l7_protocol_data': pa.string(),
+}
+
+# Packed 16 byte form of the src_name/dst_name addresses, IPv4 stored IPv4-mapped.
+address_columns = {'src_name': 'src_ip_bytes', 'dst_name': 'dst_ip_bytes'}
+address_bytes_columns = list(address_columns.values())
+
+# Pandas dtypes used when conforming a batch to the arrow schema.
+_nullable_dtypes = {
+    pa.int8(): 'Int8', pa.int16(): 'Int16', pa.int32(): 'Int32', pa.int64(): 'Int64',
+    pa.uint8(): 'UInt8', pa.uint16(): 'UInt16', pa.uint32(): 'UInt32', pa.uint64(): 'UInt64',
+    pa.float32(): 'Float32', pa.float64(): 'Float64', pa.bool_(): 'boolean', pa.string(): 'string',
+}
+
+
+def read_flow_records(flows_file):
+    """Generator to read the ndpiReader json lines output, skipping blank lines."""
+    with open(flows_file, 'r') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_flow_batches(flows_file, batch_size: int):
+    """Generator yielding lists of at most batch_size flow records."""
+    records = read_flow_records(flows_file)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def expand_dict_column(series: pd.Series, prefix: str) -> pd.DataFrame:
+    """
+    Widens a column of dicts into <prefix>_<key> columns in one columnar pass,
+    instead of building a Series per row with apply(pd.Series).
+    """
+    records = [value if isinstance(value, dict) else {} for value in series.tolist()]
+    expanded_df = pd.DataFrame.from_records(records, index=series.index)
+    expanded_df.columns = [f"{prefix}_{c}" for c in expanded_df.columns]
+
+    return expanded_df
+
+
+def flatten_flows(df: pd.DataFrame) -> pd.DataFrame:
+    """Widens the nested ndpi columns and normalises the flow dataframe."""
+    # Explode dict values in columns to separate columns
+    for col in explode_columns:
+        if col in df.columns:
+            df = df.join(expand_dict_column(df[col], col))
+
+    # Drop the original columns
+    df = df.drop(columns=[col for col in explode_columns if col in df.columns])
+
+    # Rename columns (if existing) for compatibility:
+    # first_seen -> first_seen_ms
+    # last_seen -> last_seen_ms
+    df = df.rename(columns=renamed_columns)
+
+    # Convert milliseconds to UTC datetime
+    df["first_seen_utc"] = pd.to_datetime(df["first_seen_ms"], unit="ms", utc=True)
+    df["last_seen_utc"] = pd.to_datetime(df["last_seen_ms"], unit="ms", utc=True)
+
+    # Convert l7_protocol_data to string.
+    # required to deal with limitations of parquet file format
+    if 'l7_protocol_data' in df.columns:
+        df['l7_protocol_data'] = df['l7_protocol_data'].map(str, na_action='ignore')
+
+    # Store the addresses in packed form alongside the display string
+    for name_col, bytes_col in address_columns.items():
+        if name_col in df.columns:
+            df[bytes_col] = pack_addresses(df[name_col])
+
+    return df
+
+
+def pack_address(address):
+    """Returns the 16 byte packed form of an address, or None if it does not parse."""
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return None
+    if ip.version == 4:
+        return b'\x00' * 10 + b'\xff\xff' + ip.packed
+    return ip.packed
+
+
+def pack_addresses(series: pd.Series) -> pd.Series:
+    """Packs each distinct address once and broadcasts the result back to the rows."""
+    categorical = series.astype('category')
+    packed = [pack_address(address) for address in categorical.cat.categories] + [None]
+    # Missing values have code -1, which picks the trailing None
+    return pd.Series(np.array(packed, dtype=object)[categorical.cat.codes.to_numpy()], index=series.index)
+
+
+def _arrow_type(types: set):
+    types = types - {type(None)}
+    if types == {bool}:
+        return pa.bool_()
+    if types == {int}:
+        return pa.int64()
+    if types <= {int, float}:
+        return pa.float64()
+    return pa.string()
+
+
+def scan_flow_schema(flows_file):
+    """
+    Streams the ndpi flows file once to build the arrow schema of the flattened
+    flow table. Returns the raw record keys and the schema, or (None, None) when
+    the file holds no flows.
+    """
+    columns = {}
+    nested = {}
+    total = 0
+
+    # Only the value types are tracked, the records themselves are dropped
+    for record in read_flow_records(flows_file):
+        total += 1
+        for key, value in record.items():
+            if key in explode_columns:
+                group = nested.setdefault(key, {})
+                if isinstance(value, dict):
+                    for sub_key, sub_value in value.items():
+                        group.setdefault(sub_key, set()).add(type(sub_value))
+            else:
+                columns.setdefault(key, set()).add(type(value))
+
+    if not total:
+        return None, None
+
+    raw_keys = list(columns) + [col for col in explode_columns if col in nested]
+    for col in explode_columns:
+        columns.update({f"{col}_{sub_key}": types for sub_key, types in nested.get(col, {}).items()})
+
+    fields = []
+    for name, types in columns.items():
+        name = renamed_columns.get(name, name)
+        fields.append(pa.field(name, flow_column_types.get(name) or _arrow_type(types)))
+
+    fields += [pa.field('first_seen_utc', pa.timestamp('ns', tz='UTC')),
+               pa.field('last_seen_utc', pa.timestamp('ns', tz='UTC'))]
+    fields += [pa.field(bytes_col, pa.binary(16))
+               for name_col, bytes_col in address_columns.items() if name_col in columns]
+
+    return raw_keys, pa.schema(fields)
+
+
+def conform_flows(df: pd.DataFrame, schema: pa.Schema) -> pd.DataFrame:
+    """Casts the flattened flow columns to the nullable dtypes of schema."""
+    df = df.reindex(columns=schema.names)
+
+    for field in schema:
+        col = df[field.name]
+        if pa.types.is_dictionary(field.type):
+            df[field.name] = col.astype('string').astype('category')
+        elif field.type == pa.string():
+            # Non-string values (e.g. nested dicts) are kept as their repr
+            df[field.name] = col.map(str, na_action='ignore').astype('string')
+        elif field.type in _nullable_dtypes:
+            df[field.name] = col.astype(_nullable_dtypes[field.type])
+
+    return df
+
+
+def flows_batch_to_table(records: list, raw_keys: list, schema: pa.Schema) -> pa.Table:
+    """Flattens a batch of flow records into an arrow table matching schema."""
+    df = pd.DataFrame.from_records(records, columns=raw_keys)
+    df = conform_flows(flatten_flows(df), schema)
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def stream_flows_to_parquet(flows_file, parquet_file, batch_size: int = None) -> int:
+    """
+    Converts the ndpiReader json lines output to typed parquet in bounded batches.
+    Each batch is flattened and appended as its own row group, so peak memory
+    is set by batch_size rather than by the number of flows. A batch_size of
+    None converts the whole file in one batch.
+    Returns the number of flows written.
+    """
+    raw_keys, schema = scan_flow_schema(flows_file)
+    if schema is None:
+        pd.DataFrame().to_parquet(parquet_file)
+        return 0
+
+    writer = None
+    written = 0
+    try:
+        for records in read_flow_batches(flows_file, batch_size):
+            table = flows_batch_to_table(records, raw_keys, schema)
+            if writer is None:
+                # The first batch carries the pandas metadata restoring the nullable dtypes
+                writer = pq.ParquetWriter(parquet_file, table.schema)
+            writer.write_table(table)
+            written += len(records)
+    finally:
+        if writer:
+            writer.close()
+
+    return written
+
+
+# Direction markers swapped when a flow was seen from the other side.
+_direction_swaps = [('src2dst', 'dst2src'), ('c_to_s', 's_to_c')]
+
+
+def flow_key(record: dict):
+    """
+    Returns the direction independent 5-tuple of a flow record, and whether
+    the record is oriented dst -> src relative to that key.
+    """
+    src = (str(record.get('src_name')), record.get('src_port') or 0)
+    dst = (str(record.get('dst_name')), record.get('dst_port') or 0)
+    reversed_ = dst < src
+    return (min(src, dst), max(src, dst), record.get('proto')), reversed_
+
+
+def _swap_direction(name: str) -> str:
+    for a, b in _direction_swaps:
+        if a in name:
+            return name.replace(a, b)
+        if b in name:
+            return name.replace(b, a)
+    return name
+
+
+def _stat_weight(xfer: dict, name: str) -> int:
+    # Packets behind a statistic, by the direction it describes
+    src2dst = xfer.get('src2dst_packets') or 0
+    dst2src = xfer.get('dst2src_packets') or 0
+    if 'c_to_s' in name:
+        return src2dst
+    if 's_to_c' in name:
+        return dst2src
+    return src2dst + dst2src
+
+
+def _merge_stats(first: dict, second: dict, xfer1: dict, xfer2: dict) -> dict:
+    # Combines the nested per-flow statistics of two parts of the same flow.
+    merged = dict(first)
+    for name, value in second.items():
+        current = first.get(name)
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or current is None:
+            merged.setdefault(name, value)
+        elif name.endswith(('_packets', '_bytes', '_count')):
+            merged[name] = current + value
+        elif not _stat_weight(xfer2, name):
+            # The second part saw no packets in this direction
+            continue
+        elif not _stat_weight(xfer1, name):
+            merged[name] = value
+        elif name.endswith('_min'):
+            merged[name] = min(current, value)
+        elif name.endswith('_max'):
+            merged[name] = max(current, value)
+
+    # Means are weighted by packets, stddevs pooled around the merged mean
+    for name in list(merged):
+        if not name.endswith('_avg') or name not in second or name not in first:
+            continue
+        w1, w2 = _stat_weight(xfer1, name), _stat_weight(xfer2, name)
+        if not w1 or not w2:
+            continue
+        mean = (first[name] * w1 + second[name] * w2) / (w1 + w2)
+        stddev_name = name[:-len('_avg')] + '_stddev'
+        if stddev_name in first and stddev_name in second:
+            variance = (w1 * (first[stddev_name] ** 2 + first[name] ** 2)
+                        + w2 * (second[stddev_name] ** 2 + second[name] ** 2)) / (w1 + w2) - mean ** 2
+            merged[stddev_name] = max(variance, 0) ** 0.5
+        merged[name] = mean
+
+    if 'data_ratio' in merged and 'src2dst_bytes' in merged and 'dst2src_bytes' in merged:
+        total_bytes = merged['src2dst_bytes'] + merged['dst2src_bytes']
+        if total_bytes:
+            merged['data_ratio'] = (merged['src2dst_bytes'] - merged['dst2src_bytes']) / total_bytes
+
+    return merged
+
+
+def merge_flow_records(first: dict, second: dict, reversed_: bool = False) -> dict:
+    """
+    Reconciles two records of the same flow cut at a shard boundary. The merged
+    record keeps the orientation of first; reversed_ marks a second record seen
+    from the other side of the conversation.
+    """
+    if reversed_:
+        second = {_swap_direction(k): ({_swap_direction(n): v for n, v in value.items()}
+                                       if isinstance(value, dict) else value)
+                  for k, value in second.items()
+                  if k not in ('src_name', 'dst_name', 'src_port', 'dst_port')}
+
+    xfer1, xfer2 = first.get('xfer') or {}, second.get('xfer') or {}
+    merged = dict(first)
+    for name, value in second.items():
+        if name == 'first_seen':
+            merged[name] = min(first.get(name, value), value)
+        elif name == 'last_seen':
+            merged[name] = max(first.get(name, value), value)
+        elif name in explode_columns and isinstance(value, dict):
+            merged[name] = _merge_stats(first.get(name) or {}, value, xfer1, xfer2)
+        elif name == 'l7_protocol_name' and first.get(name) in (None, 'Unknown'):
+            merged[name] = value
+        else:
+            merged.setdefault(name, value)
+
+    return merged
+
+
+def merge_shard_flows(shard_flow_files: list, flows_file) -> int:
+    """
+    Merges the ndpiReader json lines output of consecutive time shards into a
+    single flows file. Flows whose 5-tuple continues from one shard into the
+    next are reconciled into one record. The flows of the previous and the
+    current shard are held in memory, no more.
+    Every shard numbers its flows from scratch, so flow_ids are offset past
+    those of the shards before it: flow_ids are unique per capture, and a
+    reconciled flow keeps the id it had in the first shard it appeared in.
+    Returns the number of flows written.
+    """
+    written = 0
+    previous = {}
+    offset = 0
+    with open(flows_file, 'w') as out_file:
+        def write(record):
+            nonlocal written
+            out_file.write(json.dumps(record) + "\n")
+            written += 1
+
+        for shard_file in shard_flow_files:
+            current = {}
+            next_offset = offset
+            for record in read_flow_records(shard_file):
+                if isinstance(record.get('flow_id'), int):
+                    record['flow_id'] += offset
+                    next_offset = max(next_offset, record['flow_id'] + 1)
+                key, reversed_ = flow_key(record)
+                if key in previous:
+                    base, base_reversed = previous.pop(key)
+                    current[key] = (merge_flow_records(base, record, reversed_ != base_reversed), base_reversed)
+                    continue
+                if key in current:
+                    # ndpiReader split the flow itself (e.g. idle timeout)
+                    write(current[key][0])
+                current[key] = (record, reversed_)
+
+            # Flows not continued in this shard are complete
+            for record, _ in previous.values():
+                write(record)
+            previous = current
+            offset = next_offset
+
+        for record, _ in previous.values():
+            write(record)
+
+    return written
@@ -0,0 +1,179 @@
+# Offline GeoIP/ASN enrichment of the flow table.
+# Country and ASN databases in the MaxMind DB format (GeoLite2, GeoIP2 or
+# compatible) are memory-mapped and queried once per distinct address, not
+# once per flow. The distinct addresses are looked up in sorted order, and
+# every record found covers the network it is stored for, so the following
+# addresses in that network reuse it without another lookup.
+#
+# Results are memoized per address in a parquet file shared by all captures,
+# most recently used first, and dropped when a database is updated. They are
+# broadcast back to the flows as dictionary (categorical) columns per side,
+# written row for row next to the flow table.
+
+import bisect
+import json
+import os
+
+import maxminddb
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from tpahelper.utils.addresses import address_column, distinct_addresses, format_addresses, split_packed
+from tpahelper.utils.flows import address_columns
+
+MAX_ENTRIES = 5_000_000
+
+geoip_fields = {
+    'country': pa.string(),
+    # 'AS15169', as OTX writes it; parquet keeps only string dictionaries categorical
+    'asn': pa.string(),
+    'org': pa.string(),
+}
+geoip_cache_schema = pa.schema([('ip_bytes', pa.binary(16))] + list(geoip_fields.items()))
+geoip_schema = pa.schema(
+    [(f"{name_col.split('_')[0]}_{field}", pa.dictionary(pa.int32(), arrow_type))
+     for name_col in address_columns for field, arrow_type in geoip_fields.items()])
+
+
+def record_fields(record) -> dict:
+    """country, asn and org of a City, Country or ASN database record, None where it has none."""
+    record = record if isinstance(record, dict) else {}
+    country = None
+    # The registered country stands in when no location is known, e.g. for anycast networks
+    for key in ('country', 'registered_country'):
+        if isinstance(record.get(key), dict) and record[key].get('iso_code'):
+            country = record[key]['iso_code']
+            break
+    asn = record.get('autonomous_system_number')
+    return {'country': country, 'asn': f"AS{asn}" if asn is not None else None,
+            'org': record.get('autonomous_system_organization')}
+
+
+def open_databases(database_files: list) -> list:
+    """Memory-mapped readers of the database files that exist."""
+    return [maxminddb.open_database(path, maxminddb.MODE_MMAP)
+            for path in database_files if path and os.path.exists(path)]
+
+
+def database_signature(readers: list) -> str:
+    return json.dumps([(m.database_type, m.build_epoch, m.ip_version)
+                       for m in (reader.metadata() for reader in readers)])
+
+
+def _lookup_sorted(reader, values: list, texts: list, width: int):
+    # One lookup per network: the record of values[i] also holds for the
+    # following values up to the last address of its network
+    records = [None] * len(values)
+    lookups = 0
+    i = 0
+    while i < len(values):
+        record, prefix_len = reader.get_with_prefix_len(texts[i])
+        lookups += 1
+        last = values[i] | ((1 << (width - prefix_len)) - 1)
+        end = bisect.bisect_right(values, last, i + 1)
+        records[i:end] = [record] * (end - i)
+        i = end
+    return records, lookups
+
+
+def lookup_addresses(readers: list, ip_bytes: pa.Array):
+    """
+    Rows of geoip_cache_schema for a sorted, distinct binary(16) array of
+    packed addresses, and the number of database lookups it took.
+    """
+    hi, lo, ipv4 = split_packed(ip_bytes)
+    texts = format_addresses(ip_bytes).to_pylist()
+    values = [(h << 64) | l for h, l in zip(hi.tolist(), lo.tolist())]
+    # IPv4 prefixes count from the start of the IPv4 space, so each version is walked on its own
+    versions = [(rows, width) for rows, width in
+                ((np.flatnonzero(ipv4).tolist(), 32), (np.flatnonzero(~ipv4).tolist(), 128)) if rows]
+
+    fields = {field: [None] * len(ip_bytes) for field in geoip_fields}
+    lookups = 0
+    for reader in readers:
+        records = [None] * len(ip_bytes)
+        for rows, width in versions:
+            if width == 128 and reader.metadata().ip_version == 4:
+                continue
+            found, count = _lookup_sorted(reader, [values[r] for r in rows], [texts[r] for r in rows], width)
+            lookups += count
+            for row, record in zip(rows, found):
+                records[row] = record
+        # Later databases fill the fields the earlier ones left empty
+        for position, record in enumerate(records):
+            if record is not None:
+                for field, value in record_fields(record).items():
+                    if fields[field][position] is None:
+                        fields[field][position] = value
+    return pa.Table.from_pydict({'ip_bytes': ip_bytes, **fields}, schema=geoip_cache_schema), lookups
+
+
+def read_memo(memo_file, signature: str) -> pa.Table:
+    """The memoized results of memo_file, empty when it is missing or was made with other databases."""
+    if os.path.exists(memo_file):
+        try:
+            memo = pq.read_table(memo_file, schema=geoip_cache_schema)
+            metadata = pq.read_schema(memo_file).metadata or {}
+            if metadata.get(b'signature', b'').decode() == signature:
+                return memo
+        except (OSError, pa.ArrowInvalid):
+            pass
+    return geoip_cache_schema.empty_table()
+
+
+def write_memo(memo_file, memo: pa.Table, signature: str):
+    os.makedirs(os.path.dirname(os.path.abspath(memo_file)), exist_ok=True)
+    tmp_file = f"{memo_file}.tmp"
+    pq.write_table(memo.replace_schema_metadata({'signature': signature}), tmp_file)
+    os.replace(tmp_file, memo_file)
+
+
+def _sorted(ip_bytes: pa.Array) -> pa.Array:
+    hi, lo, _ = split_packed(ip_bytes)
+    return ip_bytes.take(pa.array(np.lexsort((lo, hi))))
+
+
+def geoip_flows(flows_parquet, database_files: list, memo_file, output_parquet,
+                max_entries: int = MAX_ENTRIES):
+    """
+    Writes the geoip_schema columns of the flows in flows_parquet to
+    output_parquet, one row per flow, and returns them with the counts of
+    distinct addresses, memo hits and database lookups.
+    """
+    readers = open_databases(database_files)
+    try:
+        signature = database_signature(readers)
+        unique = _sorted(distinct_addresses(flows_parquet))
+        memo = read_memo(memo_file, signature)
+        known = pc.is_in(unique, value_set=memo['ip_bytes'].combine_chunks())
+        new, lookups = lookup_addresses(readers, unique.filter(pc.invert(known)))
+    finally:
+        for reader in readers:
+            reader.close()
+
+    seen = pc.is_in(memo['ip_bytes'], value_set=unique)
+    results = pa.concat_tables([memo.filter(seen), new])
+    if readers:
+        # This capture's addresses go first, the least recently used ones fall off the end
+        memo = pa.concat_tables([results, memo.filter(pc.invert(seen))])
+        write_memo(memo_file, memo.slice(0, max(max_entries, results.num_rows)), signature)
+
+    # Every field is encoded once per distinct address and broadcast to the flows by index
+    encoded = {field: results[field].combine_chunks().dictionary_encode() for field in geoip_fields}
+    num_rows = pq.read_metadata(flows_parquet).num_rows
+    columns = []
+    for name_col in address_columns:
+        addresses = address_column(flows_parquet, name_col)
+        if len(addresses) != num_rows:
+            addresses = pa.nulls(num_rows, pa.binary(16))
+        positions = pc.index_in(addresses, value_set=results['ip_bytes'].combine_chunks()).combine_chunks()
+        for field in geoip_fields:
+            columns.append(pa.DictionaryArray.from_arrays(encoded[field].indices.take(positions),
+                                                          encoded[field].dictionary))
+    table = pa.Table.from_arrays(columns, schema=geoip_schema)
+    pq.write_table(table, output_parquet)
+    stats = {'addresses': len(unique), 'hits': len(unique) - new.num_rows, 'lookups': lookups,
+             'databases': len(readers)}
+    return table, stats
@@ -0,0 +1,120 @@
+# Persistent indicator cache shared by all captures.
+# Threat intelligence responses are stored in a SQLite database keyed by
+# (indicator, type), so a host seen in several captures is only queried once
+# per ttl. Failed lookups are cached too, for the shorter negative_ttl, so a
+# failing indicator isn't retried by every run. Entries are compressed JSON;
+# the least recently used ones are evicted once the stored responses grow
+# past max_bytes.
+#
+# Usage:
+#   with IndicatorCache(cache_file) as cache:
+#       hits = cache.get_many([('8.8.8.8', 'ipv4')])
+#       cache.put('1.1.1.1', 'ipv4', data)
+
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+TTL = 7 * 24 * 3600
+NEGATIVE_TTL = 3600
+MAX_BYTES = 1024 ** 3
+# SQLite host parameter limit is 999 on older builds
+QUERY_CHUNK = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS indicators (
+    indicator TEXT NOT NULL,
+    type TEXT NOT NULL,
+    fetched REAL NOT NULL,
+    accessed REAL NOT NULL,
+    failed INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (indicator, type)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS indicators_accessed ON indicators (accessed);
+"""
+
+
+class IndicatorCache:
+    """
+    SQLite store of indicator responses. Entries older than ttl (negative_ttl
+    for failures) are misses. Safe to share between processes, writes wait
+    for each other.
+    """
+
+    def __init__(self, cache_file, ttl: float = TTL, negative_ttl: float = NEGATIVE_TTL,
+                 max_bytes: int = MAX_BYTES):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        self._db = sqlite3.connect(cache_file, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+    def get_many(self, keys: list) -> dict:
+        """Fresh cached responses of the given (indicator, type) pairs, keyed by pair. Hits count as a use."""
+        now = time.time()
+        hits = {}
+        keys = list(keys)
+        for first in range(0, len(keys), QUERY_CHUNK):
+            chunk = keys[first:first + QUERY_CHUNK]
+            rows = self._db.execute(
+                "SELECT indicator, type, fetched, failed, data FROM indicators WHERE (indicator, type) IN "
+                f"(VALUES {','.join(['(?, ?)'] * len(chunk))})",
+                [value for key in chunk for value in key]).fetchall()
+            for indicator, indicator_type, fetched, failed, data in rows:
+                if now - fetched <= (self.negative_ttl if failed else self.ttl):
+                    hits[(indicator, indicator_type)] = json.loads(zlib.decompress(data))
+        with self._db:
+            self._db.executemany("UPDATE indicators SET accessed = ? WHERE indicator = ? AND type = ?",
+                                 [(now, indicator, indicator_type) for indicator, indicator_type in hits])
+        return hits
+
+    def get(self, indicator: str, indicator_type: str):
+        return self.get_many([(indicator, indicator_type)]).get((indicator, indicator_type))
+
+    def put(self, indicator: str, indicator_type: str, data: dict, failed: bool = None):
+        """Stores a response, as a failure when failed (default: when it has an 'error' key)."""
+        if failed is None:
+            failed = 'error' in data
+        now = time.time()
+        blob = zlib.compress(json.dumps(data).encode())
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO indicators VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (indicator, indicator_type, now, now, int(failed), len(blob), blob))
+
+    def evict(self) -> int:
+        """Drops expired entries, then the least recently used ones past max_bytes. Returns the count removed."""
+        now = time.time()
+        with self._db:
+            removed = self._db.execute(
+                "DELETE FROM indicators WHERE (failed = 0 AND fetched < ?) OR (failed = 1 AND fetched < ?)",
+                (now - self.ttl, now - self.negative_ttl)).rowcount
+            total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM indicators").fetchone()[0]
+            if total > self.max_bytes:
+                # Oldest accesses first, until the total is under the cap
+                evicted = []
+                for indicator, indicator_type, size in self._db.execute(
+                        "SELECT indicator, type, size FROM indicators ORDER BY accessed"):
+                    evicted.append((indicator, indicator_type))
+                    total -= size
+                    if total <= self.max_bytes:
+                        break
+                self._db.executemany("DELETE FROM indicators WHERE indicator = ? AND type = ?", evicted)
+                removed += len(evicted)
+        return removed
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,69 +1,63 @@
 # script to summarize the OTX data output if the pipeline is stopped.
-# pcaps with a high number of public ips will have troubles completing the task.
-# to be fixed.
+# IPReputation summarizes results as they arrive and resumes from the summary
+# when rerun; this adds any raw OTX files missing from the summary (e.g. of
+# runs made before the summary was incremental) and writes the html page.
+# The capture is given by path or by the filename it was uploaded under, and
+# its results are found through the cache index:
+#   python -m tpahelper.utils.manual_summarize_otx eth_miner.pcap
 
 import glob
 import json
 import os
-import pandas as pd
-from pandas import json_normalize
+import sys
 
+from tpahelper.config import config
+from tpahelper.utils.cache import lookup_capture, register_capture, resolve_alias
 from tpahelper.utils.html_templates import datatable_template
+from tpahelper.utils.reputation import ReputationWriter, compact_reputation
 
 
-pcap_name = 'eth_miner'
-base_dir = os.path.abspath(os.path.dirname(__file__))
-indicator_path = os.path.join(base_dir, f'../processed/{pcap_name}/indicators/')
-raw_indicator_path = os.path.join(indicator_path, 'raw')
-otx_files = glob.glob(f'{raw_indicator_path}/*.json')
+def capture_digest(capture, output_dir):
+    """Digest keying the results of a capture given by path, or by the filename it was uploaded under."""
+    if os.path.isfile(capture):
+        return lookup_capture(capture, output_dir) or register_capture(capture, output_dir)
+    return resolve_alias(os.path.basename(capture), output_dir)
 
-out_parquet = os.path.join(indicator_path, "ip_reputation.parquet")
-out_html = os.path.join(indicator_path, "ip_reputation.html")
 
-main_df_list = []
-pulses_df_list = []
+def summarize_otx(indicator_path):
+    raw_indicator_path = os.path.join(indicator_path, 'raw')
+    otx_files = glob.glob(f'{raw_indicator_path}/otx_*.json')
 
-if not otx_files:
-    raise FileNotFoundError(f"No OTX files found in {raw_indicator_path}")
+    out_parquet = os.path.join(indicator_path, "ip_reputation.parquet")
+    out_html = os.path.join(indicator_path, "ip_reputation.html")
 
-for file in otx_files:
-    with open(file, 'r') as infile:
-        data = json.load(infile)
+    if not otx_files:
+        raise FileNotFoundError(f"No OTX files found in {raw_indicator_path}")
 
-        # Normalize main data, excluding the deeply nested 'pulses' first
-        this_df = json_normalize(data)
-        if 'pulse_info.pulses' in this_df.columns:
-            this_df.drop(columns=['pulse_info.pulses'], inplace=True)
+    with ReputationWriter(out_parquet) as writer:
+        for file in otx_files:
+            # otx_{type}_{indicator}.json
+            indicator_type, _, indicator = os.path.basename(file)[len('otx_'):-len('.json')].partition('_')
+            if (indicator, indicator_type) in writer.done:
+                continue
+            with open(file, 'r') as infile:
+                writer.add(indicator, indicator_type, json.load(infile))
 
-        # Store each main DataFrame to list
-        main_df_list.append(this_df)
+    df = compact_reputation(out_parquet).to_pandas()
+    html_table = df.to_html(classes='display', index=False, table_id='dataTable')
 
-        # Check if 'pulse_info.pulses' is present and process if available
-        if 'pulse_info.pulses' in data:
-            # Normalize pulses data
-            pulses = json_normalize(data, record_path=['pulse_info', 'pulses'])
-            # Add an identifier if necessary (e.g., from the main data)
-            if 'indicator' in this_df.columns:
-                pulses['indicator'] = data['indicator']
-            pulses_df_list.append(pulses)
+    page = datatable_template.format(html_table)
+    with open(out_html, 'w') as out_file:
+        out_file.write(page)
 
-# Concatenate all main dataframes into a single DataFrame
-main_df = pd.concat(main_df_list, ignore_index=True, sort=False)
 
-# Concatenate all pulses dataframes into a single DataFrame
-if pulses_df_list:
-    pulses_df = pd.concat(pulses_df_list, ignore_index=True, sort=False)
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m tpahelper.utils.manual_summarize_otx <pcap file or name> [output dir]")
+        sys.exit(1)
 
-    # Join pulses to the main DataFrame based on an identifier or directly if the order is preserved
-    # Here we assume 'indicator' to be the linking column; adjust as necessary
-    df = pd.merge(main_df, pulses_df, on='indicator', how='left', suffixes=('', '_pulse'))
-else:
-    df = main_df  # No pulses data to merge
-
-# Write the DataFrame to parquet file
-df.to_parquet(out_parquet)
-html_table = df.to_html(classes='display', index=False, table_id='dataTable')
-
-page = datatable_template.format(html_table)
-with open(out_html, 'w') as out_file:
-    out_file.write(page)
\ No newline at end of file
+    output_dir = sys.argv[2] if len(sys.argv) > 2 else config.OUTPUT_DIR
+    digest = capture_digest(sys.argv[1], output_dir)
+    if digest is None:
+        raise FileNotFoundError(f"No results found for {sys.argv[1]} in {output_dir}")
+    summarize_otx(os.path.join(output_dir, digest, 'indicators'))
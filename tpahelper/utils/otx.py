@@ -0,0 +1,210 @@
+# Asynchronous AlienVault OTX enrichment.
+# All indicators of a capture are queried from one asyncio event loop over a
+# single pooled aiohttp session, so connections (and their TLS handshakes)
+# are reused across requests. At most `concurrency` requests are in flight,
+# a token bucket keeps the request rate under `rate` per second, and
+# throttled (429), failed (5xx) or dropped requests are retried with
+# exponential backoff. Every indicator's response is written to its own
+# otx_{type}_{indicator}.json file, as the summary expects. Error records
+# are not: a failed indicator is queried again by the next run (or after the
+# cache's negative ttl), instead of staying failed for the capture.
+#
+# With an IndicatorCache, only indicators missing from it (or expired) go to
+# the network, and every response is stored in it for the next captures.
+# on_result(indicator, type, response) is called with every result as it
+# arrives, e.g. to summarize incrementally.
+#
+# base_url replaces the OTX host, e.g. to point the client at a local stub
+# server (see bench_otx in benchmarks).
+#
+# Usage:
+#   query_indicators([('8.8.8.8', 'ipv4'), ('2001:4860:4860::8888', 'ipv6')], raw_dir)
+
+import asyncio
+import json
+import os
+import random
+import time
+from urllib.parse import quote, urlsplit
+
+import aiohttp
+from termcolor import colored
+
+from tpahelper.utils.external_commands import otx_ipv4, otx_ipv6
+
+CONCURRENCY = 16
+RATE = 10.0
+RETRIES = 5
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+TIMEOUT = 30
+PROGRESS_EVERY = 1000
+
+otx_urls = {'ipv4': otx_ipv4, 'ipv6': otx_ipv6}
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def indicator_url(indicator: str, indicator_type: str, base_url: str = None) -> str:
+    """OTX general section URL of an indicator, on base_url's host when given."""
+    url = otx_urls[indicator_type].format(quote(indicator, safe=''))
+    if base_url:
+        url = base_url.rstrip('/') + urlsplit(url).path
+    return url
+
+
+def indicator_file(raw_dir, indicator: str, indicator_type: str) -> str:
+    return os.path.join(raw_dir, f"otx_{indicator_type}_{indicator}.json")
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, in bursts of at most `burst`."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def _retry_delay(attempt: int, backoff: float, retry_after: str = None) -> float:
+    # Retry-After (in seconds) wins, otherwise exponential backoff with full jitter
+    if retry_after:
+        try:
+            return min(MAX_BACKOFF, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return random.uniform(0, min(MAX_BACKOFF, backoff * 2 ** attempt))
+
+
+async def fetch_indicator(session: aiohttp.ClientSession, bucket: TokenBucket, url: str, indicator: str,
+                          retries: int = RETRIES, backoff: float = BACKOFF) -> dict:
+    """
+    OTX response of one indicator. After `retries` failed retries, or on a
+    response that retrying can't fix, an error record is returned instead.
+    """
+    for attempt in range(retries + 1):
+        await bucket.acquire()
+        retry_after = None
+        try:
+            async with session.get(url) as resp:
+                if resp.status == 200:
+                    return await resp.json(content_type=None)
+                if resp.status not in RETRY_STATUS:
+                    return {'error': 'Failed to fetch data', 'indicator': indicator, 'status': resp.status}
+                retry_after = resp.headers.get('Retry-After')
+                reason = f"HTTP {resp.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            reason = f"{type(e).__name__}: {e}"
+        if attempt < retries:
+            await asyncio.sleep(_retry_delay(attempt, backoff, retry_after))
+    return {'error': 'Failed to fetch data', 'indicator': indicator, 'reason': reason}
+
+
+def _write_json(output_file, data):
+    tmp_file = f"{output_file}.tmp"
+    with open(tmp_file, 'w') as out_file:
+        json.dump(data, out_file)
+    os.replace(tmp_file, output_file)
+
+
+def _read_raw(raw_file):
+    # Stored response of an indicator, None when it has to be queried. Error
+    # records written by earlier versions count as missing.
+    try:
+        with open(raw_file, 'r') as infile:
+            data = json.load(infile)
+    except (FileNotFoundError, ValueError):
+        return None
+    return None if isinstance(data, dict) and 'error' in data else data
+
+
+async def _query_indicators(indicators: list, raw_dir, concurrency: int, rate: float, retries: int,
+                            backoff: float, base_url: str, api_key: str, cache, on_result, stats: dict):
+    bucket = TokenBucket(rate, burst=concurrency)
+    slots = asyncio.Semaphore(concurrency)
+    headers = {'X-OTX-API-KEY': api_key} if api_key else None
+    connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    started = time.monotonic()
+
+    async def query(indicator, indicator_type):
+        async with slots:
+            data = await fetch_indicator(session, bucket, indicator_url(indicator, indicator_type, base_url),
+                                         indicator, retries, backoff)
+        if 'error' not in data:
+            _write_json(indicator_file(raw_dir, indicator, indicator_type), data)
+        if cache is not None:
+            cache.put(indicator, indicator_type, data)
+        if on_result is not None:
+            on_result(indicator, indicator_type, data)
+        stats['failed' if 'error' in data else 'fetched'] += 1
+        done = stats['fetched'] + stats['failed']
+        if done % PROGRESS_EVERY == 0:
+            print(colored(f"\tOTX: {done}/{len(indicators)} indicators, "
+                          f"{done / (time.monotonic() - started):.1f}/s", "green"))
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers) as session:
+        await asyncio.gather(*(query(indicator, indicator_type) for indicator, indicator_type in indicators))
+
+
+def query_indicators(indicators: list, raw_dir, concurrency: int = CONCURRENCY, rate: float = RATE,
+                     retries: int = RETRIES, backoff: float = BACKOFF, base_url: str = None,
+                     api_key: str = None, cache=None, on_result=None) -> dict:
+    """
+    Queries OTX for every (indicator, type) pair and writes the responses to
+    raw_dir. Indicators whose file already exists are skipped, so an
+    interrupted run resumes where it stopped, and fresh entries of cache (an
+    IndicatorCache) are used without a request. Failures get no file, so
+    they are pending again on the next run. Every result, skipped ones
+    included, is passed to on_result(indicator, type, response) when given.
+    A rate of 0 disables the rate limit. Returns the fetched, failed and
+    skipped counts, and the cache hits and misses.
+    """
+    os.makedirs(raw_dir, exist_ok=True)
+    stats = {'fetched': 0, 'failed': 0, 'skipped': 0, 'hits': 0, 'misses': 0}
+    pending = []
+    for indicator, indicator_type in indicators:
+        if indicator_type not in otx_urls:
+            data = {'error': 'Invalid indicator type', 'indicator': indicator}
+            stats['failed'] += 1
+        else:
+            data = _read_raw(indicator_file(raw_dir, indicator, indicator_type))
+            if data is None:
+                pending.append((indicator, indicator_type))
+                continue
+            stats['skipped'] += 1
+        if on_result is not None:
+            on_result(indicator, indicator_type, data)
+
+    if cache is not None and pending:
+        hits = cache.get_many(pending)
+        for (indicator, indicator_type), data in hits.items():
+            if 'error' not in data:
+                _write_json(indicator_file(raw_dir, indicator, indicator_type), data)
+            if on_result is not None:
+                on_result(indicator, indicator_type, data)
+        pending = [key for key in pending if key not in hits]
+        stats['hits'] = len(hits)
+        stats['misses'] = len(pending)
+
+    if pending:
+        asyncio.run(_query_indicators(pending, raw_dir, max(1, concurrency), rate, retries, backoff,
+                                      base_url, api_key, cache, on_result, stats))
+    if cache is not None:
+        cache.evict()
+    return stats
@@ -0,0 +1,300 @@
+# Packet offset index.
+# A columnar sidecar recording the file offset, record size, timestamp and
+# flow id of every packet in a capture. Extracting a flow or a time range is
+# then a lookup in the index followed by seek-and-copy of the matching
+# records, instead of a filtered rescan of the whole capture.
+#
+# The rows are written twice: in packet order, where the timestamps grow
+# and row group statistics prune time range lookups, and sorted by flow id
+# in a second file, where they prune flow lookups to the row groups holding
+# those flows. The flow ordered copy is built with a bucketed external sort:
+# every row group is also sorted by flow id and spilled to a raw file, with
+# the row count per flow id range, and at the end each run of ranges is read
+# back from all spilled groups, sorted and written, one row group at a time.
+
+import hashlib
+import os
+from array import array
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from tpahelper.utils.demux import flow_tuple, packet_flow_key, protocol_numbers
+from tpahelper.utils.flows import pack_address
+from tpahelper.utils.pcap import PcapReader, PcapWriter, decode_packet
+
+INDEX_SUFFIX = ".index.parquet"
+ROW_GROUP_SIZE = 1_000_000
+# Flow ids are spilled in 2 ** RANGE_BITS ranges of their top bits
+RANGE_BITS = 12
+
+index_schema = pa.schema([
+    ('offset', pa.uint64()),
+    ('size', pa.uint32()),
+    ('ts_ns', pa.int64()),
+    ('flow_id', pa.int64()),
+])
+_spill_dtype = np.dtype([('offset', np.uint64), ('size', np.uint32), ('ts_ns', np.int64), ('flow_id', np.int64)])
+
+
+def index_path(pcap_file) -> str:
+    """Default sidecar location of the index of pcap_file."""
+    return f"{pcap_file}{INDEX_SUFFIX}"
+
+
+def flow_index_path(index_file) -> str:
+    """Location of the flow ordered copy of index_file."""
+    root, ext = os.path.splitext(index_file)
+    return f"{root}.flows{ext}"
+
+
+def _key_bytes(key) -> bytes:
+    proto, (a_addr, a_port), (b_addr, b_port) = key
+    return (proto.to_bytes(1, 'big') + a_addr + a_port.to_bytes(2, 'big')
+            + b_addr + b_port.to_bytes(2, 'big'))
+
+
+def key_flow_id(key) -> int:
+    """Stable 64 bit id of a direction independent 5-tuple, 0 for non-IP packets."""
+    if key is None:
+        return 0
+    return int.from_bytes(hashlib.blake2b(_key_bytes(key), digest_size=8).digest(), 'big', signed=True)
+
+
+def flow_id(proto, src, sport, dst, dport) -> int:
+    """
+    Returns the flow id of a 5-tuple given as strings or numbers, e.g.
+    flow_id('TCP', '10.0.0.1', 51000, '10.0.0.2', 502). Either direction gives the same id.
+    """
+    if not isinstance(proto, int):
+        proto = int(proto) if str(proto).isdigit() else protocol_numbers[str(proto).lower()]
+    src_bytes, dst_bytes = pack_address(src), pack_address(dst)
+    if src_bytes is None or dst_bytes is None:
+        raise ValueError(f"Invalid address in flow {src} -> {dst}")
+    return key_flow_id(flow_tuple(proto, src_bytes, int(sport or 0), dst_bytes, int(dport or 0)))
+
+
+class PacketIndexBuilder:
+    """
+    Accumulates index rows while a capture is read and writes them to the
+    sidecar in row groups, so memory stays bounded for any capture size.
+
+    Usage:
+        with PacketIndexBuilder(pcap_file, index_file) as builder:
+            for record in reader:
+                builder.add(record, decode_packet(record.linktype, record.data))
+    """
+
+    def __init__(self, pcap_file, index_file=None):
+        self.pcap_file = pcap_file
+        self.index_file = index_file or index_path(pcap_file)
+        self.flow_index_file = flow_index_path(self.index_file)
+        self.count = 0
+        self._tmp_file = f"{self.index_file}.tmp"
+        self._flow_tmp_file = f"{self.flow_index_file}.tmp"
+        self._spill_file = f"{self.index_file}.spill"
+        self._writer = None
+        self._spill = None
+        # Per spilled row group: its first row in the spill file and its row count per range
+        self._runs = []
+        self._flow_ids = {}
+        self._reset()
+
+    def _reset(self):
+        self._offset = array('Q')
+        self._size = array('I')
+        self._ts = array('q')
+        self._flow = array('q')
+
+    def add(self, record, info):
+        key = packet_flow_key(info)
+        flow = self._flow_ids.get(key)
+        if flow is None:
+            flow = self._flow_ids[key] = key_flow_id(key)
+        self._offset.append(record.offset)
+        self._size.append(record.size)
+        self._ts.append(record.ts_ns)
+        self._flow.append(flow)
+        if len(self._offset) >= ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._writer is None:
+            stat = os.stat(self.pcap_file)
+            self._schema = index_schema.with_metadata({
+                'pcap_size': str(stat.st_size), 'pcap_mtime_ns': str(stat.st_mtime_ns)})
+            self._writer = pq.ParquetWriter(self._tmp_file, self._schema)
+            self._spill = open(self._spill_file, 'wb')
+        rows = np.empty(len(self._offset), dtype=_spill_dtype)
+        for name, column in (('offset', self._offset), ('size', self._size), ('ts_ns', self._ts),
+                             ('flow_id', self._flow)):
+            rows[name] = np.frombuffer(column, dtype=_spill_dtype[name])
+        self._writer.write_table(pa.Table.from_arrays([pa.array(rows[name]) for name in index_schema.names],
+                                                      schema=self._schema))
+        # A stable sort keeps the packets of each flow in capture order
+        rows = rows[np.argsort(rows['flow_id'], kind='stable')]
+        rows.tofile(self._spill)
+        self._runs.append((self.count, np.bincount(_flow_range(rows['flow_id']), minlength=1 << RANGE_BITS)))
+        self.count += len(rows)
+        self._reset()
+
+    def _write_flow_index(self):
+        with pq.ParquetWriter(self._flow_tmp_file, self._schema) as writer:
+            if not self.count:
+                return
+            spill = np.memmap(self._spill_file, dtype=_spill_dtype, mode='r')
+            bounds = [(start, np.r_[0, np.cumsum(counts)]) for start, counts in self._runs]
+            totals = np.sum([counts for _, counts in self._runs], axis=0)
+            # Consecutive ranges are read back from every run until they fill a row group
+            first = pending = 0
+            for last, total in enumerate(totals.tolist()):
+                pending += total
+                if pending < ROW_GROUP_SIZE and last + 1 < len(totals):
+                    continue
+                if pending:
+                    rows = np.concatenate([spill[start + ends[first]:start + ends[last + 1]]
+                                           for start, ends in bounds])
+                    rows = rows[np.argsort(rows['flow_id'], kind='stable')]
+                    writer.write_table(pa.Table.from_arrays([pa.array(rows[name]) for name in index_schema.names],
+                                                            schema=self._schema))
+                first, pending = last + 1, 0
+            del spill
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+        self._spill.close()
+        try:
+            self._write_flow_index()
+        finally:
+            os.remove(self._spill_file)
+        os.replace(self._flow_tmp_file, self.flow_index_file)
+        os.replace(self._tmp_file, self.index_file)
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._spill.close()
+            for path in (self._tmp_file, self._spill_file, self._flow_tmp_file):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _flow_range(flow_ids: np.ndarray) -> np.ndarray:
+    # Range of each flow id by its top bits, in flow id order
+    return (flow_ids >> (64 - RANGE_BITS)) + (1 << (RANGE_BITS - 1))
+
+
+def build_packet_index(pcap_file, index_file=None) -> int:
+    """Indexes pcap_file in a single pass. Returns the number of packets indexed."""
+    with PcapReader(pcap_file) as reader, PacketIndexBuilder(pcap_file, index_file) as builder:
+        for record in reader:
+            builder.add(record, decode_packet(record.linktype, record.data))
+    return builder.count
+
+
+def is_current(pcap_file, index_file=None) -> bool:
+    """True when the index and its flow ordered copy exist and were built from the current pcap_file."""
+    index_file = index_file or index_path(pcap_file)
+    stat = os.stat(pcap_file)
+    for path in (index_file, flow_index_path(index_file)):
+        if not os.path.exists(path):
+            return False
+        metadata = pq.read_schema(path).metadata or {}
+        if (metadata.get(b'pcap_size') != str(stat.st_size).encode()
+                or metadata.get(b'pcap_mtime_ns') != str(stat.st_mtime_ns).encode()):
+            return False
+    return True
+
+
+def ensure_packet_index(pcap_file, index_file=None) -> str:
+    """Returns the index of pcap_file, building it first when missing or stale."""
+    index_file = index_file or index_path(pcap_file)
+    if not is_current(pcap_file, index_file):
+        build_packet_index(pcap_file, index_file)
+    return index_file
+
+
+def _flow_row_groups(parquet_file, flow_ids: np.ndarray) -> list:
+    # Row groups whose flow_id statistics span one of the sorted flow_ids
+    column = parquet_file.schema_arrow.get_field_index('flow_id')
+    row_groups = []
+    for i in range(parquet_file.metadata.num_row_groups):
+        stats = parquet_file.metadata.row_group(i).column(column).statistics
+        if stats is None or not stats.has_min_max:
+            row_groups.append(i)
+        elif np.searchsorted(flow_ids, stats.max, side='right') > np.searchsorted(flow_ids, stats.min):
+            row_groups.append(i)
+    return row_groups
+
+
+def select_packets(index_file, flow_ids=None, start_ns: int = None, end_ns: int = None):
+    """
+    Returns the offsets, sizes and timestamps of the indexed packets matching
+    the flows and time range, in capture order.
+    """
+    if flow_ids is None:
+        filters = []
+        if start_ns is not None:
+            filters.append(('ts_ns', '>=', start_ns))
+        if end_ns is not None:
+            filters.append(('ts_ns', '<=', end_ns))
+        table = pq.read_table(index_file, columns=['offset', 'size', 'ts_ns'], filters=filters or None)
+    else:
+        # Only the row groups of the flow ordered copy holding these flows are read
+        flow_ids = np.unique(np.asarray(list(flow_ids), dtype=np.int64))
+        parquet_file = pq.ParquetFile(flow_index_path(index_file))
+        table = parquet_file.read_row_groups(_flow_row_groups(parquet_file, flow_ids),
+                                             columns=['offset', 'size', 'ts_ns', 'flow_id'])
+        mask = pc.is_in(table['flow_id'], value_set=pa.array(flow_ids))
+        if start_ns is not None:
+            mask = pc.and_(mask, pc.greater_equal(table['ts_ns'], start_ns))
+        if end_ns is not None:
+            mask = pc.and_(mask, pc.less_equal(table['ts_ns'], end_ns))
+        table = table.filter(mask)
+        table = table.take(pc.sort_indices(table['offset']))
+    return table['offset'].to_numpy(), table['size'].to_numpy(), table['ts_ns'].to_numpy()
+
+
+def slice_capture(pcap_file, output_pcap, flow_ids=None, start_ns: int = None, end_ns: int = None,
+                  index_file=None) -> int:
+    """
+    Copies the packets of the given flows and/or time range to output_pcap.
+    Records of classic pcaps are copied verbatim, pcapng packets are rewritten
+    as pcap. Returns the number of packets written.
+    """
+    index_file = ensure_packet_index(pcap_file, index_file)
+    offsets, sizes, timestamps = select_packets(index_file, flow_ids, start_ns, end_ns)
+
+    with PcapReader(pcap_file) as reader:
+        if reader.format == 'pcap':
+            tmp_file = f"{output_pcap}.tmp"
+            with open(tmp_file, 'wb') as out_file:
+                out_file.write(reader.read_at(0, 24))
+                # Coalesce adjacent records into a single copy
+                i = 0
+                while i < len(offsets):
+                    start = end = int(offsets[i])
+                    while i < len(offsets) and int(offsets[i]) == end:
+                        end += int(sizes[i])
+                        i += 1
+                    out_file.write(reader.read_at(start, end - start))
+            os.replace(tmp_file, output_pcap)
+        else:
+            with PcapWriter(output_pcap, reader.linktype or 1, reader.snaplen, reader.nanosecond) as writer:
+                for offset, ts_ns in zip(offsets.tolist(), timestamps.tolist()):
+                    _, wirelen, data = reader.packet_at(offset)
+                    writer.write(ts_ns, data, wirelen)
+
+    return len(offsets)
@@ -0,0 +1,376 @@
+# Minimal pure-Python pcap / pcapng reader and pcap writer.
+# Captures are memory-mapped and walked record by record, so a capture of any
+# size can be read in a single pass without loading it into memory.
+
+import mmap
+import struct
+from collections import namedtuple
+
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+# Link layer types handled by decode_packet
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+RAW_LINKTYPES = {12, 14, LINKTYPE_RAW, 228, 229}
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = {0x8100, 0x88a8, 0x9100}
+ETHERTYPE_MPLS = {0x8847, 0x8848}
+
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+IPPROTO_SCTP = 132
+PORT_PROTOCOLS = {IPPROTO_TCP, IPPROTO_UDP, IPPROTO_SCTP}
+IPV6_EXTENSION_HEADERS = {0, 43, 44, 51, 60}
+
+# A single captured packet.
+# index: packet number (0 based), offset: file offset of the record,
+# size: length of the whole record, ts_ns: timestamp in nanoseconds.
+PcapRecord = namedtuple('PcapRecord', 'index offset size ts_ns linktype caplen wirelen data')
+
+
+class PcapError(ValueError):
+    pass
+
+
+class PacketInfo:
+    """Network and transport fields of a decoded packet."""
+    __slots__ = ('version', 'src', 'dst', 'proto', 'sport', 'dport', 'l3_offset', 'l4_offset', 'data')
+
+    def __init__(self, data):
+        self.data = data
+        self.version = None
+        self.src = None
+        self.dst = None
+        self.proto = None
+        self.sport = None
+        self.dport = None
+        self.l3_offset = None
+        self.l4_offset = None
+
+
+class PcapReader:
+    """
+    Iterates the records of a pcap or pcapng capture from a memory map.
+
+    Usage:
+        with PcapReader(path) as reader:
+            for record in reader:
+                ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.format = None
+        self.linktype = None
+        self.snaplen = 262144
+        self.nanosecond = False
+        self._file = None
+        self._mm = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise PcapError(f"Empty capture: {self.path}")
+
+        magic = self._mm[:4]
+        if len(magic) < 4:
+            self.close()
+            raise PcapError(f"Truncated capture: {self.path}")
+        if struct.unpack('<I', magic)[0] == PCAPNG_SHB:
+            self.format = 'pcapng'
+            self._read_pcapng_header()
+        elif struct.unpack('<I', magic)[0] in (PCAP_MAGIC_US, PCAP_MAGIC_NS) or \
+                struct.unpack('>I', magic)[0] in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            self.format = 'pcap'
+            self._read_pcap_header()
+        else:
+            self.close()
+            raise PcapError(f"Not a pcap or pcapng capture: {self.path}")
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._mm:
+            self._mm.close()
+            self._mm = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __iter__(self):
+        if self.format == 'pcap':
+            return self._iter_pcap()
+        return self._iter_pcapng()
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        """Returns the raw bytes of a record previously yielded at offset."""
+        return self._mm[offset:offset + size]
+
+    def packet_at(self, offset: int):
+        """Returns (caplen, wirelen, data) of the record at offset."""
+        mm = self._mm
+        if self.format == 'pcap':
+            caplen, wirelen = struct.unpack_from(self._endian + 'II', mm, offset + 8)
+            return caplen, wirelen, mm[offset + 16:offset + 16 + caplen]
+
+        # pcapng blocks carry no byte order of their own, it is read from the block type
+        endian = '<' if mm[offset] else '>'
+        block_type, block_len = struct.unpack_from(endian + 'II', mm, offset)
+        if block_type == 3:
+            wirelen, = struct.unpack_from(endian + 'I', mm, offset + 8)
+            caplen = min(wirelen, block_len - 16)
+            return caplen, wirelen, mm[offset + 12:offset + 12 + caplen]
+        if block_type not in (2, 6):
+            raise PcapError(f"No packet block at offset {offset}: {self.path}")
+        caplen, wirelen = struct.unpack_from(endian + 'II', mm, offset + 20)
+        return caplen, wirelen, mm[offset + 28:offset + 28 + caplen]
+
+    def _read_pcap_header(self):
+        for endian in '<>':
+            magic, = struct.unpack(endian + 'I', self._mm[:4])
+            if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+                self._endian = endian
+                self.nanosecond = magic == PCAP_MAGIC_NS
+                break
+        _, _, _, _, self.snaplen, linktype = struct.unpack_from(self._endian + 'HHiIII', self._mm, 4)
+        # The upper bits may hold FCS information
+        self.linktype = linktype & 0x0fffffff
+
+    def _read_pcapng_header(self):
+        # Link type and resolution of the first interface, known before any packet is read
+        for _ in self._iter_pcapng():
+            break
+
+    def _iter_pcap(self):
+        mm = self._mm
+        size = len(mm)
+        header = struct.Struct(self._endian + 'IIII')
+        scale = 1 if self.nanosecond else 1000
+        linktype = self.linktype
+        offset = 24
+        index = 0
+        while offset + 16 <= size:
+            sec, frac, caplen, wirelen = header.unpack_from(mm, offset)
+            end = offset + 16 + caplen
+            if end > size:
+                break  # truncated last record
+            yield PcapRecord(index, offset, 16 + caplen, sec * 1_000_000_000 + frac * scale,
+                             linktype, caplen, wirelen, mm[offset + 16:end])
+            offset = end
+            index += 1
+
+    def _iter_pcapng(self):
+        mm = self._mm
+        size = len(mm)
+        offset = 0
+        index = 0
+        endian = '<'
+        interfaces = []
+        while offset + 12 <= size:
+            block_type, = struct.unpack_from(endian + 'I', mm, offset)
+            if block_type == PCAPNG_SHB:
+                # Every section restates the byte order and its interfaces
+                endian = '<' if struct.unpack_from('<I', mm, offset + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                interfaces = []
+            block_len, = struct.unpack_from(endian + 'I', mm, offset + 4)
+            if block_len < 12 or offset + block_len > size:
+                break
+            body = offset + 8
+
+            if block_type == 1:  # Interface Description Block
+                linktype, _, snaplen = struct.unpack_from(endian + 'HHI', mm, body)
+                tsresol = _pcapng_tsresol(mm, body + 8, offset + block_len - 4, endian)
+                interfaces.append((linktype, tsresol))
+                if self.linktype is None:
+                    self.linktype = linktype
+                    self.snaplen = snaplen or self.snaplen
+                    self.nanosecond = tsresol != (10, 6)
+
+            elif block_type == 6:  # Enhanced Packet Block
+                iface, ts_high, ts_low, caplen, wirelen = struct.unpack_from(endian + 'IIIII', mm, body)
+                linktype, tsresol = interfaces[iface] if iface < len(interfaces) else (self.linktype, (10, 6))
+                data_start = body + 20
+                yield PcapRecord(index, offset, block_len, _to_ns((ts_high << 32) | ts_low, tsresol),
+                                 linktype, caplen, wirelen, mm[data_start:data_start + caplen])
+                index += 1
+
+            elif block_type == 3:  # Simple Packet Block, no timestamp
+                wirelen, = struct.unpack_from(endian + 'I', mm, body)
+                linktype = interfaces[0][0] if interfaces else self.linktype
+                caplen = min(wirelen, block_len - 16)
+                yield PcapRecord(index, offset, block_len, 0, linktype, caplen, wirelen,
+                                 mm[body + 4:body + 4 + caplen])
+                index += 1
+
+            elif block_type == 2:  # Obsolete Packet Block
+                iface, _, ts_high, ts_low, caplen, wirelen = struct.unpack_from(endian + 'HHIIII', mm, body)
+                linktype, tsresol = interfaces[iface] if iface < len(interfaces) else (self.linktype, (10, 6))
+                data_start = body + 20
+                yield PcapRecord(index, offset, block_len, _to_ns((ts_high << 32) | ts_low, tsresol),
+                                 linktype, caplen, wirelen, mm[data_start:data_start + caplen])
+                index += 1
+
+            offset += block_len
+
+
+def _pcapng_tsresol(mm, start, end, endian):
+    # Walks the IDB options for if_tsresol, defaulting to microseconds
+    offset = start
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(endian + 'HH', mm, offset)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = mm[offset + 4]
+            return (2, value & 0x7f) if value & 0x80 else (10, value)
+        offset += 4 + ((length + 3) & ~3)
+    return 10, 6
+
+
+def _to_ns(units: int, tsresol) -> int:
+    base, exponent = tsresol
+    if base == 2:
+        return (units * 1_000_000_000) >> exponent
+    if exponent <= 9:
+        return units * 10 ** (9 - exponent)
+    return units // 10 ** (exponent - 9)
+
+
+class PcapWriter:
+    """Writes packets to a classic little-endian pcap file."""
+
+    def __init__(self, path, linktype: int, snaplen: int = 262144, nanosecond: bool = False,
+                 buffering: int = 1024 * 1024):
+        self.path = path
+        self.nanosecond = nanosecond
+        self._divisor = 1 if nanosecond else 1000
+        self._header = struct.Struct('<IIII')
+        self._file = open(path, 'wb', buffering=buffering)
+        self._file.write(struct.pack('<IHHiIII', PCAP_MAGIC_NS if nanosecond else PCAP_MAGIC_US,
+                                     2, 4, 0, 0, snaplen, linktype))
+        self.count = 0
+
+    def write(self, ts_ns: int, data: bytes, wirelen: int = None):
+        sec, frac = divmod(ts_ns, 1_000_000_000)
+        self._file.write(self._header.pack(sec, frac // self._divisor, len(data), wirelen or len(data)))
+        self._file.write(data)
+        self.count += 1
+
+    def write_record(self, record: PcapRecord):
+        self.write(record.ts_ns, record.data, record.wirelen)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def decode_packet(linktype: int, data: bytes) -> PacketInfo:
+    """
+    Decodes the network and transport headers of a packet. Fields that cannot
+    be decoded (non-IP traffic, truncated headers) are left as None.
+    """
+    info = PacketInfo(data)
+    length = len(data)
+
+    # Link layer
+    if linktype == LINKTYPE_ETHERNET:
+        if length < 14:
+            return info
+        ethertype = (data[12] << 8) | data[13]
+        offset = 14
+        while ethertype in ETHERTYPE_VLAN and offset + 4 <= length:
+            ethertype = (data[offset + 2] << 8) | data[offset + 3]
+            offset += 4
+        if ethertype in ETHERTYPE_MPLS:
+            # Skip the label stack, the payload version is read from the IP header
+            while offset + 4 <= length:
+                bottom = data[offset + 2] & 0x01
+                offset += 4
+                if bottom:
+                    break
+            ethertype = None
+    elif linktype in RAW_LINKTYPES:
+        offset = 0
+        ethertype = None
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if length < 16:
+            return info
+        ethertype = (data[14] << 8) | data[15]
+        offset = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if length < 20:
+            return info
+        ethertype = (data[0] << 8) | data[1]
+        offset = 20
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        if length < 4:
+            return info
+        offset = 4
+        ethertype = None
+    else:
+        return info
+
+    if offset >= length:
+        return info
+    version = data[offset] >> 4
+    if ethertype not in (None, ETHERTYPE_IPV4, ETHERTYPE_IPV6):
+        return info
+
+    # Network layer
+    info.l3_offset = offset
+    if version == 4 and offset + 20 <= length:
+        ihl = (data[offset] & 0x0f) * 4
+        info.version = 4
+        info.proto = data[offset + 9]
+        info.src = data[offset + 12:offset + 16]
+        info.dst = data[offset + 16:offset + 20]
+        # Only the first fragment carries the transport header
+        if ((data[offset + 6] & 0x1f) << 8) | data[offset + 7]:
+            return info
+        l4 = offset + ihl
+    elif version == 6 and offset + 40 <= length:
+        info.version = 6
+        info.src = data[offset + 8:offset + 24]
+        info.dst = data[offset + 24:offset + 40]
+        proto = data[offset + 6]
+        l4 = offset + 40
+        while proto in IPV6_EXTENSION_HEADERS and l4 + 8 <= length:
+            if proto == 44:
+                if ((data[l4 + 2] << 8) | data[l4 + 3]) & 0xfff8:
+                    info.proto = data[l4]
+                    return info
+                proto, l4 = data[l4], l4 + 8
+            elif proto == 51:
+                proto, l4 = data[l4], l4 + (data[l4 + 1] + 2) * 4
+            else:
+                proto, l4 = data[l4], l4 + (data[l4 + 1] + 1) * 8
+        info.proto = proto
+    else:
+        return info
+
+    # Transport layer
+    info.l4_offset = l4
+    if info.proto in PORT_PROTOCOLS and l4 + 4 <= length:
+        info.sport = (data[l4] << 8) | data[l4 + 1]
+        info.dport = (data[l4 + 2] << 8) | data[l4 + 3]
+
+    return info
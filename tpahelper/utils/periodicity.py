@@ -0,0 +1,171 @@
+# Batch periodicity analysis of protocol point values.
+# Every point of a series store (see point_values) is laid on a common time
+# grid, forward filled within its own span, and analysed a block of points at
+# a time as rows of a 2-D array: autocorrelation through the FFT power
+# spectrum (Wiener-Khinchin), the strongest autocorrelation peak, and the
+# dominant spectral period. Nothing is plotted, the result is a report table.
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from scipy import fft
+
+INTERVAL_NS = 1_000_000_000
+# Rows x FFT length of a block of points analysed at once
+BLOCK_ELEMENTS = 1 << 24
+# Autocorrelation peaks within this ratio of the highest count as the period
+PEAK_RATIO = 0.9
+# Fewer readings than this aren't enough to call a period
+MIN_READINGS = 8
+
+periodicity_schema = pa.schema([
+    ('point', pa.string()),
+    ('readings', pa.int64()),
+    ('first', pa.timestamp('ns', tz='UTC')),
+    ('last', pa.timestamp('ns', tz='UTC')),
+    ('mean', pa.float64()),
+    ('std', pa.float64()),
+    ('acf_period_s', pa.float64()),
+    ('acf_peak', pa.float64()),
+    ('fft_period_s', pa.float64()),
+    ('fft_power_ratio', pa.float64()),
+])
+
+
+def _forward_fill(matrix: np.ndarray) -> np.ndarray:
+    # Row-wise forward fill of NaN gaps, leading NaNs are left as they are
+    index = np.where(np.isnan(matrix), 0, np.arange(matrix.shape[1]))
+    np.maximum.accumulate(index, axis=1, out=index)
+    return matrix[np.arange(matrix.shape[0])[:, None], index]
+
+
+def autocorrelation(matrix: np.ndarray) -> np.ndarray:
+    """
+    Normalized (biased) autocorrelation of every row of matrix at lags
+    0..n-1, from the power spectrum of the zero padded rows. Rows must be
+    demeaned, constant rows give NaN.
+    """
+    n = matrix.shape[1]
+    size = fft.next_fast_len(2 * n - 1, real=True)
+    spectrum = fft.rfft(matrix, size, axis=1, workers=-1)
+    acf = fft.irfft(spectrum.real ** 2 + spectrum.imag ** 2, size, axis=1, workers=-1)[:, :n]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return acf / acf[:, :1]
+
+
+def strongest_peaks(acf: np.ndarray, max_lag: int):
+    """
+    Lag and height of the period peak of every row in lags 1..max_lag: the
+    first positive local maximum reaching PEAK_RATIO of the highest one, so
+    multiples of the period don't win on noise. 0 and NaN when there is none.
+    """
+    max_lag = min(max_lag, acf.shape[1] - 1)
+    if max_lag < 2:
+        # A peak needs a lag on either side of it
+        return np.zeros(len(acf), dtype=np.int64), np.full(len(acf), np.nan)
+    middle = acf[:, 1:max_lag]
+    peaks = (middle > acf[:, :max_lag - 1]) & (middle >= acf[:, 2:max_lag + 1]) & (middle > 0)
+    heights = np.where(peaks, middle, -np.inf)
+    highest = heights.max(axis=1, initial=-np.inf)
+    lags = np.argmax(peaks & (heights >= PEAK_RATIO * highest[:, None]), axis=1)
+    found = peaks.any(axis=1)
+    return np.where(found, lags + 1, 0), np.where(found, heights[np.arange(len(lags)), lags], np.nan)
+
+
+def dominant_periods(matrix: np.ndarray, interval_s: float):
+    """Period in seconds of the strongest non-DC frequency of every row, and its share of the row's power."""
+    n = matrix.shape[1]
+    power = np.abs(fft.rfft(matrix, axis=1, workers=-1)[:, 1:]) ** 2
+    if power.shape[1] == 0:
+        return np.full(len(matrix), np.nan), np.full(len(matrix), np.nan)
+    peak = np.argmax(power, axis=1)
+    total = power.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = power[np.arange(len(peak)), peak] / total
+        periods = np.where(total > 0, n * interval_s / (peak + 1), np.nan)
+    return periods, np.where(total > 0, ratio, np.nan)
+
+
+def analyze_periodicity(series_parquet, report_parquet, interval_ns: int = INTERVAL_NS,
+                        max_lag_fraction: float = 0.5) -> pa.Table:
+    """
+    Writes the periodicity report of every point in series_parquet to
+    report_parquet and returns it. Periods are searched up to
+    max_lag_fraction of the capture duration.
+    """
+    table = pq.read_table(series_parquet)
+    points = table['point'].combine_chunks()
+    if isinstance(points.type, pa.DictionaryType):
+        names, codes = points.dictionary, points.indices.to_numpy(zero_copy_only=False)
+    else:
+        names = pc.unique(points)
+        codes = pc.index_in(points, value_set=names).to_numpy(zero_copy_only=False)
+    time_ns = table['time'].cast(pa.int64()).to_numpy()
+    values = table['value'].to_numpy()
+
+    columns = {field.name: [] for field in periodicity_schema}
+    if len(values):
+        bins = (time_ns - time_ns.min()) // interval_ns
+        n = int(bins.max()) + 1
+        max_lag = min(n - 1, max(2, int(n * max_lag_fraction)))
+        order = np.argsort(codes, kind='stable')
+        codes, bins, values, time_ns = codes[order], bins[order], values[order], time_ns[order]
+        present = np.unique(codes)
+        bounds = np.searchsorted(codes, present)
+        block = max(1, BLOCK_ELEMENTS // fft.next_fast_len(2 * n - 1, real=True))
+
+        for first in range(0, len(present), block):
+            block_codes = present[first:first + block]
+            start = bounds[first]
+            end = bounds[first + block] if first + block < len(present) else len(codes)
+            rows = np.searchsorted(block_codes, codes[start:end])
+            block_bins = bins[start:end]
+            block_values = values[start:end]
+
+            matrix = np.full((len(block_codes), n), np.nan)
+            matrix[rows, block_bins] = block_values
+            # Each point holds its last reading until the next one, and is
+            # neutral (its mean) outside its own first..last span
+            matrix = _forward_fill(matrix)
+            readings = np.bincount(rows, minlength=len(block_codes))
+            sums = np.bincount(rows, weights=block_values, minlength=len(block_codes))
+            squares = np.bincount(rows, weights=block_values ** 2, minlength=len(block_codes))
+            means = sums / readings
+            stds = np.sqrt(np.maximum(squares / readings - means ** 2, 0))
+            last_bins = np.full(len(block_codes), -1)
+            np.maximum.at(last_bins, rows, block_bins)
+            matrix[np.arange(n) > last_bins[:, None]] = np.nan
+            matrix = np.nan_to_num(matrix - np.nanmean(matrix, axis=1)[:, None])
+
+            lags, heights = strongest_peaks(autocorrelation(matrix), max_lag)
+            periods, ratios = dominant_periods(matrix, interval_ns / 1e9)
+            too_few = readings < MIN_READINGS
+            constant = stds == 0
+
+            first_ns = np.full(len(block_codes), np.iinfo(np.int64).max)
+            last_ns = np.full(len(block_codes), np.iinfo(np.int64).min)
+            np.minimum.at(first_ns, rows, time_ns[start:end])
+            np.maximum.at(last_ns, rows, time_ns[start:end])
+
+            # Spans of fewer than 3 bins have no lag to find a peak at
+            undefined = too_few | constant | (n < 3)
+            columns['point'] += names.take(pa.array(block_codes)).to_pylist()
+            columns['readings'] += readings.tolist()
+            columns['first'] += first_ns.tolist()
+            columns['last'] += last_ns.tolist()
+            columns['mean'] += means.tolist()
+            columns['std'] += stds.tolist()
+            columns['acf_period_s'] += np.where(undefined | (lags == 0), np.nan,
+                                                lags * interval_ns / 1e9).tolist()
+            columns['acf_peak'] += np.where(undefined, np.nan, heights).tolist()
+            columns['fft_period_s'] += np.where(undefined, np.nan, periods).tolist()
+            columns['fft_power_ratio'] += np.where(undefined, np.nan, ratios).tolist()
+
+    report = pa.Table.from_arrays(
+        [pa.array(columns[field.name], type=field.type) for field in periodicity_schema],
+        schema=periodicity_schema)
+    report = report.sort_by([('acf_peak', 'descending'), ('point', 'ascending')])
+    pq.write_table(report, report_parquet)
+    return report
+
@@ -0,0 +1,236 @@
+# Columnar storage of protocol point values.
+# Processors append every (time, type, index, value) reading to typed column
+# buffers, flushed as Arrow record batches to a long-format parquet, so memory
+# stays bounded by the batch size instead of the capture length. The readings
+# are then resampled into a sparse series store: one row per point and
+# interval that has a reading, sorted by point then time, with dictionary
+# encoded point ids, delta encoded timestamps and per-point statistics.
+# Wide views are pivoted on demand for a selection of points and times.
+
+import math
+import os
+from array import array
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+BATCH_SIZE = 1_000_000
+
+point_values_schema = pa.schema([
+    ('time', pa.timestamp('ns', tz='UTC')),
+    ('type', pa.dictionary(pa.int32(), pa.string())),
+    ('index', pa.uint32()),
+    ('value', pa.float64()),
+])
+
+series_schema = pa.schema([
+    ('point', pa.dictionary(pa.int32(), pa.string())),
+    ('time', pa.timestamp('ns', tz='UTC')),
+    ('value', pa.float64()),
+])
+
+series_stats_schema = pa.schema([
+    ('point', pa.string()),
+    ('count', pa.int64()),
+    ('first', pa.timestamp('ns', tz='UTC')),
+    ('last', pa.timestamp('ns', tz='UTC')),
+    ('min', pa.float64()),
+    ('max', pa.float64()),
+])
+
+
+def epoch_ns(value) -> int:
+    """Nanoseconds since the epoch of a tshark frame.time_epoch string, without float rounding."""
+    seconds, _, fraction = str(value).partition('.')
+    return int(seconds) * 1_000_000_000 + int((fraction + '000000000')[:9])
+
+
+def to_float(value) -> float:
+    """float() of a field value, NaN when it isn't numeric."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class PointValueWriter:
+    """
+    Accumulates point values in typed buffers and writes them to a long-format
+    parquet in batches of batch_size rows. types lists the point value fields
+    the type codes passed to add() refer to.
+
+    Usage:
+        with PointValueWriter(values_parquet, ['dnp3.al.ana.int', ...]) as writer:
+            writer.add(time_ns, 0, index, value)
+    """
+
+    def __init__(self, values_parquet, types: list, batch_size: int = BATCH_SIZE):
+        self.values_parquet = values_parquet
+        self.types = pa.array(types, type=pa.string())
+        self.batch_size = batch_size
+        self.count = 0
+        self._tmp_file = f"{values_parquet}.tmp"
+        self._writer = pq.ParquetWriter(self._tmp_file, point_values_schema)
+        self._reset()
+
+    def _reset(self):
+        self._time = array('q')
+        self._type = array('i')
+        self._index = array('I')
+        self._value = array('d')
+
+    def add(self, time_ns: int, type_code: int, index: int, value: float):
+        self._time.append(time_ns)
+        self._type.append(type_code)
+        self._index.append(index)
+        self._value.append(value)
+        if len(self._time) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._time:
+            return
+        batch = pa.RecordBatch.from_arrays([
+            pa.array(np.frombuffer(self._time, dtype=np.int64)).cast(point_values_schema.field('time').type),
+            pa.DictionaryArray.from_arrays(pa.array(np.frombuffer(self._type, dtype=np.int32)), self.types),
+            pa.array(np.frombuffer(self._index, dtype=np.uint32)),
+            pa.array(np.frombuffer(self._value, dtype=np.float64)),
+        ], schema=point_values_schema)
+        self._writer.write_batch(batch)
+        self.count += len(self._time)
+        self._reset()
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+        os.replace(self._tmp_file, self.values_parquet)
+
+    def abort(self):
+        self._writer.close()
+        os.remove(self._tmp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _interval_sums(table: pa.Table, interval_ns: int) -> pa.Table:
+    # Sum and count of the numeric readings of every (interval, index)
+    table = table.filter(pc.invert(pc.is_nan(table['value'])))
+    bins = pc.multiply(pc.divide(table['time'].cast(pa.int64()), interval_ns), interval_ns)
+    table = pa.table({'time': bins, 'index': table['index'], 'value': table['value']})
+    sums = table.group_by(['time', 'index']).aggregate([('value', 'sum'), ('value', 'count')])
+    return pa.table({'time': sums['time'], 'index': sums['index'], 'sum': sums['value_sum'],
+                     'count': sums['value_count']})
+
+
+def _merge_sums(partials: list) -> pa.Table:
+    sums = pa.concat_tables(partials).group_by(['time', 'index']).aggregate([('sum', 'sum'), ('count', 'sum')])
+    return pa.table({'time': sums['time'], 'index': sums['index'], 'sum': sums['sum_sum'],
+                     'count': sums['count_sum']})
+
+
+def resample_point_values(values_parquet, interval_ns: int = 1_000_000_000,
+                          batch_size: int = BATCH_SIZE) -> pa.Table:
+    """
+    Mean value of every point index per time interval, skipping intervals
+    without a numeric reading. Returns a (time, index, value) table sorted by
+    time then index.
+
+    The readings are read batch_size rows at a time and reduced to partial
+    sums per interval, so memory follows the number of resampled rows, not
+    the number of readings.
+    """
+    partials = []
+    pending = merged = 0
+    parquet = pq.ParquetFile(values_parquet)
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=['time', 'index', 'value']):
+        partial = _interval_sums(pa.Table.from_batches([batch]), interval_ns)
+        partials.append(partial)
+        pending += partial.num_rows
+        # Merge once the partials outgrow the last merge, merged rows are only re-read a bounded number of times
+        if len(partials) > 1 and pending > max(batch_size, 2 * merged):
+            partials = [_merge_sums(partials)]
+            pending = merged = partials[0].num_rows
+
+    if partials:
+        sums = _merge_sums(partials)
+    else:
+        sums = pa.table({'time': pa.array([], pa.int64()), 'index': pa.array([], pa.uint32()),
+                         'sum': pa.array([], pa.float64()), 'count': pa.array([], pa.int64())})
+    table = pa.table({
+        'time': sums['time'].cast(point_values_schema.field('time').type),
+        'index': sums['index'],
+        'value': pc.divide(sums['sum'], sums['count'].cast(pa.float64())),
+    })
+    return table.sort_by([('time', 'ascending'), ('index', 'ascending')])
+
+
+def series_stats_path(series_parquet) -> str:
+    """Location of the per-point statistics of a series store."""
+    return series_parquet.replace('.parquet', '_stats.parquet')
+
+
+def write_point_series(values_parquet, series_parquet, interval_ns: int = 1_000_000_000) -> pa.Table:
+    """
+    Resamples the readings in values_parquet into the sparse series store
+    series_parquet, with its per-point statistics next to it.
+    Returns the statistics table.
+    """
+    table = resample_point_values(values_parquet, interval_ns)
+    points = table['index'].cast(pa.string())
+    # Point ids are sorted, so row group statistics prune reads of a point selection
+    dictionary = pc.unique(points).sort()
+    table = pa.table({'point': pc.index_in(points, value_set=dictionary), 'time': table['time'],
+                      'value': table['value']}).sort_by([('point', 'ascending'), ('time', 'ascending')])
+    series = pa.Table.from_arrays([
+        pa.DictionaryArray.from_arrays(table['point'].combine_chunks(), dictionary),
+        table['time'].combine_chunks(),
+        table['value'].combine_chunks(),
+    ], schema=series_schema)
+    pq.write_table(series, series_parquet, use_dictionary=['point'],
+                   column_encoding={'time': 'DELTA_BINARY_PACKED'})
+
+    stats = table.group_by('point').aggregate(
+        [('value', 'count'), ('time', 'min'), ('time', 'max'), ('value', 'min'), ('value', 'max')])
+    stats = stats.sort_by('point')
+    stats = pa.Table.from_arrays([dictionary.take(stats['point'])] + [stats[c] for c in (
+        'value_count', 'time_min', 'time_max', 'value_min', 'value_max')], schema=series_stats_schema)
+    pq.write_table(stats, series_stats_path(series_parquet))
+    return stats
+
+
+def _utc(value) -> pd.Timestamp:
+    timestamp = pd.Timestamp(value)
+    return timestamp.tz_localize('UTC') if timestamp.tzinfo is None else timestamp.tz_convert('UTC')
+
+
+def read_point_series(series_parquet, points: list = None, start=None, end=None) -> pd.DataFrame:
+    """Long-format readings of the given points between start and end (inclusive), all when not given."""
+    filters = []
+    if points is not None:
+        filters.append(('point', 'in', [str(p) for p in points]))
+    if start is not None:
+        filters.append(('time', '>=', _utc(start)))
+    if end is not None:
+        filters.append(('time', '<=', _utc(end)))
+    table = pq.read_table(series_parquet, filters=filters or None)
+    return table.to_pandas()
+
+
+def pivot_point_series(series_parquet, points: list = None, start=None, end=None) -> pd.DataFrame:
+    """
+    Wide view of read_point_series(), one column per point. Intervals
+    without a reading of a point are left empty (NaN), not filled.
+    """
+    df = read_point_series(series_parquet, points, start, end)
+    df['point'] = df['point'].astype(str)
+    return df.pivot(index='time', columns='point', values='value')
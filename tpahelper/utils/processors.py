@@ -1,20 +1,33 @@
 import pandas as pd
-import dpath
+import gzip
 import json
 import os
+import shlex
 import subprocess
+import tempfile
+from contextlib import contextmanager
 from termcolor import colored
 from tabulate import tabulate
 from loguru import logger
 import ijson
 import numpy as np
-import plotly.express as px
+import pyarrow.parquet as pq
 
 from statsmodels.tsa.stattools import acf
 from statsmodels.graphics.tsaplots import plot_acf
 import matplotlib.pyplot as plt
 from scipy.signal import find_peaks
 
+from tpahelper.utils.charts import MAX_POINTS, PAGE_SIZE, write_point_charts
+from tpahelper.utils.periodicity import analyze_periodicity
+from tpahelper.utils.point_values import (
+    PointValueWriter,
+    epoch_ns,
+    series_stats_path,
+    to_float,
+    write_point_series
+)
+
 def read_json_lines_generator(json_file):
     """Generator to read a file with each line as a separate JSON object."""
     with open(json_file, 'r') as file:
@@ -22,168 +35,187 @@ def read_json_lines_generator(json_file):
             yield json.loads(line)
 
 
-def read_json_doc_generator(file_path):
-    """Generator to read a JSON file with each object as a separate JSON document."""
-    with open(file_path, 'rb') as file:
-        objects = ijson.items(file, 'item')
-        for obj in objects:
-            yield obj
+class _TeeReader:
+    """File-like wrapper copying everything read from stream to tee_file."""
+
+    def __init__(self, stream, tee_file):
+        self.stream = stream
+        self.tee_file = tee_file
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.tee_file.write(data)
+        return data
+
+
+@contextmanager
+def tshark_process(command: list):
+    """
+    Runs a tshark command with its stdout piped to the caller. tshark is
+    killed when the caller stops reading early, and its errors are reported
+    when it exits with a failure.
+    """
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            yield process
+        except GeneratorExit:
+            # The consumer stopped early, tshark has nothing left to report
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            if process.wait() > 0:
+                stderr.seek(0)
+                print(colored(f"\tError: {stderr.read().decode(errors='replace')}", 'red'))
+
+
+def tshark_json_generator(command: list, tee_json: str = None):
+    """
+    Runs a tshark -T json command and yields its packets while it is still
+    dissecting, so parsing overlaps tshark instead of waiting for a json file.
+    The raw output is copied to tee_json when given, gzip compressed if the
+    name ends in .gz.
+    """
+    with tshark_process(command) as process:
+        stream = process.stdout
+        if not tee_json:
+            yield from ijson.items(stream, 'item')
+            return
+        with gzip.open(tee_json, 'wb') if tee_json.endswith('.gz') else open(tee_json, 'wb') as tee_file:
+            yield from ijson.items(_TeeReader(stream, tee_file), 'item')
+
+
+def collect_fields(packet, fields) -> dict:
+    """
+    Collects the values of the given field names anywhere in a packet's JSON
+    tree in a single walk. Values are listed in the order dpath.search('**/<field>')
+    yields them: a node's own keys first, then each child in turn.
+    """
+    found = {field: [] for field in fields}
+    _collect_fields(packet, found)
+    return found
+
+
+def _collect_fields(node, found):
+    if isinstance(node, dict):
+        items = list(node.items())
+    elif isinstance(node, list):
+        items = list(enumerate(node))
+    else:
+        return
+
+    for key, value in items:
+        if key == '':
+            raise KeyError("Empty string keys not allowed")
+        values = found.get(key)
+        if values is not None:
+            values.append(value)
+
+    for _, value in items:
+        if isinstance(value, (dict, list)):
+            _collect_fields(value, found)
 
 
 class DNP3Processor:
     name = 'DNP3'
 
-    def __init__(self, infile, outpath):
+    def __init__(self, infile, outpath, json_output: str = 'none', chart_points: int = MAX_POINTS,
+                 chart_page_size: int = PAGE_SIZE, chart_method: str = 'minmax'):
+        """
+        json_output: 'none' streams tshark without keeping its output, 'gzip' or 'plain' also keep it.
+        chart_points, chart_page_size, chart_method: see charts.write_point_charts.
+        """
         self.infile = infile
         self.outpath = outpath
+        self.json_output = json_output
+        self.chart_points = chart_points
+        self.chart_page_size = chart_page_size
+        self.chart_method = chart_method
         self.output_json = os.path.join(self.outpath, "target_dnp3.json")
+        if json_output == 'gzip':
+            self.output_json += ".gz"
+        self.output_points = os.path.join(self.outpath, "dnp3_points.parquet")
         self.output_parquet = os.path.join(self.outpath, "dnp3_values.parquet")
+        self.output_periodicity = os.path.join(self.outpath, "dnp3_periodicity.parquet")
         self.output_html = os.path.join(self.outpath, "dnp3_point_value_charts.html")
         self.dnp3_types = ['int', 'double', 'float']
         self.dnp3_point_types = ['dnp3.al.ana.', 'dnp3.al.anaout.']
         self.target_points = [p + t for p in self.dnp3_point_types for t in self.dnp3_types]
-        self.target_string = ' '.join(f"-j {point}" for point in self.target_points)
+        self.custom_timestamp = "dnp3.al.timestamp"
+        self.packet_fields = ['frame.time', 'frame.time_utc', 'frame.time_epoch', self.custom_timestamp,
+                              'dnp3.al.index'] + self.target_points
 
     def run(self) -> list:
-        print(colored(f"\nConverting target DNP3 fields to json", 'green'))
-        self.dnp3_to_json()
-
-        print(colored(f"\nExtracting point values", 'green'))
-        all_point_values = []
-        for line in read_json_doc_generator(self.output_json):
-            for target_point in self.target_points:
-                point_values = self.extract_point_values(line, target_point,
-                                                          custom_timestamp="dnp3.al.timestamp")
-
-                if point_values:
-                    all_point_values += point_values
-
-        df = pd.DataFrame(all_point_values)
-
-        ### Convert the dataframe to a timeseries ###
-        # Convert 'dnp3.al.timestamp' to datetime
-        df['frame.time'] = pd.to_datetime(df['frame.time'])
-
-        # Ensure 'value' column is numeric.
-        df['value'] = pd.to_numeric(df['value'], errors='coerce')
-
-        # Set the index to 'dnp3.al.timestamp' and keep only the necessary columns
-        df = df[['frame.time', 'al.index', 'value']].set_index('frame.time')
-
-        # Group by 'al.index', resample, and calculate mean only for 'value'
-        df_resampled = df.groupby('al.index').resample('1s').agg({'value': 'mean'}).dropna(
-            subset=['value']).reset_index()
-
-        # Pivot the DataFrame to get 'al.index' as columns
-        df_pivot = df_resampled.pivot(index='frame.time', columns='al.index', values='value').fillna(0)
-
-        # Reset index to make 'dnp3.al.timestamp' a column again for plotting
-        df_pivot.reset_index(inplace=True)
-
-
-        print(colored("\nDataframe head:", 'blue'))
-        print(colored(tabulate(df_pivot.head(), headers='keys', tablefmt='psql'), 'green'))
-
-        # # Write df to parquet
-        df_pivot.to_parquet(self.output_parquet, index=False)
-
-        self.visualize_point_values()
-
-        return [self.output_json, self.output_parquet, self.output_html]
-
-    def dnp3_to_json(self):
-        command = (
-            f"tshark -r {self.infile} -T json -O json -J frame "
-            f"-j frame.time -j frame.time_utc -J ip -j ip.src -j ip.dst -J dnp3 "
-            f"{self.target_string} > {self.output_json}"
-        )
-
+        print(colored(f"\nExtracting point values from tshark json", 'green'))
+        with PointValueWriter(self.output_points, self.target_points) as writer:
+            for packet in self.dnp3_json_generator():
+                self.add_packet_values(writer, packet)
+        print(colored(f"\t{writer.count} point values", 'green'))
+
+        # Mean of each 'al.index' every second, stored sparse: only seconds with a reading
+        stats = write_point_series(self.output_points, self.output_parquet).to_pandas()
+
+        print(colored("\nPoint statistics head:", 'blue'))
+        print(colored(tabulate(stats.head(), headers='keys', tablefmt='psql', showindex=False), 'green'))
+
+        # Polling cycles of every point, strongest autocorrelation first
+        print(colored("\nAnalyzing point periodicity", 'green'))
+        report = analyze_periodicity(self.output_parquet, self.output_periodicity).to_pandas()
+        print(colored(tabulate(report.head(10), headers='keys', tablefmt='psql', showindex=False), 'green'))
+
+        chart_files = self.visualize_point_values()
+
+        output_files = [self.output_points, self.output_parquet, series_stats_path(self.output_parquet),
+                        self.output_periodicity] + chart_files
+        if self.json_output != 'none':
+            output_files.insert(0, self.output_json)
+        return output_files
+
+    def tshark_command(self) -> list:
+        return ['tshark', '-r', str(self.infile), '-T', 'json', '-O', 'json',
+                '-J', 'frame', '-j', 'frame.time', '-j', 'frame.time_utc', '-j', 'frame.time_epoch',
+                '-J', 'ip', '-j', 'ip.src', '-j', 'ip.dst', '-J', 'dnp3'] + \
+            [arg for point in self.target_points for arg in ('-j', point)]
+
+    def dnp3_json_generator(self):
+        """Yields the dissected DNP3 packets as tshark produces them."""
+        command = self.tshark_command()
         print(colored("\nExecuting command:", "yellow"))
-        print(colored(f"{command}\n", "blue"))
-
-        # blocking call for testing / execution profiling purposes
-        result = subprocess.run(command,
-                                capture_output=True,
-                                text=True,
-                                shell=True)
-
-        if result.stdout:
-            print(f"\t{result.stdout}")
-        elif result.stderr:
-            print(f"\tError: {result.stderr}")
-        else:
-            print("\tNo output")
+        print(colored(f"{shlex.join(command)}\n", "blue"))
+        return tshark_json_generator(command, self.output_json if self.json_output != 'none' else None)
 
     @logger.catch
-    def extract_point_values(self, packet: dict, target_field: str, _filter: str = None,
-                              custom_timestamp: str = None) -> list:
-        all_values = []
-        filter_search = None
-        if _filter:
-            filter_search = dpath.search(packet, f'**/{_filter}', yielded=True)
-
-        target_field_search = list(dpath.search(packet, f'**/{target_field}', yielded=True))
-
-        if (filter_search or not _filter) and target_field_search:
-            time_search = list(dpath.search(packet, '**/frame.time', yielded=True))
-            utc_time_search = list(dpath.search(packet, '**/frame.time_utc', yielded=True))
-
-            custom_timestamps = []
-            if custom_timestamp:
-                custom_timestamp_search = dpath.search(packet, f'**/{custom_timestamp}', yielded=True)
-                custom_timestamps = [ts for p, ts in custom_timestamp_search]
-
-            point_number_search = dpath.search(packet, f'**/dnp3.al.index', yielded=True)
-            point_numbers = [v for p, v in point_number_search]
-
-            point_value_search = dpath.search(packet, f'**/{target_field}', yielded=True)
-            point_values = [v for p, v in point_value_search]
-
-            if len(custom_timestamps) == len(point_numbers) == len(point_values):
-                for ts, pn, pv in zip(custom_timestamps, point_numbers, point_values):
-                    all_values.append({
-                        'type': target_field,
-                        'frame.time': time_search[0][1] if time_search else None,
-                        'frame.time_utc': utc_time_search[0][1] if utc_time_search else None,
-                        'dnp3.al.timestamp': ts,
-                        'al.index': pn,
-                        'value': pv
-                    })
-
-            else:
-                for pn, pv in zip(point_numbers, point_values):
-                    all_values.append({
-                        'type': target_field,
-                        'frame.time': time_search[0][1] if time_search else None,
-                        'frame.time_utc': utc_time_search[0][1] if utc_time_search else None,
-                        'dnp3.al.timestamp': None,
-                        'al.index': pn,
-                        'value': pv
-                    })
-
-        return all_values
-
-    def visualize_point_values(self):
+    def add_packet_values(self, writer: PointValueWriter, packet: dict):
+        """Appends the point values of every target point type in packet to writer."""
+        found = collect_fields(packet, self.packet_fields)
+        if found['frame.time_epoch']:
+            time_ns = epoch_ns(found['frame.time_epoch'][0])
+        elif found['frame.time']:
+            time_ns = pd.Timestamp(found['frame.time'][0]).value
+        else:
+            return
+
+        point_numbers = found['dnp3.al.index']
+        for type_code, target_field in enumerate(self.target_points):
+            for pn, pv in zip(point_numbers, found[target_field]):
+                writer.add(time_ns, type_code, int(pn), to_float(pv))
+
+    def visualize_point_values(self) -> list:
         print(colored("\nCreating DNP3 charts", 'green'))
 
-        # read parquet file to dataframe
-        df = pd.read_parquet(self.output_parquet)
-        if df.empty:
+        if not pq.read_metadata(self.output_parquet).num_rows:
             print(colored("Dataframe is empty", 'red'))
             with open(self.output_html, 'w') as f:
                 f.write("<h1>No DNP3 point values.</h1>")
-            return
-
-        # Plot using Plotly
-        fig = px.line(df, x='frame.time', y=df.columns[1:],
-                      title='Averaged Values per AL Index Every Second',
-                      labels={'value': 'Averaged Value', 'frame.time': 'Timestamp', 'variable': 'AL Index'})
-
-        # Update legend to show 'AL Index'
-        fig.update_layout(legend_title_text='AL Index')
-
-        # Save the plot to an HTML file
-        fig.write_html(self.output_html)
+            return [self.output_html]
+
+        # Downsampled WebGL line per AL index, paged when there are many
+        return write_point_charts(self.output_parquet, self.output_html,
+                                  title='Averaged Values per AL Index Every Second',
+                                  labels={'value': 'Averaged Value', 'time': 'Timestamp', 'point': 'AL Index'},
+                                  max_points=self.chart_points, page_size=self.chart_page_size,
+                                  method=self.chart_method)
 
     def fft_period_estimate(df: pd.DataFrame, column: str):
         # Ensure column exists
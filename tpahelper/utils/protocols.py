@@ -1,4 +1,4 @@
-from tpahelper.utils import processors
+from tpahelper.utils import field_processors, processors
 
 ndpi_protocol_map = {
     "AFP": {"tshark": "afp", "tcpdump": "port 548", "ports": [548]},
@@ -241,4 +241,9 @@ ndpi_protocol_map = {
 
 processor_map = {
     'dnp3': processors.DNP3Processor,
+    'modbus': field_processors.ModbusProcessor,
+    'iec60870': field_processors.IEC104Processor,
+    's7comm': field_processors.S7CommProcessor,
+    'cip': field_processors.CIPProcessor,
+    'bacnet': field_processors.BACnetProcessor,
 }
\ No newline at end of file
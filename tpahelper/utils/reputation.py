@@ -0,0 +1,271 @@
+# Incremental IP reputation summary.
+# Every enrichment result is flattened into rows of a fixed schema (one row
+# per OTX pulse, or one row without pulses) as soon as it arrives, and the
+# buffered rows are written as a new part file of the ip_reputation.parquet
+# dataset directory every flush_rows rows or flush_seconds seconds. Part
+# files appear atomically, so the dataset can be read with pd.read_parquet
+# at any time, and the indicators in it are the checkpoint a killed run
+# resumes from. Offline blocklist hits are merged in when the dataset is
+# compacted, as rows with source 'blocklist' and the listing feed.
+#
+# Usage:
+#   with ReputationWriter(reputation_parquet) as writer:
+#       pending = [key for key in indicators if key not in writer.done]
+#       writer.add('8.8.8.8', 'ipv4', otx_response)
+
+import glob
+import json
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+FLUSH_ROWS = 1000
+FLUSH_SECONDS = 10
+
+_strings = pa.list_(pa.string())
+
+# column: (path in the OTX response, arrow type). Pulse paths are relative to a pulse.
+indicator_fields = {
+    'indicator': (('indicator',), pa.string()),
+    'type': (('type',), pa.string()),
+    'type_title': (('type_title',), pa.string()),
+    'reputation': (('reputation',), pa.int64()),
+    'asn': (('asn',), pa.string()),
+    'country_code': (('country_code',), pa.string()),
+    'country_name': (('country_name',), pa.string()),
+    'region': (('region',), pa.string()),
+    'city': (('city',), pa.string()),
+    'continent_code': (('continent_code',), pa.string()),
+    'latitude': (('latitude',), pa.float64()),
+    'longitude': (('longitude',), pa.float64()),
+    'whois': (('whois',), pa.string()),
+    'pulse_info.count': (('pulse_info', 'count'), pa.int64()),
+    'false_positive': (('false_positive',), pa.string()),
+    'validation': (('validation',), pa.string()),
+    'error': (('error',), pa.string()),
+}
+pulse_fields = {
+    'pulse.id': (('id',), pa.string()),
+    'pulse.name': (('name',), pa.string()),
+    'pulse.description': (('description',), pa.string()),
+    'pulse.created': (('created',), pa.string()),
+    'pulse.modified': (('modified',), pa.string()),
+    'pulse.author': (('author', 'username'), pa.string()),
+    'pulse.adversary': (('adversary',), pa.string()),
+    'pulse.TLP': (('TLP',), pa.string()),
+    'pulse.indicator_count': (('indicator_count',), pa.int64()),
+    'pulse.tags': (('tags',), _strings),
+    'pulse.targeted_countries': (('targeted_countries',), _strings),
+    'pulse.industries': (('industries',), _strings),
+    'pulse.malware_families': (('malware_families', 'display_name'), _strings),
+    'pulse.attack_ids': (('attack_ids', 'id'), _strings),
+    'pulse.references': (('references',), _strings),
+}
+
+reputation_schema = pa.schema(
+    [('indicator_type', pa.string()), ('source', pa.string()), ('feed', pa.string())]
+    + [(column, arrow_type) for column, (_, arrow_type) in indicator_fields.items()]
+    + [(column, arrow_type) for column, (_, arrow_type) in pulse_fields.items()])
+
+_PART = re.compile(r'part-(\d+)\.parquet$')
+
+
+def _get(data, path):
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def _value(value, arrow_type):
+    # Response value as the column type, None when it doesn't fit
+    if value is None or value == []:
+        return None
+    if arrow_type == _strings:
+        if not isinstance(value, list):
+            return None
+        return [str(v) for v in value if v is not None] or None
+    if pa.types.is_string(arrow_type):
+        # Nested values are kept as JSON text
+        return value if isinstance(value, str) else json.dumps(value)
+    try:
+        return int(value) if pa.types.is_integer(arrow_type) else float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _list_value(items, key, arrow_type):
+    # Lists of dicts keep the key of every item
+    if isinstance(items, list) and key is not None:
+        items = [item.get(key) if isinstance(item, dict) else item for item in items]
+    return _value(items, arrow_type)
+
+
+def flatten_response(indicator: str, indicator_type: str, data: dict) -> list:
+    """Rows of reputation_schema for one OTX response, one per pulse."""
+    row = {'indicator_type': indicator_type, 'source': 'otx', 'feed': None}
+    for column, (path, arrow_type) in indicator_fields.items():
+        row[column] = _value(_get(data, path), arrow_type)
+    row['indicator'] = row['indicator'] or indicator
+
+    pulses = _get(data, ('pulse_info', 'pulses'))
+    if not isinstance(pulses, list) or not pulses:
+        return [{**row, **dict.fromkeys(pulse_fields)}]
+    rows = []
+    for pulse in pulses:
+        pulse_row = dict(row)
+        for column, (path, arrow_type) in pulse_fields.items():
+            if arrow_type == _strings:
+                pulse_row[column] = _list_value(_get(pulse, path[:1]), path[1] if len(path) > 1 else None, arrow_type)
+            else:
+                pulse_row[column] = _value(_get(pulse, path), arrow_type)
+        rows.append(pulse_row)
+    return rows
+
+
+def _otx_rows(table: pa.Table) -> pa.ChunkedArray:
+    # Parts written before blocklist rows existed have no source, they are OTX rows
+    return pc.fill_null(pc.not_equal(table['source'], 'blocklist'), True)
+
+
+def _latest_results(table: pa.Table) -> pa.Table:
+    # The error rows of an indicator that was retried and succeeded are
+    # dropped, one that still fails keeps only its last error row
+    otx = _otx_rows(table).to_numpy(zero_copy_only=False)
+    failed = otx & table['error'].is_valid().to_numpy(zero_copy_only=False)
+    keys = list(zip(table['indicator'].to_pylist(), table['indicator_type'].to_pylist()))
+    succeeded = {key for key, ok in zip(keys, otx & ~failed) if ok}
+    last_failure = {key: row for row, key in enumerate(keys) if failed[row]}
+    return table.filter(pa.array([not failed[row] or (key not in succeeded and last_failure[key] == row)
+                                  for row, key in enumerate(keys)], type=pa.bool_()))
+
+
+def _recover(reputation_parquet):
+    # A compaction killed between moving the dataset aside and moving the
+    # compacted one in leaves only the .old copy, which is the checkpoint
+    old_dir = f"{reputation_parquet}.old"
+    if not os.path.exists(reputation_parquet) and os.path.isdir(old_dir):
+        os.replace(old_dir, reputation_parquet)
+
+
+def _part_files(dataset_dir) -> list:
+    return sorted(glob.glob(os.path.join(dataset_dir, 'part-*.parquet')))
+
+
+class ReputationWriter:
+    """
+    Appends flattened enrichment results to the dataset directory
+    reputation_parquet. done holds the (indicator, type) pairs already in it;
+    failed lookups are written but not done, so a rerun retries them.
+    """
+
+    def __init__(self, reputation_parquet, flush_rows: int = FLUSH_ROWS, flush_seconds: float = FLUSH_SECONDS):
+        self.reputation_parquet = reputation_parquet
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        _recover(reputation_parquet)
+        if os.path.isfile(reputation_parquet):
+            # Single file summary of an earlier version, rebuilt from the results
+            os.remove(reputation_parquet)
+        os.makedirs(reputation_parquet, exist_ok=True)
+
+        parts = _part_files(reputation_parquet)
+        self._next_part = max((int(_PART.search(p).group(1)) for p in parts), default=0) + 1
+        self.done = set()
+        if parts:
+            written = pq.read_table(parts, columns=['indicator_type', 'indicator', 'source', 'error'],
+                                    schema=reputation_schema)
+            written = written.filter(pc.and_(_otx_rows(written), written['error'].is_null()))
+            self.done = set(zip(written['indicator'].to_pylist(), written['indicator_type'].to_pylist()))
+        self.count = 0
+        self._rows = []
+        self._flushed = time.monotonic()
+
+    def add(self, indicator: str, indicator_type: str, data: dict):
+        if (indicator, indicator_type) in self.done:
+            return
+        self._rows += flatten_response(indicator, indicator_type, data)
+        if 'error' not in data:
+            self.done.add((indicator, indicator_type))
+        self.count += 1
+        if len(self._rows) >= self.flush_rows or time.monotonic() - self._flushed >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        self._flushed = time.monotonic()
+        if not self._rows:
+            return
+        table = pa.Table.from_pylist(self._rows, schema=reputation_schema)
+        part_file = os.path.join(self.reputation_parquet, f"part-{self._next_part:06d}.parquet")
+        # Dot files are ignored by dataset readers until renamed
+        tmp_file = os.path.join(self.reputation_parquet, f".part-{self._next_part:06d}.parquet.tmp")
+        pq.write_table(table, tmp_file)
+        os.replace(tmp_file, part_file)
+        self._next_part += 1
+        self._rows = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # Results received before a failure are kept, they are complete rows
+        self.close()
+
+
+def read_reputation(reputation_parquet) -> pa.Table:
+    """Everything summarized so far, an empty table when nothing is."""
+    _recover(reputation_parquet)
+    parts = _part_files(reputation_parquet) if os.path.isdir(reputation_parquet) else []
+    if not parts:
+        return reputation_schema.empty_table()
+    return pq.read_table(parts, schema=reputation_schema)
+
+
+def blocklist_rows(blocklist_matches) -> pa.Table:
+    """Rows of reputation_schema for the hits in a blocklist matches parquet."""
+    matches = pq.read_table(blocklist_matches, columns=['ip', 'version', 'feed'])
+    versions = matches['version'].to_numpy()
+    columns = {
+        'indicator_type': pa.array(np.where(versions == 4, 'ipv4', 'ipv6'), type=pa.string()),
+        'source': pa.array(np.full(matches.num_rows, 'blocklist'), type=pa.string()),
+        'feed': matches['feed'].cast(pa.string()),
+        'indicator': matches['ip'],
+    }
+    return pa.table([columns[field.name] if field.name in columns else pa.nulls(matches.num_rows, field.type)
+                     for field in reputation_schema], schema=reputation_schema)
+
+
+def compact_reputation(reputation_parquet, blocklist_matches=None) -> pa.Table:
+    """
+    Rewrites the dataset as a single part, sorted by indicator, and returns it.
+    The hits in blocklist_matches replace any blocklist rows merged before,
+    and failures superseded by a later result are dropped.
+    """
+    table = _latest_results(read_reputation(reputation_parquet))
+    if blocklist_matches is not None:
+        table = table.filter(_otx_rows(table))
+        table = pa.concat_tables([table, blocklist_rows(blocklist_matches)])
+    table = table.sort_by([('indicator', 'ascending')])
+    tmp_dir = f"{reputation_parquet}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    pq.write_table(table, os.path.join(tmp_dir, 'part-000001.parquet'))
+    old_dir = f"{reputation_parquet}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.isdir(reputation_parquet):
+        os.replace(reputation_parquet, old_dir)
+    elif os.path.exists(reputation_parquet):
+        os.remove(reputation_parquet)
+    os.replace(tmp_dir, reputation_parquet)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return table
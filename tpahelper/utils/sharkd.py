@@ -0,0 +1,267 @@
+# Warm sharkd worker pool.
+# sharkd loads the dissectors once and forks a session per connection on its
+# unix socket, so a connected session answers frame, filter and field
+# queries in milliseconds instead of paying tshark startup every time. The
+# pool keeps a few sharkd daemons running, caches one session per capture
+# (the capture is loaded once), evicts idle sessions and bounds the number
+# of requests in flight.
+#
+# Requests use the sharkd JSON-RPC API (Wireshark 3.6 and later).
+#
+# Usage:
+#   pool = SharkdPool()
+#   pool.frames(pcap_file, filter='modbus', limit=100)
+#   pool.frame(pcap_file, 42)
+#   pool.close()
+
+import itertools
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+WORKERS = 1
+MAX_SESSIONS = 8
+IDLE_TIMEOUT = 600
+MAX_CONCURRENT = 4
+START_TIMEOUT = 10
+REQUEST_TIMEOUT = 120
+
+
+class SharkdError(RuntimeError):
+    pass
+
+
+class SharkdSession:
+    """A connection to a sharkd daemon with one capture loaded. Requests are serialized."""
+
+    def __init__(self, socket_path, pcap_file, timeout: float = REQUEST_TIMEOUT):
+        self.pcap_file = pcap_file
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        try:
+            self._socket.connect(socket_path)
+            self._reader = self._socket.makefile('rb')
+            self.request('load', file=os.path.abspath(pcap_file))
+        except (OSError, SharkdError):
+            self._socket.close()
+            raise
+
+    def request(self, method: str, **params):
+        """Sends a JSON-RPC request and returns its result, raising SharkdError on errors."""
+        message = {'jsonrpc': '2.0', 'id': next(self._ids), 'method': method}
+        if params:
+            message['params'] = params
+        self.last_used = time.monotonic()
+        self._socket.sendall(json.dumps(message).encode() + b'\n')
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionResetError(f"sharkd closed the session of {self.pcap_file}")
+        response = json.loads(line)
+        if 'error' in response:
+            error = response['error']
+            raise SharkdError(f"{method}: {error.get('message', error)}")
+        return response.get('result')
+
+    def close(self):
+        try:
+            self._socket.sendall(json.dumps({'jsonrpc': '2.0', 'id': 0, 'method': 'bye'}).encode() + b'\n')
+        except OSError:
+            pass
+        self._reader.close()
+        self._socket.close()
+
+
+class SharkdPool:
+    """
+    Pool of long-lived sharkd daemons listening on unix sockets in socket_dir
+    (a private temporary directory by default). Sessions are cached per
+    capture, the least recently used one is closed past max_sessions and any
+    unused for idle_timeout seconds is closed in the background. At most
+    max_concurrent requests run at once, each session handles one at a time.
+    """
+
+    def __init__(self, workers: int = WORKERS, max_sessions: int = MAX_SESSIONS,
+                 idle_timeout: float = IDLE_TIMEOUT, max_concurrent: int = MAX_CONCURRENT,
+                 socket_dir: str = None, sharkd: str = 'sharkd'):
+        self.workers = max(1, workers)
+        self.max_sessions = max(1, max_sessions)
+        self.idle_timeout = idle_timeout
+        self.sharkd = sharkd
+        self._own_dir = socket_dir is None
+        self.socket_dir = socket_dir or tempfile.mkdtemp(prefix='sharkd-')
+        os.makedirs(self.socket_dir, mode=0o700, exist_ok=True)
+        self._daemons = [None] * self.workers
+        # Starting a daemon holds only its own lock, never the pool lock
+        self._daemon_locks = [threading.Lock() for _ in range(self.workers)]
+        self._next_daemon = itertools.count()
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrent))
+        self._closed = threading.Event()
+        self._reaper = threading.Thread(target=self._reap, name='sharkd-reaper', daemon=True)
+        self._reaper.start()
+
+    def _socket_path(self, worker: int) -> str:
+        return os.path.join(self.socket_dir, f"sharkd-{worker}.sock")
+
+    def _daemon_socket(self) -> str:
+        # Round robin over the daemons, (re)starting one that isn't running
+        worker = next(self._next_daemon) % self.workers
+        path = self._socket_path(worker)
+        with self._daemon_locks[worker]:
+            if self._closed.is_set():
+                raise SharkdError("sharkd pool is closed")
+            daemon = self._daemons[worker]
+            if daemon is None or daemon.poll() is not None:
+                if os.path.exists(path):
+                    os.remove(path)
+                daemon = subprocess.Popen([self.sharkd, f"unix:{path}"], stdin=subprocess.DEVNULL,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                self._daemons[worker] = daemon
+                deadline = time.monotonic() + START_TIMEOUT
+                while not os.path.exists(path):
+                    if daemon.poll() is not None or time.monotonic() > deadline:
+                        daemon.kill()
+                        raise SharkdError(f"{self.sharkd} failed to start on {path}")
+                    time.sleep(0.05)
+        return path
+
+    def _session(self, pcap_file) -> SharkdSession:
+        key = os.path.realpath(pcap_file)
+        with self._lock:
+            if self._closed.is_set():
+                raise SharkdError("sharkd pool is closed")
+            session = self._sessions.get(key)
+            if session is not None:
+                session.last_used = time.monotonic()
+                return session
+
+        # Starting a daemon and loading a capture can take a while, other sessions stay usable meanwhile
+        session = SharkdSession(self._daemon_socket(), pcap_file)
+        evicted = None
+        with self._lock:
+            if self._closed.is_set():
+                session.close()
+                raise SharkdError("sharkd pool is closed")
+            loaded = self._sessions.get(key)
+            if loaded is None:
+                idle = [k for k, s in self._sessions.items() if not s.lock.locked()]
+                if len(self._sessions) >= self.max_sessions and idle:
+                    evicted = self._sessions.pop(min(idle, key=lambda k: self._sessions[k].last_used))
+                self._sessions[key] = session
+        if loaded is not None:
+            # Another request loaded it first
+            session.close()
+            return loaded
+        if evicted is not None:
+            self._close_session(evicted)
+        return session
+
+    @staticmethod
+    def _close_session(session):
+        # Called without self._lock, a busy session is closed once its request is done
+        with session.lock:
+            session.close()
+
+    def _pop_sessions(self, keys) -> list:
+        # Called with self._lock held
+        return [self._sessions.pop(key) for key in keys]
+
+    def request(self, pcap_file, method: str, **params):
+        """
+        Runs a sharkd request against pcap_file, e.g. request(pcap, 'frames', filter='dnp3').
+        A session that died is replaced once before giving up.
+        """
+        if not self._slots.acquire(timeout=REQUEST_TIMEOUT):
+            raise SharkdError("Too many sharkd requests in progress")
+        try:
+            key = os.path.realpath(pcap_file)
+            for attempt in range(2):
+                session = self._session(pcap_file)
+                try:
+                    with session.lock:
+                        return session.request(method, **params)
+                except (OSError, ValueError) as e:
+                    with self._lock:
+                        failed = self._sessions.get(key) is session
+                        if failed:
+                            del self._sessions[key]
+                    if failed:
+                        self._close_session(session)
+                    if attempt:
+                        raise SharkdError(f"sharkd session of {pcap_file} failed: {e}") from e
+        finally:
+            self._slots.release()
+
+    def status(self, pcap_file) -> dict:
+        """Frame count, duration and file size of the loaded capture."""
+        return self.request(pcap_file, 'status')
+
+    def frames(self, pcap_file, filter: str = None, skip: int = 0, limit: int = 100, columns: list = None) -> list:
+        """Summary rows of the frames matching a display filter, as {'num': n, 'c': [columns...]}."""
+        params = {'skip': skip, 'limit': limit}
+        if filter:
+            params['filter'] = filter
+        for i, column in enumerate(columns or []):
+            params[f"column{i}"] = column
+        return self.request(pcap_file, 'frames', **params)
+
+    def frame(self, pcap_file, number: int, tree: bool = True, data: bool = False) -> dict:
+        """Dissection tree (and bytes with data=True) of one frame."""
+        params = {'frame': number}
+        if tree:
+            params['proto'] = True
+        if data:
+            params['bytes'] = True
+        return self.request(pcap_file, 'frame', **params)
+
+    def check_filter(self, pcap_file, filter: str) -> bool:
+        """True when filter is a valid display filter."""
+        try:
+            self.request(pcap_file, 'check', filter=filter)
+        except SharkdError:
+            return False
+        return True
+
+    def _reap(self):
+        while not self._closed.wait(max(1.0, self.idle_timeout / 4)):
+            now = time.monotonic()
+            with self._lock:
+                idle = self._pop_sessions([k for k, s in self._sessions.items()
+                                           if now - s.last_used > self.idle_timeout and not s.lock.locked()])
+            for session in idle:
+                self._close_session(session)
+
+    def close(self):
+        """Closes every session and stops the daemons."""
+        self._closed.set()
+        with self._lock:
+            sessions = self._pop_sessions(list(self._sessions))
+        for session in sessions:
+            self._close_session(session)
+        for worker, daemon_lock in enumerate(self._daemon_locks):
+            # Waits for a daemon being started, none is started after this
+            with daemon_lock:
+                daemon = self._daemons[worker]
+                if daemon is not None and daemon.poll() is None:
+                    daemon.terminate()
+                    try:
+                        daemon.wait(timeout=5)
+                    except subprocess.TimeoutExpired:
+                        daemon.kill()
+        if self._own_dir:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,177 @@
+# Near-duplicate collapsing of extracted strings.
+# Variable tokens (timestamps, addresses, hex, numbers) are replaced with
+# placeholders so strings differing only in those values share a template.
+# Templates are then clustered with MinHash/LSH over character shingles to
+# merge fuzzier matches, and written as a counted table ranked by frequency.
+# Memory is bounded by the number of distinct templates, not strings.
+
+import re
+import zlib
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Placeholder patterns, applied in order. They are RE2 compatible so whole
+# batches can be normalized in Arrow.
+template_patterns = [
+    ('TS', r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?"
+           r"|\d{4}[-/]\d{2}[-/]\d{2}|\d{1,2}:\d{2}:\d{2}(?:\.\d+)?"),
+    ('UUID', r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"),
+    ('MAC', r"(?:[0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2}"),
+    ('IP', r"\d{1,3}(?:\.\d{1,3}){3}"),
+    ('HEX', r"0[xX][0-9a-fA-F]+|\b[0-9a-fA-F]{8,}\b"),
+    ('NUM', r"[-+]?\d+(?:\.\d+)?"),
+]
+_template_regexes = [(re.compile(pattern), f"<{name}>") for name, pattern in template_patterns]
+
+NUM_PERM = 32
+BANDS = 8
+SHINGLE = 3
+SIMILARITY = 0.6
+MAX_MEMBERS = 20
+
+templates_schema = pa.schema([
+    ('rank', pa.uint32()),
+    ('count', pa.uint64()),
+    ('template', pa.string()),
+    ('templates', pa.uint32()),
+    ('example', pa.string()),
+    ('first_packet', pa.uint32()),
+    ('members', pa.list_(pa.string())),
+])
+
+
+def normalize(value: str) -> str:
+    """Returns the template of a string, with variable tokens replaced by <NAME> placeholders."""
+    for regex, placeholder in _template_regexes:
+        value = regex.sub(placeholder, value)
+    return value
+
+
+def normalize_array(values: pa.Array) -> pa.Array:
+    """normalize() over an Arrow string array."""
+    for name, pattern in template_patterns:
+        values = pc.replace_substring_regex(values, pattern=pattern, replacement=f"<{name}>")
+    return values
+
+
+def _minhash_params(seed: int = 1):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, np.iinfo(np.uint64).max, NUM_PERM, dtype=np.uint64, endpoint=True) | np.uint64(1)
+    b = rng.integers(0, np.iinfo(np.uint64).max, NUM_PERM, dtype=np.uint64, endpoint=True)
+    return a, b
+
+
+def _shingle_hashes(template: str) -> list:
+    return [zlib.crc32(template[i:i + SHINGLE].encode())
+            for i in range(max(1, len(template) - SHINGLE + 1))]
+
+
+def minhash_signatures(templates: list, params, chunk_size: int = 250_000) -> np.ndarray:
+    """MinHash signatures over the character shingles of templates, one row per template."""
+    a, b = params
+    signatures = np.empty((len(templates), NUM_PERM), dtype=np.uint64)
+    first = 0
+    while first < len(templates):
+        # Hash the shingles of a run of templates at once, bounded by chunk_size shingles
+        hashes, lengths = [], []
+        last = first
+        while last < len(templates) and (not lengths or len(hashes) < chunk_size):
+            shingles = _shingle_hashes(templates[last])
+            hashes.extend(shingles)
+            lengths.append(len(shingles))
+            last += 1
+        hashes = np.array(hashes, dtype=np.uint64)
+        # Multiply-shift hashing, one (a, b) pair per permutation, wrapping mod 2**64
+        permuted = (hashes[:, None] * a + b) >> np.uint64(32)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        signatures[first:last] = np.minimum.reduceat(permuted, offsets, axis=0)
+        first = last
+    return signatures
+
+
+class _UnionFind:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parent[max(i, j)] = min(i, j)
+
+
+def cluster_templates(templates: list) -> list:
+    """
+    Clusters similar templates with MinHash/LSH. Templates sharing a band
+    bucket are merged when their estimated similarity reaches SIMILARITY.
+    Returns the cluster id of every template.
+    """
+    params = _minhash_params()
+    rows = NUM_PERM // BANDS
+    signatures = minhash_signatures(templates, params)
+    clusters = _UnionFind(len(templates))
+    for band in range(BANDS):
+        buckets = {}
+        for i, key in enumerate(map(bytes, signatures[:, band * rows:(band + 1) * rows])):
+            j = buckets.setdefault(key, i)
+            if j != i and np.mean(signatures[i] == signatures[j]) >= SIMILARITY:
+                clusters.union(i, j)
+    return [clusters.find(i) for i in range(len(templates))]
+
+
+def collapse_strings(strings_parquet, templates_parquet) -> int:
+    """
+    Collapses the string occurrences in strings_parquet (as written by
+    extract_strings) into a ranked template table in templates_parquet.
+    Returns the number of rows written.
+    """
+    # template -> [count, example, first packet]
+    stats = {}
+    parquet = pq.ParquetFile(strings_parquet)
+    for batch in parquet.iter_batches(columns=['string', 'packet']):
+        # Occurrences per string, then per template, before anything reaches Python
+        strings = pa.table({'string': batch.column('string').cast(pa.string()), 'packet': batch.column('packet')})
+        strings = strings.group_by('string').aggregate([('packet', 'count'), ('packet', 'min')])
+        strings = strings.append_column('template', normalize_array(strings['string']))
+        strings = strings.sort_by('packet_min')
+        templates = strings.group_by('template', use_threads=False).aggregate(
+            [('packet_count', 'sum'), ('packet_min', 'min'), ('string', 'first')])
+
+        for template, count, first, example in zip(*(templates[c].to_pylist() for c in (
+                'template', 'packet_count_sum', 'packet_min_min', 'string_first'))):
+            entry = stats.get(template)
+            if entry is None:
+                stats[template] = [count, example, first]
+            else:
+                entry[0] += count
+                if first < entry[2]:
+                    entry[1], entry[2] = example, first
+
+    templates = list(stats)
+    groups = {}
+    for template, cluster in zip(templates, cluster_templates(templates) if templates else []):
+        groups.setdefault(cluster, []).append(template)
+
+    rows = []
+    for members in groups.values():
+        members.sort(key=lambda t: -stats[t][0])
+        head = stats[members[0]]
+        rows.append((sum(stats[t][0] for t in members), members[0], len(members), head[1],
+                     min(stats[t][2] for t in members), members[:MAX_MEMBERS]))
+    rows.sort(key=lambda row: (-row[0], row[4]))
+
+    columns = list(zip(*rows)) if rows else [[]] * 6
+    table = pa.Table.from_arrays(
+        [pa.array(range(1, len(rows) + 1), type=pa.uint32())] +
+        [pa.array(column, type=field.type) for column, field in zip(columns, list(templates_schema)[1:])],
+        schema=templates_schema)
+    pq.write_table(table, templates_parquet)
+    return len(rows)
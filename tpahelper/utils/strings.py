@@ -0,0 +1,167 @@
+# In-process strings extractor for protocol pcaps.
+# The capture is memory-mapped and scanned in chunks: bytes are classified
+# with a lookup table, printable runs are found with NumPy, and runs are
+# filtered to language-like strings (as strictstrings does) before any
+# Python string is built. Runs never span packets, record headers are masked.
+
+import mmap
+import os
+import struct
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from tpahelper.utils.pcap import PcapReader
+from tpahelper.utils.string_templates import collapse_strings
+
+CHUNK_SIZE = 32 * 1024 * 1024
+MIN_LENGTH = 4
+
+# Byte classes. Letter, vowel and word character counts are packed in 21 bit
+# fields of one int64, so a single reduction counts all three per run.
+_printable = np.zeros(256, dtype=bool)
+_printable[0x20:0x7f] = True
+_printable[ord('\t')] = True
+_letters = np.zeros(256, dtype=np.int64)
+_letters[ord('a'):ord('z') + 1] = 1
+_letters[ord('A'):ord('Z') + 1] = 1
+_vowels = np.zeros(256, dtype=np.int64)
+_vowels[list(b'aeiouyAEIOUY')] = 1
+_words = _letters.copy()
+_words[ord('0'):ord('9') + 1] = 1
+_words[list(b' \t.,:;-_/')] = 1
+_classes = _letters | (_vowels << 21) | (_words << 42)
+_FIELD = (1 << 21) - 1
+
+strings_schema = pa.schema([
+    ('string', pa.dictionary(pa.int32(), pa.string())),
+    ('packet', pa.uint32()),
+    ('offset', pa.uint32()),
+    ('file_offset', pa.uint64()),
+])
+
+
+def _packet_ranges(pcap_file):
+    # File offsets of the first and past-the-end data byte of every packet
+    starts = []
+    ends = []
+    with PcapReader(pcap_file) as reader:
+        if reader.format == 'pcap':
+            # Walk the record headers only, the packet data is never copied
+            header = struct.Struct(reader._endian + 'II')
+            mm = reader._mm
+            size = len(mm)
+            offset = 24
+            while offset + 16 <= size:
+                caplen, _ = header.unpack_from(mm, offset + 8)
+                end = offset + 16 + caplen
+                if end > size:
+                    break
+                starts.append(offset + 16)
+                ends.append(end)
+                offset = end
+        else:
+            for record in reader:
+                # pcapng: simple packet blocks hold data at 12, the others at 28
+                start = record.offset + (12 if record.size - record.caplen < 32 else 28)
+                starts.append(start)
+                ends.append(start + record.caplen)
+    return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+
+def find_strings(buffer, starts, ends, min_length: int = MIN_LENGTH):
+    """
+    Yields (run_starts, run_ends, packet_numbers) arrays of the language-like
+    strings in buffer, a chunk at a time. starts/ends are the data ranges of
+    the packets in buffer, packet numbers are 0 based indexes into them.
+
+    A string is a run of at least min_length printable bytes within a packet,
+    at least 80% letters, digits, whitespace or common punctuation, with three
+    or more letters including a vowel, and more than one distinct character.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    # Three letters are required, shorter runs can't qualify
+    min_length = max(min_length, 3)
+    first = 0
+    while first < len(starts):
+        # Take whole packets up to CHUNK_SIZE bytes, at least one
+        last = int(np.searchsorted(ends, starts[first] + CHUNK_SIZE, 'right'))
+        last = max(last, first + 1)
+        base = int(starts[first])
+        chunk = data[base:int(ends[last - 1])]
+
+        # Bytes outside packet data (record headers, padding) are not printable
+        data_lengths = ends[first:last] - starts[first:last]
+        gap_lengths = np.append(starts[first + 1:last] - ends[first:last - 1], 0)
+        inside = np.repeat(np.tile([True, False], last - first),
+                           np.column_stack((data_lengths, gap_lengths)).ravel())
+        printable = _printable[chunk] & inside
+
+        edges = np.diff(np.concatenate(([False], printable, [False])).astype(np.int8))
+        run_starts = np.flatnonzero(edges == 1)
+        run_ends = np.flatnonzero(edges == -1)
+        keep = run_ends - run_starts >= min_length
+        run_starts, run_ends = run_starts[keep], run_ends[keep]
+
+        if len(run_starts):
+            lengths = run_ends - run_starts
+            # Sum each run by reducing over [start, end) pairs, odd slots span the gaps.
+            # The last end is the end of run_bytes, so it is left out.
+            run_bytes = chunk[:int(run_ends[-1])]
+            counts = np.add.reduceat(_classes[run_bytes], np.column_stack((run_starts, run_ends)).ravel()[:-1])[::2]
+            letters = counts & _FIELD
+            vowels = (counts >> 21) & _FIELD
+            words = counts >> 42
+            # A run of one repeated character has no byte differing from the previous one
+            changes = (run_bytes[1:] != run_bytes[:-1]).view(np.int8)
+            distinct = np.add.reduceat(changes, np.column_stack((run_starts, run_ends - 1)).ravel()[:-1],
+                                       dtype=np.int64)[::2] > 0
+            keep = (words * 5 >= lengths * 4) & (letters >= 3) & (vowels > 0) & distinct
+            run_starts, run_ends = run_starts[keep] + base, run_ends[keep] + base
+            packets = np.searchsorted(starts, run_starts, 'right') - 1
+            yield run_starts, run_ends, packets
+
+        first = last
+
+
+def extract_strings(pcap_file, strings_file, strings_parquet, min_length: int = MIN_LENGTH) -> int:
+    """
+    Extracts the strings of pcap_file. Every occurrence is written to
+    strings_parquet with its packet number (1 based, as in Wireshark), offset
+    in the packet and file offset; the unique strings are written to
+    strings_file in order of appearance. Returns the number of unique strings.
+    """
+    starts, ends = _packet_ranges(pcap_file)
+    seen = set()
+    writer = pq.ParquetWriter(strings_parquet, strings_schema)
+    try:
+        with open(pcap_file, 'rb') as in_file, open(strings_file, 'w') as out_file:
+            buffer = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) if len(starts) else b''
+            for run_starts, run_ends, packets in find_strings(buffer, starts, ends, min_length):
+                values = [buffer[s:e].decode('ascii') for s, e in zip(run_starts.tolist(), run_ends.tolist())]
+                for value in values:
+                    if value not in seen:
+                        seen.add(value)
+                        out_file.write(value + "\n")
+                writer.write_table(pa.Table.from_arrays([
+                    pa.array(values).dictionary_encode(),
+                    pa.array(packets + 1, type=pa.uint32()),
+                    pa.array(run_starts - starts[packets], type=pa.uint32()),
+                    pa.array(run_starts, type=pa.uint64()),
+                ], schema=strings_schema))
+    finally:
+        writer.close()
+    return len(seen)
+
+
+def extract_strings_task(args) -> tuple:
+    """
+    Process pool entry point, args is (pcap_file, strings_file, strings_parquet,
+    templates_parquet, min_length). The extracted strings are collapsed into
+    templates_parquet in the same worker.
+    Returns the pcap name and the number of unique strings and templates.
+    """
+    pcap_file, strings_file, strings_parquet, templates_parquet, min_length = args
+    unique = extract_strings(pcap_file, strings_file, strings_parquet, min_length)
+    return os.path.basename(pcap_file), unique, collapse_strings(strings_parquet, templates_parquet)